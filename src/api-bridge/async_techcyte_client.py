@@ -0,0 +1,232 @@
+import asyncio
+import base64
+import functools
+import random
+import time
+import uuid
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Union
+
+import aiohttp
+
+from geojson_builder import request_body
+from techcyte_client import (
+    DEFAULT_TOKEN_LIFETIME,
+    RETRY_STATUSES,
+    TOKEN_REFRESH_MARGIN,
+    _token_cache,
+    api_url,
+)
+
+# Shares TechcyteClient's process-wide token cache, this lock serializes async refreshes
+_token_lock = None
+
+
+def _get_token_lock() -> asyncio.Lock:
+    global _token_lock
+    if _token_lock is None:
+        _token_lock = asyncio.Lock()
+    return _token_lock
+
+
+async def async_request_body(
+    results: Any, compress: bool = False, tracer=None
+) -> Union[bytes, AsyncIterator[bytes]]:
+    """geojson_builder.request_body, serialized on the default executor to keep the event loop free."""
+    loop = asyncio.get_running_loop()
+    body = await loop.run_in_executor(
+        None, functools.partial(request_body, results, compress, tracer=tracer)
+    )
+    if isinstance(body, bytes):
+        return body
+
+    async def stream():
+        while True:
+            chunk = await loop.run_in_executor(None, next, body, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    return stream()
+
+
+class AsyncTechcyteClient:
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        host: str = "app.techcyte.com",
+        jwt_token: Union[str, None] = None,
+        api_key_id: Union[str, None] = None,
+        api_key_secret: Union[str, None] = None,
+        timeout: float = 30,
+        retries: int = 3,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+    ):
+        """
+        Asyncio version of TechcyteClient on top of a shared aiohttp session.
+
+        Args:
+            session: Session reused for every request, owned by the caller
+            host: Techcyte host, e.g. ci.techcyte.com
+            jwt_token: Task specific token, used when no API key is given
+            api_key_id: API key id, used to request (and refresh) tokens
+            api_key_secret: API key secret
+            timeout: Total timeout per request in seconds
+            retries: Retries after a connection error, timeout, 429 or 5xx
+            backoff: Base delay in seconds, doubled every retry with random jitter
+            max_backoff: Longest delay in seconds, a longer Retry-After isn't waited for
+        """
+        self.session = session
+        self.host = host
+        self.base_url = f"{api_url(host)}/api/v3"
+        self.token = jwt_token
+        self.token_expires_at = None
+        self.api_key_id = api_key_id
+        self.api_key_secret = api_key_secret
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        if not self.token and not self.api_key_secret:
+            raise ValueError(
+                "Either JWT_TOKEN or API_KEY_ID+API_KEY_SECRET environment variable must be set"
+            )
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {
+            "Authorization": f"Bearer {self.token}",
+            "Content-Type": "application/json",
+        }
+
+    async def update_token(self, force: bool = False):
+        """
+        Get an access token for the API key, reusing the process-wide cached one if it's still fresh.
+
+        Args:
+            force: Always request a new token, e.g. after the current one was rejected
+        """
+        cache_key = (self.host, self.api_key_id)
+        async with _get_token_lock():
+            cached = _token_cache.get(cache_key)
+            if cached and (not force or cached[0] != self.token):
+                # When forced, another client may already have replaced the rejected token
+                self.token, self.token_expires_at = cached
+                if time.time() < self.token_expires_at - TOKEN_REFRESH_MARGIN:
+                    return
+            self.token, self.token_expires_at = await self._request_token()
+            _token_cache[cache_key] = (self.token, self.token_expires_at)
+
+    async def _request_token(self):
+        url = f"{self.base_url}/token"
+        # Combine api_key_id and api_key_secret with a colon and Base64 encode
+        auth_string = f"{self.api_key_id}:{self.api_key_secret}"
+        auth_encoded = base64.b64encode(auth_string.encode()).decode()
+        headers = {
+            "accept": "application/json, text/plain, */*",
+            "authorization": f"Basic {auth_encoded}",
+        }
+        data = {"grant_type": "client_credentials"}
+        async with self.session.post(url, headers=headers, data=data, timeout=self.timeout) as response:
+            response.raise_for_status()
+            body = await response.json()
+        expires_in = body.get("expires_in") or DEFAULT_TOKEN_LIFETIME
+        return body["access_token"], time.time() + float(expires_in)
+
+    def _retry_delay(self, attempt: int, retry_after: Optional[str] = None) -> Optional[float]:
+        """Seconds to wait before retrying, None if the server asks for longer than max_backoff."""
+        if retry_after and retry_after.isdigit():
+            return float(retry_after) if float(retry_after) <= self.max_backoff else None
+        return min(self.backoff * 2**attempt * random.uniform(0.5, 1.5), self.max_backoff)
+
+    async def _request(
+        self,
+        method: str,
+        url: str,
+        body: Optional[Callable[[], Awaitable[Any]]] = None,
+        headers: Optional[Dict[str, str]] = None,
+        **kwargs,
+    ) -> aiohttp.ClientResponse:
+        """
+        Send an authorized request and return the response with its body read.
+
+        Refreshes the token when it's close to expiry or rejected, and retries
+        connection errors, timeouts, 429 and 5xx responses with jittered backoff. A
+        response asking to retry after more than max_backoff seconds is returned as is.
+        `body` returns the request data and is awaited for every attempt, so a
+        streamed body can be sent again.
+        """
+        refreshed = False
+        attempt = 0
+        while True:
+            if self.api_key_secret:
+                await self.update_token()
+            if body is not None:
+                kwargs["data"] = await body()
+            try:
+                async with self.session.request(
+                    method,
+                    url,
+                    headers={**self.headers, **(headers or {})},
+                    timeout=self.timeout,
+                    **kwargs,
+                ) as response:
+                    await response.read()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt >= self.retries:
+                    raise
+                await asyncio.sleep(self._retry_delay(attempt))
+                attempt += 1
+                continue
+
+            if response.status == 401 and self.api_key_secret and not refreshed:
+                # The cached token may have been revoked or expired early, retry once with a new one
+                await self.update_token(force=True)
+                refreshed = True
+                continue
+            if response.status in RETRY_STATUSES and attempt < self.retries:
+                delay = self._retry_delay(attempt, response.headers.get("Retry-After"))
+                if delay is not None:
+                    await asyncio.sleep(delay)
+                    attempt += 1
+                    continue
+            return response
+
+    async def post_results(
+        self,
+        task_id: str,
+        results: Dict[str, Any],
+        compress: bool = False,
+        tracer=None,
+        idempotency_key: Optional[str] = None,
+    ) -> aiohttp.ClientResponse:
+        """
+        Post results to the /external/results/{task_id} endpoint.
+
+        Args:
+            task_id: The ID of the task
+            results: Dictionary containing caseResults and scanResults as per the schema,
+                feature collections may be geojson_builder.FeatureBuilders
+            compress: Gzip the request body
+            tracer: Optional tracing.Tracer, records the serialization of every attempt
+            idempotency_key: Sent as the Idempotency-Key header of every attempt, so the
+                server can tell a retry from a new post. Defaults to a new random key.
+
+        Returns:
+            aiohttp.ClientResponse: The response from the server, body already read
+
+        Raises:
+            aiohttp.ClientError: If the request fails
+        """
+        url = f"{self.base_url}/external/results/{task_id}"
+        headers = {"Idempotency-Key": idempotency_key or str(uuid.uuid4())}
+        if compress:
+            headers["Content-Encoding"] = "gzip"
+        response = await self._request(
+            "POST",
+            url,
+            body=lambda: async_request_body(results, compress, tracer),
+            headers=headers,
+        )
+        response.raise_for_status()
+        return response
@@ -0,0 +1,183 @@
+"""
+Dynamic batching of model calls across slides.
+
+With the thread backend every scan being processed calls the model with its own
+small batch of tiles. A `DynamicBatcher` wraps the model instead: callers hand
+it their tiles and wait, and a single inference thread concatenates the tiles
+of every waiting caller into batches of up to `batch_size`, runs the model once
+per batch and hands each caller back the outputs of its own tiles, in order.
+
+A batch runs as soon as it's full, as soon as every caller inside a `session`
+is waiting on it (nobody else could add tiles), or `max_wait` seconds after its
+oldest tiles arrived, whichever comes first. A single slide therefore isn't
+slowed down, and several slides share large batches. When the model fails on a
+shared batch, each caller's tiles are run again on their own, so only the
+caller whose tiles fail gets the error.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, Dict, List, Sequence
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class _Request:
+    def __init__(self, tiles: np.ndarray):
+        self.tiles = tiles
+        self.offset = 0  # Tiles up to here are in a batch already
+        self.outputs: List[Any] = [None] * len(tiles)
+        self.filled = 0
+        self.arrived = time.monotonic()
+        self.error = None
+        self.done = threading.Event()
+
+
+class DynamicBatcher:
+    def __init__(self, model: Callable[[np.ndarray], Sequence], batch_size: int, max_wait: float = 0.01):
+        """
+        Args:
+            model: Takes a (N, H, W, 3) batch of tiles and returns one output per tile
+            batch_size: Most tiles per model call
+            max_wait: Seconds tiles may wait for a batch to fill
+        """
+        if batch_size <= 0:
+            raise ValueError("batch_size must be positive")
+        self.model = model
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.counters = {"batches": 0, "tiles": 0, "full_batches": 0, "timed_out_batches": 0}
+        self._pending = deque()
+        self._outstanding = 0  # Requests submitted and not answered yet
+        self._sessions = 0
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="inference", daemon=True)
+        self._thread.start()
+
+    @contextmanager
+    def session(self):
+        """Mark a caller as busy with a slide, so batches wait for its tiles for up to `max_wait`."""
+        with self._condition:
+            self._sessions += 1
+        try:
+            yield self
+        finally:
+            with self._condition:
+                self._sessions -= 1
+                self._condition.notify()
+
+    def __call__(self, tiles: np.ndarray) -> List[Any]:
+        """Run the model over `tiles` as part of a shared batch, returning their outputs."""
+        if len(tiles) == 0:
+            return []
+        request = _Request(tiles)
+        with self._condition:
+            self._pending.append(request)
+            self._outstanding += 1
+            self._condition.notify()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.outputs
+
+    def _queued_tiles(self) -> int:
+        return sum(len(request.tiles) - request.offset for request in self._pending)
+
+    def _next_batch(self):
+        """Wait for a batch to be ready and take its tiles, as (request, start, end) pieces."""
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+            deadline = self._pending[0].arrived + self.max_wait
+            timed_out = False
+            while self._queued_tiles() < self.batch_size and self._outstanding < self._sessions:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    timed_out = True
+                    break
+                self._condition.wait(remaining)
+            pieces = []
+            size = 0
+            while self._pending and size < self.batch_size:
+                request = self._pending[0]
+                end = min(len(request.tiles), request.offset + self.batch_size - size)
+                pieces.append((request, request.offset, end))
+                size += end - request.offset
+                request.offset = end
+                if end == len(request.tiles):
+                    self._pending.popleft()
+            return pieces, size, timed_out
+
+    def _run(self):
+        while True:
+            pieces, size, timed_out = self._next_batch()
+            try:
+                outputs = self._call(pieces, size)
+            except Exception as e:
+                if len(pieces) == 1:
+                    logger.warning(f"Model failed on a batch of {size} tiles: {e}")
+                    self._answer(pieces[0][0], error=e)
+                    continue
+                # Run every caller's tiles on their own, so one bad scan doesn't fail the others
+                logger.warning(f"Model failed on a batch of {size} tiles from {len(pieces)} callers: {e}")
+                for piece in pieces:
+                    try:
+                        self._fill([piece], self._call([piece], piece[2] - piece[1]))
+                    except Exception as e:
+                        self._answer(piece[0], error=e)
+                continue
+            self.counters["batches"] += 1
+            self.counters["tiles"] += size
+            self.counters["full_batches"] += size == self.batch_size
+            self.counters["timed_out_batches"] += timed_out
+            self._fill(pieces, outputs)
+
+    def _call(self, pieces, size: int) -> Sequence:
+        if len(pieces) == 1:
+            request, start, end = pieces[0]
+            tiles = request.tiles[start:end]
+        else:
+            tiles = np.concatenate([request.tiles[start:end] for request, start, end in pieces])
+        outputs = self.model(tiles)
+        if len(outputs) != size:
+            raise ValueError(f"Model returned {len(outputs)} outputs for {size} tiles")
+        return outputs
+
+    def _fill(self, pieces, outputs: Sequence):
+        """Hand every caller the outputs of its tiles, answering those that are complete."""
+        position = 0
+        for request, start, end in pieces:
+            request.outputs[start:end] = outputs[position : position + end - start]
+            position += end - start
+            request.filled += end - start
+            if request.filled == len(request.tiles):
+                self._answer(request)
+
+    def _answer(self, request: _Request, error: Exception = None):
+        with self._condition:
+            if request.done.is_set():
+                return
+            if error is not None:
+                request.error = error
+                if request in self._pending:
+                    self._pending.remove(request)  # Its other tiles aren't worth running
+            self._outstanding -= 1
+        request.done.set()
+
+    def metrics(self) -> Dict[str, Any]:
+        batches = self.counters["batches"]
+        return {
+            **self.counters,
+            "mean_batch_size": self.counters["tiles"] / batches if batches else 0.0,
+            "sessions": self._sessions,
+        }
+
+
+def inference_session(model):
+    """`model.session()` for a DynamicBatcher, a no-op for a plain model."""
+    return model.session() if isinstance(model, DynamicBatcher) else nullcontext(model)
@@ -0,0 +1,120 @@
+"""
+Execution backends for CPU-bound slide processing.
+
+`create_executor` returns either a thread pool (cheap, but CPU-bound Python is
+serialized by the GIL) or a pool of worker processes. Workers are warm: the
+model is loaded once per worker by `_init_worker` and stays resident between
+jobs, and `worker_slide` keeps the last few slide handles open per worker so
+repeated reads of the same scan don't pay for opening it again.
+
+With `batch_size` set, the model is wrapped in a `DynamicBatcher`, so the
+threads of the thread backend share model calls (see batching.py).
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable
+
+from batching import DynamicBatcher
+from remote_slide import is_url, open_slide
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("threads", "processes")
+SLIDE_HANDLES = 2  # Open slide handles kept per worker thread
+
+# Set in every worker by _init_worker. Thread workers share one model.
+_model = None
+_model_lock = threading.Lock()
+_local = threading.local()
+
+
+def _init_worker(model_factory: Callable[[], Any], batch_size: int = 0, max_wait: float = 0.01):
+    global _model
+    with _model_lock:
+        if _model is None:
+            start = time.perf_counter()
+            model = model_factory()
+            _model = DynamicBatcher(model, batch_size, max_wait) if batch_size else model
+            logger.info(f"Loaded model in worker {os.getpid()} in {time.perf_counter() - start:.1f}s")
+
+
+def _ping():
+    pass
+
+
+def worker_model() -> Any:
+    """The model loaded for the current worker."""
+    if _model is None:
+        raise RuntimeError("No model loaded, run inside an executor from create_executor")
+    return _model
+
+
+def worker_slide(image_path: str):
+    """
+    An open slide for `image_path`, reused across calls in the same worker thread.
+
+    Handles are owned by the cache, don't close them. The least recently used
+    handle is closed once more than SLIDE_HANDLES are open.
+    """
+    handles = getattr(_local, "slides", None)
+    if handles is None:
+        handles = _local.slides = OrderedDict()
+    key = image_path
+    if not is_url(image_path):
+        stat = os.stat(image_path)
+        key = (image_path, stat.st_mtime_ns, stat.st_size)  # A replaced file gets a new handle
+    if key in handles:
+        handles.move_to_end(key)
+        return handles[key]
+    handles[key] = open_slide(image_path)
+    while len(handles) > SLIDE_HANDLES:
+        _, slide = handles.popitem(last=False)
+        slide.close()
+    return handles[key]
+
+
+def create_executor(
+    backend: str,
+    max_workers: int,
+    model_factory: Callable[[], Any],
+    batch_size: int = 0,
+    max_wait: float = 0.01,
+) -> Executor:
+    """
+    Create the executor jobs are processed on.
+
+    Args:
+        backend: "threads" or "processes"
+        max_workers: Worker threads or processes
+        model_factory: Picklable callable returning the model, called once per worker
+        batch_size: Batch the model calls of a worker's threads up to this many tiles, 0 doesn't
+        max_wait: Seconds tiles may wait for a batch to fill
+    """
+    initargs = (model_factory, batch_size, max_wait)
+    if backend == "threads":
+        return ThreadPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=initargs)
+    if backend == "processes":
+        # Spawned rather than forked, forking a process running an event loop and
+        # threads isn't safe, and CUDA can't be initialized in a forked child
+        return ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=initargs,
+        )
+    raise ValueError(f"Unknown execution backend {backend!r}, expected one of {BACKENDS}")
+
+
+def warm_up(executor: Executor, max_workers: int):
+    """Start every worker (and load its model) now instead of on the first job."""
+    start = time.perf_counter()
+    # Workers are started on demand, one per submit while none is idle
+    for future in [executor.submit(_ping) for _ in range(max_workers)]:
+        future.result()
+    logger.info(f"Started {max_workers} worker(s) in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,159 @@
+"""
+Deduplicating webhook intake.
+
+The platform may deliver the same webhook more than once, e.g. when it retries
+after a timeout. Every delivery is keyed on its task ID and scan IDs and claimed
+in a small SQLite database before a job is started:
+
+- A delivery whose key is already running is coalesced onto that job.
+- A delivery whose key finished successfully within the TTL gets the cached
+  case results back instead of a new job.
+- Failed tasks are not cached, so a retry runs them again.
+
+The database is shared by every uvicorn worker and survives restarts. Running
+claims are leases renewed by `heartbeat`, so a task whose worker died is taken
+over by the next delivery once its lease expires.
+"""
+
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import time
+from typing import Any, Dict, Optional, Tuple
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS tasks (
+        key TEXT PRIMARY KEY,
+        task_id TEXT NOT NULL,
+        status TEXT NOT NULL,
+        owner TEXT NOT NULL,
+        created REAL NOT NULL,
+        updated REAL NOT NULL,
+        finished REAL,
+        result TEXT
+    )
+"""
+
+
+def intake_key(data: Dict[str, Any]) -> Optional[str]:
+    """Identity of a webhook delivery, None if it has no task_id to deduplicate on."""
+    task_id = data.get("task_id")
+    if not task_id:
+        return None
+    scan_ids = sorted(str(scan_id) for scan_id in (data.get("scans") or {}))
+    return hashlib.sha1(json.dumps([str(task_id), scan_ids]).encode()).hexdigest()
+
+
+class TaskIntake:
+    def __init__(self, path: str, ttl: float = 86400, lease: float = 120):
+        """
+        Args:
+            path: SQLite database file, created if missing
+            ttl: Seconds results of a finished task are returned to duplicate deliveries
+            lease: Seconds without a heartbeat before a running task is considered abandoned
+        """
+        self.path = path
+        self.ttl = ttl
+        self.lease = lease
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.counters = {"accepted": 0, "coalesced": 0, "cached": 0, "taken_over": 0}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._execute("PRAGMA journal_mode=WAL")
+        self._execute(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        # A connection per call, so every method can run on any executor thread
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _execute(self, sql: str, params: tuple = ()) -> list:
+        db = self._connect()
+        try:
+            return db.execute(sql, params).fetchall()
+        finally:
+            db.close()
+
+    def claim(self, key: str, task_id: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """
+        Claim `key` for a new job.
+
+        Returns:
+            (outcome, row): "accepted" if the caller should start a job, "running" if the
+            task is already in progress, "cached" if it finished within the TTL. `row`
+            describes the existing task for the latter two.
+        """
+        now = time.time()
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")  # Serializes claims across threads and workers
+            db.execute(
+                "DELETE FROM tasks WHERE finished IS NOT NULL AND finished < ?", (now - self.ttl,)
+            )
+            row = db.execute(
+                "SELECT task_id, status, owner, created, updated, finished, result FROM tasks WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is not None:
+                existing = dict(zip(["task_id", "status", "owner", "created", "updated", "finished", "result"], row))
+                existing["result"] = json.loads(existing["result"]) if existing["result"] else None
+                if existing["status"] == "running" and existing["updated"] > now - self.lease:
+                    db.execute("COMMIT")
+                    self.counters["coalesced"] += 1
+                    return "running", existing
+                if existing["status"] == "done":
+                    db.execute("COMMIT")
+                    self.counters["cached"] += 1
+                    return "cached", existing
+                if existing["status"] == "running":
+                    self.counters["taken_over"] += 1  # Its worker stopped renewing the lease
+            db.execute(
+                "INSERT OR REPLACE INTO tasks (key, task_id, status, owner, created, updated) "
+                "VALUES (?, ?, 'running', ?, ?, ?)",
+                (key, task_id, self.owner, now, now),
+            )
+            db.execute("COMMIT")
+            self.counters["accepted"] += 1
+            return "accepted", None
+        except BaseException:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+    def finish(self, key: str, status: str, result: Optional[Dict[str, Any]] = None):
+        """Record the outcome of a claimed task. Only "done" tasks are returned to later deliveries."""
+        now = time.time()
+        self._execute(
+            "UPDATE tasks SET status = ?, updated = ?, finished = ?, result = ? WHERE key = ? AND owner = ?",
+            (status, now, now, json.dumps(result) if result is not None else None, key, self.owner),
+        )
+
+    def release(self, key: str):
+        """Drop a claim whose job never started or was cancelled, e.g. because the queue was full."""
+        self._execute(
+            "DELETE FROM tasks WHERE key = ? AND owner = ? AND status = 'running'", (key, self.owner)
+        )
+
+    def release_all(self):
+        """Drop every running claim of this process, so they're run again after a restart."""
+        self._execute("DELETE FROM tasks WHERE owner = ? AND status = 'running'", (self.owner,))
+
+    def heartbeat(self):
+        """Renew the leases of this process' running tasks, call at least every `lease` / 2 seconds."""
+        self._execute(
+            "UPDATE tasks SET updated = ? WHERE owner = ? AND status = 'running'",
+            (time.time(), self.owner),
+        )
+
+    def metrics(self) -> Dict[str, Any]:
+        counts = dict(self._execute("SELECT status, COUNT(*) FROM tasks GROUP BY status"))
+        return {
+            "running": counts.get("running", 0),
+            "done": counts.get("done", 0),
+            "failed": counts.get("failed", 0),
+            **self.counters,
+        }
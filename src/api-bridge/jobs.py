@@ -0,0 +1,192 @@
+"""
+Bounded job scheduling for webhook requests.
+
+Webhooks are admitted into a fixed size queue and picked up by a fixed number of
+worker tasks. Each phase of a job that needs a scarce resource (downloading,
+processing, posting) runs inside `scheduler.stage(job, name)`, which caps how
+many jobs are in that phase at once. The caps are `limits.AdaptiveLimit`s, fixed
+by default or adapting to the latency and errors of the stage. When the queue
+is full `submit` raises `QueueFull` so the webhook can push back on the caller
+instead of piling up work.
+"""
+
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from limits import AdaptiveLimit
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """The admission queue is full, the request should be retried later."""
+
+
+class Job:
+    def __init__(self, task_id: str, data: Dict[str, Any]):
+        self.task_id = task_id
+        self.data = data
+        self.status = "queued"
+        self.error = None
+        self.result = None
+        self.scans = {}  # scan_id -> stage, for jobs that fan out over several scans
+        self.trace = None  # tracing.Tracer of the job's stages, set by the handler
+        self.intake_key = None  # intake.intake_key of the webhook, None if it isn't deduplicated
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "task_id": self.task_id,
+            "status": self.status,
+            "error": self.error,
+            "scans": self.scans,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class JobScheduler:
+    def __init__(
+        self,
+        handler: Callable[[Job], Awaitable[Any]],
+        max_queued: int = 100,
+        max_downloads: int = 4,
+        max_processing: int = 4,
+        max_history: int = 1000,
+        limits: Optional[Dict[str, AdaptiveLimit]] = None,
+        is_overload: Optional[Callable[[BaseException], bool]] = None,
+    ):
+        """
+        Schedule jobs for `handler` with bounded concurrency. Must be created inside the event loop.
+
+        Args:
+            handler: Coroutine function run for every job
+            max_queued: Jobs waiting to start before submit raises QueueFull
+            max_downloads: Jobs allowed in the "downloading" stage at once
+            max_processing: Jobs allowed in the "processing" stage at once
+            max_history: Finished jobs kept for status lookups
+            limits: Limit of every limited stage, instead of fixed max_downloads and max_processing
+            is_overload: Whether an exception raised in a stage means its service is overloaded
+        """
+        self.handler = handler
+        self.max_queued = max_queued
+        self.max_history = max_history
+        self.queue = asyncio.Queue(maxsize=max_queued)
+        self.limits = limits or {
+            "downloading": AdaptiveLimit(max_downloads, minimum=max_downloads),
+            "processing": AdaptiveLimit(max_processing, minimum=max_processing),
+        }
+        self.is_overload = is_overload
+        self.active = {name: 0 for name in self.limits}
+        self.jobs = OrderedDict()
+        self.counters = {"submitted": 0, "rejected": 0, "completed": 0, "failed": 0}
+        self.accepting = True
+        # Enough workers to keep every stage busy. Holding the task references also
+        # keeps running jobs from being garbage collected.
+        self.workers = [
+            asyncio.create_task(self._worker())
+            for _ in range(sum(limit.maximum for limit in self.limits.values()))
+        ]
+
+    def submit(self, data: Dict[str, Any]) -> Job:
+        """
+        Queue `data` as a new job and return it.
+
+        Raises:
+            QueueFull: If the queue is full or the scheduler is shutting down
+        """
+        if not self.accepting:
+            self.counters["rejected"] += 1
+            raise QueueFull("Shutting down")
+        job = Job(data.get("task_id") or str(uuid.uuid4()), data)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.counters["rejected"] += 1
+            raise QueueFull(f"{self.max_queued} jobs already queued")
+        self.counters["submitted"] += 1
+        self.jobs[job.task_id] = job
+        self.jobs.move_to_end(job.task_id)
+        return job
+
+    def get(self, task_id: str) -> Optional[Job]:
+        return self.jobs.get(task_id)
+
+    @asynccontextmanager
+    async def stage(self, job: Job, name: str, scan_id: Optional[str] = None):
+        """
+        Run the body as stage `name` of `job`, waiting for a free slot if the stage is limited.
+
+        Limits are global, so every scan of a job holds its own slot. `scan_id` records
+        which scan of the job the stage belongs to. Yields the limits.Slot (None for
+        unlimited stages), set its `size` to the work done so latency is compared per unit.
+        """
+        limit = self.limits.get(name)
+        if limit is None:
+            job.status = name
+            yield None
+            return
+        async with limit.slot(self.is_overload) as slot:
+            job.status = name
+            if scan_id is not None:
+                job.scans[scan_id] = name
+            self.active[name] += 1
+            try:
+                yield slot
+            finally:
+                self.active[name] -= 1
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            job.status = "running"
+            job.started = time.time()
+            try:
+                job.result = await self.handler(job)
+            except Exception as e:
+                logger.exception(f"Job {job.task_id} failed")
+                job.error = job.error or str(e)
+            finally:
+                job.finished = time.time()
+                job.status = "failed" if job.error else "done"
+                self.counters["failed" if job.error else "completed"] += 1
+                self._trim_history()
+                self.queue.task_done()
+
+    def _trim_history(self):
+        finished = [task_id for task_id, job in self.jobs.items() if job.finished]
+        for task_id in finished[: max(0, len(finished) - self.max_history)]:
+            del self.jobs[task_id]
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "queued": self.queue.qsize(),
+            "max_queued": self.max_queued,
+            "running": sum(1 for job in self.jobs.values() if job.started and not job.finished),
+            **{f"in_{name}": count for name, count in self.active.items()},
+            **{f"limit_{name}": int(limit.limit) for name, limit in self.limits.items()},
+            **self.counters,
+        }
+
+    def limit_metrics(self) -> Dict[str, Dict[str, Any]]:
+        """Current limit, latency and adjustments of every limited stage."""
+        return {name: limit.metrics() for name, limit in self.limits.items()}
+
+    async def drain(self, timeout: float = 300):
+        """Stop accepting jobs, wait up to `timeout` seconds for queued and running jobs, then stop."""
+        self.accepting = False
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Shutting down with {self.queue.qsize()} jobs still queued")
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
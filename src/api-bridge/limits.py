@@ -0,0 +1,179 @@
+"""
+Adaptive concurrency limits.
+
+An `AdaptiveLimit` is an asyncio semaphore whose size follows the service
+behind it (AIMD, additive increase / multiplicative decrease):
+
+- Every completed operation reports its latency, per unit of work (e.g. per
+  byte downloaded), and whether it failed with an overload signal (a 429, a
+  5xx, a timeout, a dropped connection).
+- Once per window of about `limit` completions, the median latency is compared
+  with the best latency seen recently. When it's more than `tolerance` times
+  worse, or overload errors or the `overloaded` check (e.g. low memory) fired,
+  the limit is multiplied by `backoff`.
+- Otherwise, if there was more work than slots during the window, the limit
+  grows by one, up to `maximum`.
+
+The limit therefore settles just below the concurrency where the upstream
+service (or the host) stops getting faster, and backs off quickly when it
+struggles.
+"""
+
+import asyncio
+import statistics
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, Optional
+
+
+class Slot:
+    """A held slot of an AdaptiveLimit. Set `size` to the work done, or call `skip()` if it did none."""
+
+    def __init__(self):
+        self.size = 1.0
+        self.overloaded = False
+        self.sampled = True
+
+    def skip(self):
+        """Don't count this operation's latency, e.g. a cache hit that never reached the service."""
+        self.sampled = False
+
+
+class AdaptiveLimit:
+    def __init__(
+        self,
+        initial: int,
+        minimum: int = 1,
+        maximum: Optional[int] = None,
+        tolerance: float = 2.0,
+        backoff: float = 0.75,
+        overloaded: Optional[Callable[[], bool]] = None,
+    ):
+        """
+        Args:
+            initial: Starting limit
+            minimum: The limit never goes below this, `initial` too for a fixed limit
+            maximum: Or above this, defaults to `initial`
+            tolerance: Latency over the best recent latency that counts as overloaded
+            backoff: Factor applied to the limit when overloaded
+            overloaded: Optional check run once per window, True lowers the limit
+        """
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum if maximum is not None else initial)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.overloaded = overloaded
+        self.inflight = 0
+        self.baseline = None  # Best recent latency per unit of work
+        self.latency = None  # Median latency per unit of the last window
+        self.counters = {"completed": 0, "overloaded": 0, "increases": 0, "decreases": 0}
+        self._waiters = deque()
+        self._samples = []
+        self._dropped = False
+        self._saturated = False
+
+    @property
+    def adaptive(self) -> bool:
+        return self.maximum > self.minimum
+
+    async def _acquire(self):
+        if self.inflight >= int(self.limit) or self._waiters:
+            self._saturated = True
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self._release()  # Woken and cancelled at once, pass the slot on
+                raise
+        else:
+            self.inflight += 1
+
+    def _release(self):
+        self.inflight -= 1
+        self._wake()
+
+    def _wake(self):
+        # Slots are handed to waiters directly, so a newcomer can't jump the queue
+        while self._waiters and self.inflight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.inflight += 1
+                waiter.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, is_overload: Optional[Callable[[BaseException], bool]] = None):
+        """
+        Hold a slot for the body and report its latency when it's done.
+
+        Exceptions for which `is_overload` is True count as overload signals, other
+        failures (e.g. a corrupt scan) say nothing about the service and aren't counted.
+        """
+        await self._acquire()
+        slot = Slot()
+        start = time.monotonic()
+        try:
+            yield slot
+        except Exception as e:
+            if is_overload is not None and is_overload(e):
+                slot.overloaded = True
+            else:
+                slot.sampled = False
+            raise
+        except BaseException:
+            slot.sampled = False  # Cancelled
+            raise
+        finally:
+            self._release()
+            if slot.sampled or slot.overloaded:
+                self.record(time.monotonic() - start, slot.size, slot.overloaded)
+
+    def record(self, seconds: float, size: float = 1.0, overloaded: bool = False):
+        """Report a completed operation, adjusting the limit at the end of every window."""
+        self.counters["completed"] += 1
+        if overloaded:
+            self.counters["overloaded"] += 1
+            self._dropped = True
+        else:
+            self._samples.append(seconds / max(size, 1e-9))
+        if not self.adaptive:
+            return
+        if self._dropped or len(self._samples) >= max(2, int(self.limit)):
+            self._adjust()
+
+    def _adjust(self):
+        latency = statistics.median(self._samples) if self._samples else None
+        if latency is not None:
+            self.latency = latency
+            if self.baseline is None or latency < self.baseline:
+                self.baseline = latency
+            else:
+                # Drift up slowly, so a service that became slower for good resets the baseline
+                self.baseline += (latency - self.baseline) * 0.05
+        slow = latency is not None and latency > self.baseline * self.tolerance
+        if self._dropped or slow or (self.overloaded is not None and self.overloaded()):
+            limit = max(self.minimum, self.limit * self.backoff)
+            if int(limit) < int(self.limit):
+                self.counters["decreases"] += 1
+            self.limit = limit
+        elif self._saturated and self.limit < self.maximum:
+            self.limit = min(self.maximum, int(self.limit) + 1)
+            self.counters["increases"] += 1
+            self._wake()
+        self._samples = []
+        self._dropped = False
+        self._saturated = bool(self._waiters)
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "limit": int(self.limit),
+            "max_limit": self.maximum,
+            "inflight": self.inflight,
+            "waiting": len(self._waiters),
+            "latency": self.latency,
+            "baseline_latency": self.baseline,
+            **self.counters,
+        }
@@ -0,0 +1,204 @@
+"""
+Content-addressed cache of downloaded scans.
+
+Scans are stored under a key made from the scan ID and, when the server sends
+one, the object's ETag, so a re-run on the same scan skips the download and a
+re-scanned slide never matches a stale file. Files are downloaded to a
+`.part` file and renamed into place when complete. Least recently used scans
+are evicted once the cache is over its disk budget, skipping scans that are in
+use. Concurrent requests for the same scan share a single download.
+
+The directory may be shared by several processes, e.g. uvicorn workers. Every
+scan has a `.lock` file: a process downloading the scan holds an exclusive
+`flock` on it, and every caller using the scan a shared one, so a scan is
+downloaded by one process at a time and never evicted while another process
+reads it. An evicted scan's lock file is removed with it, while still locked,
+and a lock taken on a file removed meanwhile is taken again on the new one.
+LRU order is the files' modification times, which every access updates.
+"""
+
+import asyncio
+import fcntl
+import hashlib
+import logging
+import os
+import re
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Seconds between attempts to lock a scan another process is downloading or evicting
+LOCK_POLL_INTERVAL = 0.2
+_INCOMPLETE = (".part", ".progress", ".tmp", ".lock")
+
+
+class SlideCache:
+    def __init__(self, cache_dir: str, max_bytes: int):
+        """
+        Args:
+            cache_dir: Directory the scans are stored in
+            max_bytes: Disk budget, least recently used scans are evicted beyond it
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.inflight = {}  # key -> download task of this process
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entries(self) -> List[Tuple[str, str, int]]:
+        """(key, path, size) of every complete scan in the cache, least recently used first."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(_INCOMPLETE):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue  # Evicted by another process meanwhile
+            entries.append((stat.st_mtime, os.path.splitext(name)[0], path, stat.st_size))
+        return [(key, path, size) for _, key, path, size in sorted(entries)]
+
+    @staticmethod
+    def key(scan_id: str, etag: Optional[str] = None) -> str:
+        safe_id = re.sub(r"[^A-Za-z0-9_-]", "_", str(scan_id))
+        if not etag:
+            return safe_id
+        return f"{safe_id}-{hashlib.sha1(etag.encode()).hexdigest()[:16]}"
+
+    @property
+    def size(self) -> int:
+        return sum(size for _, _, size in self._entries())
+
+    def _lock_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.lock")
+
+    def _lock(self, key: str, operation: int) -> Optional[int]:
+        """Open and lock the scan's lock file without blocking, None if it's locked elsewhere."""
+        lock_path = self._lock_path(key)
+        while True:
+            # Each caller holds its own lock, flock treats separate opens like separate processes
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, operation | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return None
+            try:
+                if os.fstat(fd).st_ino == os.stat(lock_path).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+            os.close(fd)  # Removed by an eviction after it was opened, lock the current file
+
+    @asynccontextmanager
+    async def slide(
+        self,
+        scan_id: str,
+        extension: str,
+        fetch: Callable[[str], Awaitable[None]],
+        etag: Optional[str] = None,
+    ):
+        """
+        Yield a local path for the scan, downloading it with `await fetch(path)` on a miss.
+
+        The scan won't be evicted, by this process or another, until the block exits.
+        """
+        key = self.key(scan_id, etag)
+        path = os.path.join(self.cache_dir, f"{key}{extension}")
+        fd = None
+        try:
+            counted = False
+            while True:
+                if os.path.exists(path):
+                    fd = self._lock(key, fcntl.LOCK_SH)
+                    if fd is not None and os.path.exists(path):
+                        break
+                    if fd is not None:
+                        os.close(fd)  # Evicted just before it was locked
+                        fd = None
+                else:
+                    task = self.inflight.get(key)
+                    if task is not None:
+                        if not counted:
+                            self.counters["coalesced"] += 1
+                    else:
+                        task = self._start_fill(key, path, fetch)
+                        if task is not None:
+                            self.counters["misses"] += 1
+                    if task is not None:
+                        counted = True
+                        # Shielded, so a cancelled caller doesn't cancel the download for the others
+                        await asyncio.shield(task)
+                        continue
+                    if os.path.exists(path):
+                        continue  # Finished by another process just now
+                # Downloaded or evicted by another process
+                await asyncio.sleep(LOCK_POLL_INTERVAL)
+            if not counted:
+                self.counters["hits"] += 1
+            os.utime(path)  # Most recently used
+            yield path
+        finally:
+            if fd is not None:
+                os.close(fd)  # Releases the lock
+
+    def _start_fill(self, key: str, path: str, fetch: Callable[[str], Awaitable[None]]):
+        """Start downloading the scan, None if another process holds its lock or it's there already."""
+        fd = self._lock(key, fcntl.LOCK_EX)
+        if fd is None:
+            return None
+        if os.path.exists(path):
+            os.close(fd)
+            return None
+        self.inflight[key] = asyncio.ensure_future(self._fill(key, path, fetch, fd))
+        return self.inflight[key]
+
+    async def _fill(self, key: str, path: str, fetch: Callable[[str], Awaitable[None]], fd: int):
+        part_path = f"{path}.part"  # Same name every attempt so the downloader can resume
+        try:
+            await fetch(part_path)
+            os.replace(part_path, path)
+            os.utime(path)
+        finally:
+            # Held by the download itself, so it's never shared even if every caller is cancelled
+            os.close(fd)
+            del self.inflight[key]
+        self._evict(keep=key)
+
+    def _evict(self, keep: Optional[str] = None):
+        entries = self._entries()
+        total = sum(size for _, _, size in entries)
+        for key, path, size in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            fd = self._lock(key, fcntl.LOCK_EX)
+            if fd is None:
+                continue  # In use, here or in another process
+            try:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                # Removed while locked, whoever opened it before then locks the new file instead
+                os.remove(self._lock_path(key))
+            finally:
+                os.close(fd)
+            total -= size
+            self.counters["evictions"] += 1
+            logger.info(f"Evicted {path} from the slide cache")
+        if total > self.max_bytes:
+            logger.warning(f"Slide cache is {total} bytes, over its {self.max_bytes} byte budget")
+
+    def metrics(self):
+        entries = self._entries()
+        return {
+            **self.counters,
+            "entries": len(entries),
+            "bytes": sum(size for _, _, size in entries),
+            "max_bytes": self.max_bytes,
+            "downloading": len(self.inflight),
+        }
@@ -1,17 +1,35 @@
 import argparse
 import os
+import sys
 import json
 import aiohttp
-import aiofiles
 from fastapi import FastAPI, Request, HTTPException
-from concurrent.futures import ThreadPoolExecutor
+from fastapi.responses import PlainTextResponse
 import uvicorn
-import openslide
 import logging
 from urllib.parse import urlparse
 import asyncio
+import uuid
+from contextlib import AsyncExitStack, asynccontextmanager
+import numpy as np
 
-from techcyte_client import TechcyteClient
+# Modules shared with the model hosting service live in src/common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from async_techcyte_client import AsyncTechcyteClient  # noqa: E402
+from batching import inference_session  # noqa: E402
+from execution import create_executor, warm_up, worker_model, worker_slide  # noqa: E402
+from tiling import tile_grid, run_tiled_inference, tile_boxes_to_level0  # noqa: E402
+from tissue import filter_tissue_tiles  # noqa: E402
+from merge import nms  # noqa: E402
+from remote_slide import is_streamable  # noqa: E402
+from downloader import async_download_file, async_probe_object  # noqa: E402
+from jobs import JobScheduler, QueueFull  # noqa: E402
+from limits import AdaptiveLimit  # noqa: E402
+from slide_cache import SlideCache  # noqa: E402
+from geojson_builder import FeatureBuilder, dumps  # noqa: E402
+from tracing import StageMetrics, Tracer, gauges  # noqa: E402
+from spool import DeliveryRejected, ResultSpool, is_retryable_status  # noqa: E402
+from intake import TaskIntake, intake_key  # noqa: E402
 
 # Configure logging
 logging.basicConfig(
@@ -19,117 +37,502 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
-executor = ThreadPoolExecutor(max_workers=4)  # Adjust based on CPU cores
-
 CACHE_DIR = "cache"
 TECHCYTE_HOST = "ci.techcyte.com"  # OR 'app.techcyte.com' for production
 
+# Job scheduling: webhooks beyond MAX_QUEUED_JOBS waiting jobs are rejected with a 503
+MAX_QUEUED_JOBS = int(os.environ.get("MAX_QUEUED_JOBS", "100"))
+MAX_DOWNLOADS = int(os.environ.get("MAX_DOWNLOADS", "2"))  # Scans downloading at once
+# "threads" runs process_image in a thread pool, "processes" in a pool of worker
+# processes, which is what CPU-bound models need to use more than one core
+EXECUTION_BACKEND = os.environ.get("EXECUTION_BACKEND", "threads")
+# Uvicorn worker processes. With the process backend one is enough, its pool uses every core.
+WEB_WORKERS = int(
+    os.environ.get("WEB_WORKERS", "1" if EXECUTION_BACKEND == "processes" else "2")
+)
+# Scans processed at once per uvicorn worker, the CPU count is split between them
+MAX_PROCESSING = int(
+    os.environ.get("MAX_PROCESSING", str(max(1, (os.cpu_count() or 1) // WEB_WORKERS)))
+)
+# Adapt the download, processing and posting limits below to the latency and 429/5xx/timeout
+# rates of the scan store and the Techcyte API, and to free memory (see limits.py). Each
+# stage starts at its MAX_ value and grows up to its _LIMIT; set to 0 for fixed limits.
+ADAPTIVE_CONCURRENCY = os.environ.get("ADAPTIVE_CONCURRENCY", "1").lower() in ("1", "true", "yes")
+MAX_DOWNLOADS_LIMIT = int(os.environ.get("MAX_DOWNLOADS_LIMIT", str(max(8, MAX_DOWNLOADS))))
+MAX_POSTING = int(os.environ.get("MAX_POSTING", "2"))  # Results being posted at once
+MAX_POSTING_LIMIT = int(os.environ.get("MAX_POSTING_LIMIT", str(max(8, MAX_POSTING))))
+# Downloads and processing back off while less memory than this is available
+MIN_FREE_MEMORY_BYTES = int(float(os.environ.get("MIN_FREE_MEMORY_MB", "512")) * 1024**2)
+# Scans of one multi-scan case downloaded and processed at once, on top of the global limits
+MAX_SCANS_PER_JOB = int(os.environ.get("MAX_SCANS_PER_JOB", "4"))
+SHUTDOWN_TIMEOUT = float(os.environ.get("SHUTDOWN_TIMEOUT", "300"))
+# Disk budget for downloaded scans, least recently used scans are evicted beyond it
+SLIDE_CACHE_BYTES = int(float(os.environ.get("SLIDE_CACHE_GB", "20")) * 1024**3)
 
-async def download_image(url, save_path):
-    """Download image asynchronously from a URL to save_path."""
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            response.raise_for_status()
-            async with aiofiles.open(save_path, "wb") as f:
-                async for chunk in response.content.iter_chunked(8192):
-                    await f.write(chunk)
-    logger.info(f"Downloaded image to {save_path}")
-
-
-def process_image(image_path, data):
-    """Process image and generate results."""
-    slide = None
+# Tiling options for process_image, tune these for your model
+TILE_SIZE = int(os.environ.get("TILE_SIZE", "512"))
+TILE_OVERLAP = int(os.environ.get("TILE_OVERLAP", "0"))
+TILE_LEVEL = int(os.environ.get("TILE_LEVEL", "0"))  # Pyramid level, 0 is full resolution
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", "16"))
+# With the thread backend, the tiles of every scan being processed are gathered into shared
+# model calls of up to INFERENCE_BATCH_SIZE tiles, waiting at most INFERENCE_MAX_WAIT_MS for
+# a batch to fill (see batching.py). 0 lets each scan call the model with its own batches.
+INFERENCE_BATCH_SIZE = int(
+    os.environ.get(
+        "INFERENCE_BATCH_SIZE",
+        str(BATCH_SIZE * MAX_PROCESSING if EXECUTION_BACKEND == "threads" and MAX_PROCESSING > 1 else 0),
+    )
+)
+INFERENCE_MAX_WAIT = float(os.environ.get("INFERENCE_MAX_WAIT_MS", "10")) / 1000
+# Boxes overlapping a higher scoring box by more than this IoU are dropped as duplicates,
+# e.g. the same object found by two overlapping tiles
+MERGE_IOU = float(os.environ.get("MERGE_IOU", "0.5"))
+NUM_WORKERS = int(os.environ.get("NUM_WORKERS", "0"))  # 0 decodes tiles in the executor thread
+# Tiles with less tissue than this fraction are skipped. Set to 0 to process every tile.
+MIN_TISSUE_COVERAGE = float(os.environ.get("MIN_TISSUE_COVERAGE", "0.05"))
+# Read tiled TIFF/SVS scans straight from their URL with Range requests instead of
+# downloading them first. Falls back to the full download if a scan can't be streamed.
+STREAM_SLIDES = os.environ.get("STREAM_SLIDES", "").lower() in ("1", "true", "yes")
+# Concurrent range requests and bytes per request when downloading a scan
+DOWNLOAD_CONNECTIONS = int(os.environ.get("DOWNLOAD_CONNECTIONS", "8"))
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get("DOWNLOAD_CHUNK_MB", "16")) * 1024 * 1024
+# Optional directory to write every job's trace to, they're also served at /jobs/{task_id}/trace
+TRACE_DIR = os.environ.get("TRACE_DIR")
+# Results that still can't be posted after retries are spooled to disk and re-sent every
+# SPOOL_FLUSH_SECONDS until the API takes them (see spool.py)
+RESULTS_SPOOL_DIR = os.environ.get("RESULTS_SPOOL_DIR", os.path.join(CACHE_DIR, "results_spool"))
+SPOOL_FLUSH_SECONDS = float(os.environ.get("SPOOL_FLUSH_SECONDS", "30"))
+# Gzip result bodies, worth it for large GeoJSON payloads if your Techcyte host accepts it
+COMPRESS_RESULTS = os.environ.get("COMPRESS_RESULTS", "").lower() in ("1", "true", "yes")
+# Repeated webhooks for the same task and scans are coalesced onto the running job, or answered
+# with the cached case results for INTAKE_TTL_SECONDS after it finished (see intake.py)
+INTAKE_DB = os.environ.get("INTAKE_DB", os.path.join(CACHE_DIR, "intake.sqlite3"))
+INTAKE_TTL_SECONDS = float(os.environ.get("INTAKE_TTL_SECONDS", "86400"))
+INTAKE_LEASE_SECONDS = float(os.environ.get("INTAKE_LEASE_SECONDS", "120"))
+
+
+def available_memory():
+    """Bytes of memory left to this container (cgroup v2) or host, None if unknown."""
     try:
-        scans = data.get("scans", {})
-        if not scans:
-            raise ValueError("No scans provided in data")
-        scan_id, _ = next(iter(scans.items()))  # First scan
-        slide = openslide.OpenSlide(image_path)
-        width, height = slide.dimensions
-        geojson = generate_fake_geojson(width, height)
-        num_boxes = len(geojson["features"])
-        logger.info(f"Generated {num_boxes} fake annotations for {image_path}")
-        logger.debug(f"GeoJSON: {json.dumps(geojson, indent=2)}")
+        with open("/sys/fs/cgroup/memory.max") as f:
+            limit = f.read().strip()
+        if limit != "max":
+            with open("/sys/fs/cgroup/memory.current") as f:
+                return int(limit) - int(f.read())
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def low_memory():
+    available = available_memory()
+    return available is not None and available < MIN_FREE_MEMORY_BYTES
+
+
+def is_overload(error):
+    """Whether a stage failed because its service is overloaded or unreachable, rather than the input."""
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError, ConnectionError))
+
+
+def stage_limits():
+    """The scheduler's stage limits, adaptive between 1 and each stage's ceiling unless disabled."""
+    if not ADAPTIVE_CONCURRENCY:
         return {
-            "caseResults": {"mitosisCount": num_boxes},
-            "scanResults": [{"scanId": scan_id, "geojson": geojson}],
+            "downloading": AdaptiveLimit(MAX_DOWNLOADS, minimum=MAX_DOWNLOADS),
+            "processing": AdaptiveLimit(MAX_PROCESSING, minimum=MAX_PROCESSING),
+            "posting": AdaptiveLimit(MAX_POSTING, minimum=MAX_POSTING),
         }
-    finally:
-        if slide:
-            slide.close()  # Ensure slide is closed to free resources
+    return {
+        "downloading": AdaptiveLimit(
+            MAX_DOWNLOADS, maximum=MAX_DOWNLOADS_LIMIT, overloaded=low_memory
+        ),
+        # The executor has MAX_PROCESSING workers, so processing can only go lower
+        "processing": AdaptiveLimit(
+            MAX_PROCESSING, maximum=MAX_PROCESSING, minimum=1, overloaded=low_memory
+        ),
+        "posting": AdaptiveLimit(MAX_POSTING, maximum=MAX_POSTING_LIMIT),
+    }
+
+
+async def download_image(url, save_path):
+    """Download image asynchronously from a URL to save_path, resuming an interrupted download."""
+    stats = await async_download_file(
+        url,
+        save_path,
+        chunk_size=DOWNLOAD_CHUNK_SIZE,
+        connections=DOWNLOAD_CONNECTIONS,
+        session=app.state.http,
+    )
+    logger.info(f"Downloaded image to {save_path}: {stats}")
+    return stats
+
+
+async def scan_etag(url):
+    """ETag of the scan, so a re-scanned slide doesn't hit a stale cache entry."""
+    _, etag = await async_probe_object(url, app.state.http)
+    return etag
+
+
+def load_model():
+    """
+    Replace with loading your model, e.g. reading weights onto the GPU.
+    Called once per worker, the model stays loaded between jobs.
+    """
+    return example_model
+
+
+def example_model(tiles):
+    """
+    Replace with your model.
+    Input: (N, TILE_SIZE, TILE_SIZE, 3) uint8 RGB batch of tiles.
+    Output: One (K, 5) array of [x0, y0, x1, y1, score] boxes per tile, in tile pixels.
+    """
+    return [np.empty((0, 5), dtype=np.float32) for _ in tiles]
+
+
+def process_image(image_path, scan_id):
+    """
+    Process one scan and return its scanResults entry with the counts merge_results needs,
+    and the spans recorded along the way (wrap your own steps in tracer.span(name)).
+    """
+    tracer = Tracer()  # Runs in a worker, its spans are sent back with the output
+    with tracer.span("open_slide", scan_id=scan_id):
+        slide = worker_slide(image_path)  # Kept open by the worker for the next job, don't close it
+    width, height = slide.dimensions
+    with tracer.span("tiling", scan_id=scan_id) as span:
+        tiles = tile_grid(slide, TILE_SIZE, TILE_OVERLAP, TILE_LEVEL)
+        tile_count = len(tiles)
+        skipped_ratio = 0.0
+        if MIN_TISSUE_COVERAGE > 0:
+            tiles, skipped_ratio = filter_tissue_tiles(slide, tiles, MIN_TISSUE_COVERAGE)
+        span.items = len(tiles)
+    logger.info(
+        f"Running model over {len(tiles)} tiles of scan {scan_id}, "
+        f"skipped {skipped_ratio:.1%} as background"
+    )
+
+    geojson = generate_fake_geojson(width, height)  # A FeatureBuilder, add your results to it
+    slide_boxes = [np.empty((0, 5))]
+    # Shared with the other scans being processed when batching is on
+    with tracer.span("inference", scan_id=scan_id) as span, inference_session(worker_model()) as model:
+        for batch_tiles, outputs in run_tiled_inference(
+            image_path,
+            model,
+            tiles=tiles,
+            batch_size=BATCH_SIZE,
+            num_workers=NUM_WORKERS,
+            slide=slide,
+        ):
+            for tile, boxes in zip(batch_tiles, outputs):
+                slide_boxes.append(tile_boxes_to_level0(tile, boxes))
+            span.items += len(batch_tiles)
+    # Merge detections repeated across tile seams before adding them to the results
+    with tracer.span("merge", scan_id=scan_id) as span:
+        slide_boxes = np.concatenate(slide_boxes)
+        span.items = len(slide_boxes)
+        geojson.add_boxes(
+            slide_boxes[nms(slide_boxes, MERGE_IOU), :4], ANNOTATION_PROPERTIES, include_bbox=True
+        )
+    num_boxes = len(geojson)
+    logger.info(f"Generated {num_boxes} fake annotations for scan {scan_id}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"GeoJSON: {dumps(geojson)}")
+    return {
+        "scanResult": {"scanId": scan_id, "geojson": geojson},
+        "mitosisCount": num_boxes,
+        "tileCount": tile_count,
+        "skippedTiles": tile_count - len(tiles),
+        "spans": tracer.as_dicts(),
+    }
+
+
+def merge_results(scan_outputs):
+    """Combine process_image outputs of every scan in the case into one results document."""
+    tile_count = sum(output["tileCount"] for output in scan_outputs)
+    skipped_tiles = sum(output["skippedTiles"] for output in scan_outputs)
+    return {
+        "caseResults": {
+            "mitosisCount": sum(output["mitosisCount"] for output in scan_outputs),
+            "skippedTileRatio": round(skipped_tiles / tile_count, 4) if tile_count else 0.0,
+        },
+        "scanResults": [output["scanResult"] for output in scan_outputs],
+    }
+
+
+ANNOTATION_PROPERTIES = {"annotation_type": "tissue_tumor_positive"}
 
 
 def generate_fake_geojson(width, height, grid_size=2):
-    """Generate fake GeoJSON with boxes in a grid_size x grid_size grid."""
-    features = []
+    """Generate a fake GeoJSON FeatureBuilder with boxes in a grid_size x grid_size grid."""
     box_width = width // grid_size
     box_height = height // grid_size
-    for i in range(grid_size):
-        for j in range(grid_size):
-            x1 = i * box_width
-            y1 = j * box_height
-            x2 = x1 + box_width
-            y2 = y1 + box_height
-            bbox = [x1, y1, x2, y2]
-            coordinates = [[[x1, y1], [x1, y2], [x2, y2], [x2, y1], [x1, y1]]]
-            feature = {
-                "type": "Feature",
-                "bbox": bbox,
-                "geometry": {"type": "Polygon", "coordinates": coordinates},
-                "properties": {"annotation_type": "tissue_tumor_positive"},
-            }
-            features.append(feature)
-    return {"type": "FeatureCollection", "features": features}
+    cols, rows = np.meshgrid(np.arange(grid_size), np.arange(grid_size), indexing="ij")
+    x1 = cols.ravel() * box_width
+    y1 = rows.ravel() * box_height
+    geojson = FeatureBuilder()
+    geojson.add_boxes(
+        np.stack([x1, y1, x1 + box_width, y1 + box_height], axis=1),
+        ANNOTATION_PROPERTIES,
+        include_bbox=True,
+    )
+    return geojson
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """Start the job scheduler, and let queued and running jobs finish on shutdown."""
+    # One connection pool for downloads and Techcyte API calls, for the life of the app
+    app.state.http = aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+    )
+    app.state.executor = create_executor(
+        EXECUTION_BACKEND, MAX_PROCESSING, load_model, INFERENCE_BATCH_SIZE, INFERENCE_MAX_WAIT
+    )
+    await asyncio.get_running_loop().run_in_executor(
+        None, warm_up, app.state.executor, MAX_PROCESSING
+    )
+    app.state.stage_metrics = StageMetrics()
+    app.state.slide_cache = SlideCache(os.path.join(CACHE_DIR, "slides"), SLIDE_CACHE_BYTES)
+    app.state.scheduler = JobScheduler(
+        background_task_handler,
+        max_queued=MAX_QUEUED_JOBS,
+        limits=stage_limits(),
+        is_overload=is_overload,
+    )
+    app.state.spool = ResultSpool(RESULTS_SPOOL_DIR)
+    app.state.intake = TaskIntake(INTAKE_DB, ttl=INTAKE_TTL_SECONDS, lease=INTAKE_LEASE_SECONDS)
+    background = [
+        asyncio.create_task(flush_spool_forever()),
+        asyncio.create_task(renew_intake_leases_forever()),
+    ]
+    yield
+    logger.info("Shutting down, draining job queue")
+    await app.state.scheduler.drain(SHUTDOWN_TIMEOUT)
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+    # Jobs cut off by the drain timeout run again when the webhook is delivered again
+    await asyncio.get_running_loop().run_in_executor(None, app.state.intake.release_all)
+    app.state.executor.shutdown(wait=False, cancel_futures=True)
+    await app.state.http.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+def techcyte_client(jwt_token):
+    api_key_id = os.environ.get("API_KEY_ID")
+    api_key_secret = os.environ.get("API_KEY_SECRET")
+    if not api_key_id or not api_key_secret:
+        raise ValueError("API key ID or secret not provided")
+    # jwt is necessary for production environments, not required for local testing
+    return AsyncTechcyteClient(
+        app.state.http,
+        host=TECHCYTE_HOST,
+        jwt_token=jwt_token,
+        api_key_id=api_key_id,
+        api_key_secret=api_key_secret,
+    )
+
+
+def _failed_status(error):
+    """HTTP status of a failed post, None if there was no response."""
+    return error.status if isinstance(error, aiohttp.ClientResponseError) else None
+
+
+async def send_spooled(entry):
+    """Post spooled results again, for ResultSpool.async_flush."""
+    task = entry.task
+    try:
+        await techcyte_client(task["jwt_token"]).post_results(
+            task["task_id"],
+            entry.results(),
+            compress=COMPRESS_RESULTS,
+            idempotency_key=entry.idempotency_key,
+        )
+    except aiohttp.ClientResponseError as e:
+        if not is_retryable_status(e.status):
+            raise DeliveryRejected(str(e)) from e
+        raise
+    logger.info(f"Delivered spooled results of task {task['task_id']}")
+
+
+async def flush_spool_forever():
+    """Re-send spooled results in the background, for the life of the app."""
+    while True:
+        try:
+            await app.state.spool.async_flush(send_spooled)
+        except Exception:
+            logger.exception("Error flushing result spool")
+        await asyncio.sleep(SPOOL_FLUSH_SECONDS)
+
+
+async def renew_intake_leases_forever():
+    """Keep this worker's running tasks claimed, so duplicates don't start them again."""
+    while True:
+        await asyncio.sleep(INTAKE_LEASE_SECONDS / 3)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, app.state.intake.heartbeat)
+        except Exception:
+            logger.exception("Error renewing intake leases")
+
+
+async def process_scan(job, scan_id, scan_url, scan_limit):
+    """Download (or stream) and process one scan of the job, holding one of the job's scan slots."""
+    scheduler = app.state.scheduler
+    loop = asyncio.get_running_loop()
+    async with scan_limit:
+        # Keeps the cached scan from being evicted until processing is done
+        async with AsyncExitStack() as stack:
+            async with scheduler.stage(job, "downloading", scan_id) as slot:
+                # Only downloads count towards the download latency, not streams or cache hits
+                slot.skip()
+                if STREAM_SLIDES and await loop.run_in_executor(None, is_streamable, scan_url):
+                    logger.info(f"Streaming scan {scan_id} with range requests")
+                    image_path = scan_url
+                else:
+                    # Extract file extension from URL
+                    parsed_url = urlparse(scan_url)
+                    file_ext = os.path.splitext(parsed_url.path)[1] or ".svs"
+
+                    async def fetch(save_path):
+                        logger.info(f"Starting download for {scan_url}")
+                        with job.trace.span("download", scan_id=scan_id) as span:
+                            span.bytes = (await download_image(scan_url, save_path)).downloaded
+                        slot.size = span.bytes
+                        slot.sampled = span.bytes > 0
+
+                    image_path = await stack.enter_async_context(
+                        app.state.slide_cache.slide(
+                            scan_id, file_ext, fetch, etag=await scan_etag(scan_url)
+                        )
+                    )
 
+            async with scheduler.stage(job, "processing", scan_id) as slot:
+                logger.info(f"Processing scan {scan_id}")
+                with job.trace.span("process", scan_id=scan_id):
+                    output = await loop.run_in_executor(
+                        app.state.executor, process_image, image_path, scan_id
+                    )
+                job.trace.extend(output.pop("spans"))
+                # Compared per processed tile, scans differ a lot in size
+                slot.size = max(1, output["tileCount"] - output["skippedTiles"])
+    job.scans[scan_id] = "done"
+    return output
 
-async def background_task_handler(data):
+
+async def background_task_handler(job):
     """Handle background processing of webhook data."""
+    data = job.data
+    scheduler = app.state.scheduler
+    # Spans of every stage of the job, also added to the /metrics totals
+    job.trace = Tracer(f"task {job.task_id}", on_span=app.state.stage_metrics.record)
+    case_results = None
+    delivered = False  # Posted, or spooled for the spool to post
     try:
         scans = data.get("scans", {})
         if not scans:
             raise ValueError("No scans provided in data")
-        scan_id, scan_url = next(iter(scans.items()))
-
-        os.makedirs(CACHE_DIR, exist_ok=True)
-        # Extract file extension from URL
-        parsed_url = urlparse(scan_url)
-        file_ext = os.path.splitext(parsed_url.path)[1] or ".svs"
-        image_path = os.path.join(CACHE_DIR, f"image{file_ext}")
-
-        logger.info(f"Starting download for {scan_url}")
-        await download_image(scan_url, image_path)
-
-        logger.info(f"Processing image {image_path}")
-        loop = asyncio.get_running_loop()
-        result = await loop.run_in_executor(executor, process_image, image_path, data)
-
-        api_key_id = os.environ.get("API_KEY_ID")
-        api_key_secret = os.environ.get("API_KEY_SECRET")
-        # jwt is necessary for production environments, not required for local testing
-        jwt_token = data.get("jwt_token")
-
-        if not api_key_id or not api_key_secret:
-            raise ValueError("API key ID or secret not provided")
-
-        client = TechcyteClient(
-            host=TECHCYTE_HOST,
-            jwt_token=jwt_token,
-            api_key_id=api_key_id,
-            api_key_secret=api_key_secret,
+
+        # Every scan of the case runs concurrently, up to MAX_SCANS_PER_JOB at a time and
+        # within the scheduler's global download and processing limits
+        scan_limit = asyncio.Semaphore(MAX_SCANS_PER_JOB)
+        job.scans = {scan_id: "queued" for scan_id in scans}
+        outputs = await asyncio.gather(
+            *(process_scan(job, scan_id, url, scan_limit) for scan_id, url in scans.items()),
+            return_exceptions=True,
         )
-        logger.info(f"Posting results for task {data.get('task_id')}")
-        client.post_results(data.get("task_id"), result)
+        scan_outputs = []
+        failures = []
+        for scan_id, output in zip(scans, outputs):
+            if isinstance(output, Exception):
+                logger.error(f"Scan {scan_id} of task {job.task_id} failed: {str(output)}")
+                job.scans[scan_id] = f"failed: {output}"
+                failures.append(scan_id)
+            else:
+                scan_outputs.append(output)
+        if not scan_outputs:
+            raise RuntimeError(f"All {len(scans)} scans failed")
+        if failures:
+            # Post what succeeded rather than losing the work on the other scans
+            logger.warning(
+                f"Posting results for {len(scan_outputs)} of {len(scans)} scans, failed: {failures}"
+            )
+        result = merge_results(scan_outputs)
+        case_results = result["caseResults"]
+
+        client = techcyte_client(data.get("jwt_token"))
+        # The same key for every attempt, including re-sends from the spool
+        idempotency_key = str(uuid.uuid4())
+        async with scheduler.stage(job, "posting") as slot:
+            logger.info(f"Posting results for task {data.get('task_id')}")
+            try:
+                with job.trace.span("post"):
+                    await client.post_results(
+                        data.get("task_id"),
+                        result,
+                        compress=COMPRESS_RESULTS,
+                        tracer=job.trace,
+                        idempotency_key=idempotency_key,
+                    )
+                delivered = True
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if not is_retryable_status(_failed_status(e)):
+                    raise
+                slot.overloaded = True
+                # Don't throw away the processing, the spool flusher sends the results later
+                entry = await asyncio.get_running_loop().run_in_executor(
+                    None,
+                    app.state.spool.put,
+                    {"task_id": job.task_id, "host": TECHCYTE_HOST, "jwt_token": data.get("jwt_token")},
+                    result,
+                    idempotency_key,
+                    str(e) or type(e).__name__,
+                )
+                delivered = True
+                logger.warning(
+                    f"Posting results for task {job.task_id} failed ({str(e)}), spooled to {entry.body_path}"
+                )
+                return {"statusCode": 202, "body": json.dumps({"message": "Results spooled"})}
 
-        return {"statusCode": 200, "body": json.dumps(result)}
+        return {"statusCode": 200, "body": dumps(result)}
     except Exception as e:
         logger.error(f"Error in background processing: {str(e)}")
+        job.error = str(e)
         return {
             "statusCode": 500,
             "body": json.dumps(
                 {"message": f"Error in background processing: {str(e)}"}
             ),
         }
+    finally:
+        if job.intake_key and not delivered and job.error is None:
+            # Cancelled, e.g. by the drain timeout. Released rather than cached, so a
+            # redelivery runs the task again. Not awaited, the task is being cancelled.
+            app.state.intake.release(job.intake_key)
+        elif job.intake_key:
+            # Spooled results count as done, the spool delivers them
+            await asyncio.get_running_loop().run_in_executor(
+                None,
+                app.state.intake.finish,
+                job.intake_key,
+                "done" if delivered else "failed",
+                {"caseResults": case_results},
+            )
+        logger.info(str(job.trace))
+        if TRACE_DIR:
+            await asyncio.get_running_loop().run_in_executor(
+                None, job.trace.write, os.path.join(TRACE_DIR, f"{job.task_id}.json")
+            )
 
 
 @app.post("/webhook")
@@ -138,15 +541,95 @@ async def webhook(request: Request):
     try:
         data = await request.json()
         logger.info(f"Received webhook data: {data}")
-
-        # Start background task and return immediately
-        loop = asyncio.get_running_loop()
-        loop.create_task(background_task_handler(data))
-        return {"message": "Processing started"}
     except Exception as e:
         logger.error(f"Webhook error: {str(e)}")
         raise HTTPException(status_code=400, detail=f"Invalid request: {str(e)}")
 
+    loop = asyncio.get_running_loop()
+    key = intake_key(data)
+    if key:
+        outcome, existing = await loop.run_in_executor(
+            None, app.state.intake.claim, key, str(data["task_id"])
+        )
+        if outcome == "running":
+            logger.info(f"Task {data['task_id']} is already processing, ignoring duplicate webhook")
+            return {"message": "Already processing", "task_id": existing["task_id"], "duplicate": True}
+        if outcome == "cached":
+            logger.info(f"Task {data['task_id']} was already processed, returning cached results")
+            return {
+                "message": "Already processed",
+                "task_id": existing["task_id"],
+                "duplicate": True,
+                "finished": existing["finished"],
+                "result": existing["result"],
+            }
+
+    # Queue the job and return immediately, or ask the caller to retry later when busy
+    try:
+        job = app.state.scheduler.submit(data)
+    except QueueFull as e:
+        if key:
+            await loop.run_in_executor(None, app.state.intake.release, key)
+        logger.warning(f"Rejected webhook for task {data.get('task_id')}: {str(e)}")
+        raise HTTPException(
+            status_code=503,
+            detail=f"Too many queued jobs: {str(e)}",
+            headers={"Retry-After": "30"},
+        )
+    job.intake_key = key
+    return {"message": "Processing started", "task_id": job.task_id}
+
+
+@app.get("/jobs")
+async def jobs_metrics():
+    """Queue depth and job counters."""
+    return app.state.scheduler.metrics()
+
+
+@app.get("/cache")
+async def cache_metrics():
+    """Slide cache hits, misses and disk usage, for tuning SLIDE_CACHE_GB."""
+    return app.state.slide_cache.metrics()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """
+    Stage timings, bytes and items, peak RSS and CPU time, queue, cache and concurrency
+    limit counters in the Prometheus text format. Each uvicorn worker reports its own.
+    """
+    text = app.state.stage_metrics.prometheus()
+    text += gauges("devkit", "jobs", "Job scheduler counters", app.state.scheduler.metrics(), "name")
+    text += gauges("devkit", "slide_cache", "Slide cache counters", app.state.slide_cache.metrics(), "name")
+    spool_metrics = await asyncio.get_running_loop().run_in_executor(None, app.state.spool.metrics)
+    text += gauges("devkit", "result_spool", "Undelivered result spool", spool_metrics, "name")
+    intake_metrics = await asyncio.get_running_loop().run_in_executor(None, app.state.intake.metrics)
+    text += gauges("devkit", "intake", "Webhook intake tasks and duplicates", intake_metrics, "name")
+    # One gauge per limit statistic, e.g. devkit_concurrency_limit{stage="downloading"}
+    limits = app.state.scheduler.limit_metrics()
+    for key in next(iter(limits.values()), {}):
+        values = {stage: metrics[key] for stage, metrics in limits.items()}
+        text += gauges("devkit", f"concurrency_{key}", f"Stage concurrency limit {key}", values, "stage")
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
+
+
+@app.get("/jobs/{task_id}/trace")
+async def job_trace(task_id: str):
+    """Chrome trace of a job's stages, open it in https://ui.perfetto.dev."""
+    job = app.state.scheduler.get(task_id)
+    if job is None or job.trace is None:
+        raise HTTPException(status_code=404, detail=f"No trace for task {task_id}")
+    return job.trace.chrome_trace()
+
+
+@app.get("/jobs/{task_id}")
+async def job_status(task_id: str):
+    """Status of a queued, running or recently finished job."""
+    job = app.state.scheduler.get(task_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown task {task_id}")
+    return job.as_dict()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -169,4 +652,4 @@ if __name__ == "__main__":
     logger.info(f"Initialized API_KEY_SECRET: {args.api_key_secret}")
 
     # Run Uvicorn with correct import string (file is named webserver.py)
-    uvicorn.run("webserver:app", host="0.0.0.0", port=args.port, workers=2)
+    uvicorn.run("webserver:app", host="0.0.0.0", port=args.port, workers=WEB_WORKERS)
@@ -0,0 +1,131 @@
+"""
+Benchmark cross-slide dynamic batching of model calls in the api-bridge on CPU.
+
+Usage:
+    python bench_batching.py [--slides 8] [--workers 4] [--batch-size 16] [--inference-batch-sizes 0 64]
+
+Processes --slides synthetic slides concurrently on --workers threads, like the
+bridge's thread backend: each slide is tiled, its tiles decoded --batch-size at
+a time and run through a reference model, a small NumPy MLP over downsampled tiles
+whose cost per call, like a real network's, is dominated by reading its weights
+for small batches. With an inference batch size of 0 every slide calls the
+model itself, otherwise calls go through a batching.DynamicBatcher. Reports
+tiles/s, per-slide latency and the mean batch the model saw. Every mode's
+outputs are checked against the unbatched ones.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from fixtures import make_slide
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api-bridge"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "common"))
+from batching import DynamicBatcher, inference_session  # noqa: E402
+from remote_slide import open_slide  # noqa: E402
+from tiling import run_tiled_inference, tile_grid  # noqa: E402
+
+
+class ReferenceModel:
+    """Samples each tile at 32x32 and runs a 3072-2048-2048-5 MLP, returning one box per tile."""
+
+    def __init__(self, tile_size, hidden=2048, seed=0):
+        rng = np.random.default_rng(seed)
+        self.stride = tile_size // 32
+        self.layers = [
+            rng.standard_normal((3072, hidden), dtype=np.float32) / np.sqrt(3072),
+            rng.standard_normal((hidden, hidden), dtype=np.float32) / np.sqrt(hidden),
+            rng.standard_normal((hidden, 5), dtype=np.float32) / np.sqrt(hidden),
+        ]
+
+    def __call__(self, tiles):
+        n, size = len(tiles), tiles.shape[1]
+        x = tiles[:, :: self.stride, :: self.stride].reshape(n, -1).astype(np.float32) / 255
+        for weights in self.layers[:-1]:
+            x = np.maximum(x @ weights, 0)
+        x = 1 / (1 + np.exp(-(x @ self.layers[-1])))
+        boxes = np.hstack([x[:, :4] * size, x[:, 4:]])
+        return [box[None] for box in boxes]
+
+
+def process_slide(path, model, tile_size, batch_size):
+    """Tile and run one slide like process_image, returning its outputs in tile order and latency."""
+    start = time.perf_counter()
+    slide = open_slide(path)
+    try:
+        tiles = tile_grid(slide, tile_size)
+        outputs = {}
+        with inference_session(model) as session:
+            for batch_tiles, batch_outputs in run_tiled_inference(
+                path, session, tiles=tiles, batch_size=batch_size, num_workers=0, slide=slide
+            ):
+                for tile, boxes in zip(batch_tiles, batch_outputs):
+                    outputs[(tile.col, tile.row)] = boxes
+    finally:
+        slide.close()
+    return np.concatenate([outputs[key] for key in sorted(outputs)]), time.perf_counter() - start
+
+
+def run(paths, model, workers, tile_size, batch_size):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(lambda path: process_slide(path, model, tile_size, batch_size), paths))
+    return time.perf_counter() - start, [r[0] for r in results], [r[1] for r in results]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--slides", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=4, help="Threads, like MAX_PROCESSING")
+    parser.add_argument("--width", type=int, default=4096)
+    parser.add_argument("--height", type=int, default=4096)
+    parser.add_argument("--tile-size", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=16, help="Tiles decoded per call, like BATCH_SIZE")
+    parser.add_argument("--inference-batch-sizes", type=int, nargs="+", default=[0, 64])
+    parser.add_argument("--max-wait-ms", type=float, default=10)
+    parser.add_argument("--repeat", type=int, default=2, help="Runs per mode, the fastest is reported")
+    parser.add_argument("--work-dir", default=os.path.join(tempfile.gettempdir(), "devkit-bench"))
+    args = parser.parse_args()
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    paths = []
+    for i in range(args.slides):
+        path = os.path.join(args.work_dir, f"batching-{args.width}x{args.height}-{i}.tiff")
+        if not os.path.exists(path):
+            make_slide(path, args.width, args.height)
+        paths.append(path)
+    model = ReferenceModel(args.tile_size)
+
+    expected = None
+    print(f"{'inference batch':>15} {'seconds':>8} {'tiles/s':>8} {'p50 s':>7} {'max s':>7} {'mean batch':>11}")
+    for inference_batch_size in args.inference_batch_sizes:
+        best = None
+        for _ in range(args.repeat):
+            if inference_batch_size:
+                mode_model = DynamicBatcher(model, inference_batch_size, args.max_wait_ms / 1000)
+            else:
+                mode_model = model
+            seconds, outputs, latencies = run(paths, mode_model, args.workers, args.tile_size, args.batch_size)
+            if best is None or seconds < best[0]:
+                mean_batch = mode_model.metrics()["mean_batch_size"] if inference_batch_size else args.batch_size
+                best = seconds, latencies, mean_batch
+            if expected is None:
+                expected = outputs
+            for got, want in zip(outputs, expected):
+                np.testing.assert_allclose(got, want, rtol=1e-3, atol=1e-3)
+        seconds, latencies, mean_batch = best
+        tiles = sum(len(o) for o in expected)
+        print(
+            f"{inference_batch_size or 'per slide':>15} {seconds:>8.2f} {tiles / seconds:>8.0f} "
+            f"{np.median(latencies):>7.2f} {max(latencies):>7.2f} {mean_batch:>11.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
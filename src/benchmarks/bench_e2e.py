@@ -0,0 +1,389 @@
+"""
+End-to-end benchmark of the hosting service, the api-bridge and get_objects, fully offline.
+
+Usage:
+    python bench_e2e.py main [--slides 4] [--width 20000] [--height 15000] [--batch] [--stream]
+    python bench_e2e.py webhook [--jobs 8] [--scans-per-job 2] [--stream]
+    python bench_e2e.py objects [--objects 200000] [--page-size 10000] [--concurrency 4] [--pairs 0]
+    python bench_e2e.py all [--json results.json]
+
+Generates synthetic pyramidal TIFFs (fixtures.make_slide), serves them from a
+local Range-capable server and points the code at a mock Techcyte API
+(TECHCYTE_API_URL), then runs it as it runs in production:
+
+- main: main.py as a one-shot container per slide, or all slides at once as a
+  BATCH_FILE pipeline with --batch. Latency is per task, from start to results
+  received.
+- webhook: webserver.py under uvicorn, fed every job at once through /webhook.
+  Latency is from webhook to results received. The event loop's responsiveness
+  under that load is probed with GET /jobs every 20ms.
+- objects: get_objects.py paging through the mock's GraphQL objects, or
+  exporting a --manifest of --pairs scan/evaluation pairs with that many
+  objects each.
+
+Reports throughput, latency percentiles and peak RSS (of the whole process tree,
+tile and execution pool workers included). --latency and --fail-rate add
+per-request latency and 503s to the mock API. Slides and scratch files are kept
+in --work-dir.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from fixtures import MockTechcyte, RangeServer, make_slide
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+HOSTING_SERVICE = os.path.join(SRC, "model-hosting-service")
+API_BRIDGE = os.path.join(SRC, "api-bridge")
+DOWNLOAD_OBJECTS = os.path.join(SRC, "download-objects")
+
+
+class PeakRss:
+    """Samples the summed peak RSS (VmHWM) of a process and its descendants, Linux only."""
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peaks = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _tree(self, pid):
+        pids = [pid]
+        try:
+            for tid in os.listdir(f"/proc/{pid}/task"):
+                with open(f"/proc/{pid}/task/{tid}/children") as f:
+                    for child in f.read().split():
+                        pids += self._tree(int(child))
+        except OSError:
+            pass
+        return pids
+
+    def _run(self):
+        while not self.stopped.is_set():
+            for pid in self._tree(self.pid):
+                try:
+                    with open(f"/proc/{pid}/status") as f:
+                        for line in f:
+                            if line.startswith("VmHWM:"):
+                                peak = int(line.split()[1]) * 1024
+                                self.peaks[pid] = max(self.peaks.get(pid, 0), peak)
+                except OSError:
+                    pass
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return sum(self.peaks.values())
+
+
+def run_process(command, env, cwd, log_path):
+    """Run `command` to completion. Returns (seconds, peak RSS of its process tree in bytes)."""
+    start = time.perf_counter()
+    with open(log_path, "ab") as log:
+        process = subprocess.Popen(command, env=env, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+        sampler = PeakRss(process.pid)
+        returncode = process.wait()
+    seconds = time.perf_counter() - start
+    peak = sampler.stop()
+    if returncode:
+        raise RuntimeError(f"{os.path.basename(command[1])} exited with {returncode}, see {log_path}")
+    return seconds, peak
+
+
+def percentiles(values):
+    values = np.asarray(values, dtype=np.float64)
+    if not len(values):
+        return {"p50": 0.0, "p90": 0.0, "p99": 0.0, "max": 0.0}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {"p50": p50, "p90": p90, "p99": p99, "max": values.max()}
+
+
+def report(name, count, unit, seconds, latencies, peak_rss):
+    """Print one result row and return it as a dict."""
+    result = {
+        "target": name,
+        "count": count,
+        "unit": unit,
+        "seconds": seconds,
+        "per_second": count / seconds if seconds else 0.0,
+        "latency": percentiles(latencies),
+        "peak_rss_mb": peak_rss / 1024**2,
+    }
+    latency = result["latency"]
+    rate = result["per_second"] * 60 if unit in ("slides", "jobs") else result["per_second"]
+    rate_unit = f"{unit}/{'min' if unit in ('slides', 'jobs') else 's'}"
+    print(
+        f"{name:<8} {count:>8} {unit:<8} {seconds:>8.1f}s {rate:>10.1f} {rate_unit:<12}"
+        f" {latency['p50']:>7.2f} {latency['p90']:>7.2f} {latency['p99']:>7.2f} {latency['max']:>7.2f}"
+        f" {result['peak_rss_mb']:>8.0f}"
+    )
+    return result
+
+
+def print_header():
+    print(
+        f"{'target':<8} {'count':>8} {'':<8} {'total':>9} {'throughput':>23}"
+        f" {'p50 s':>7} {'p90 s':>7} {'p99 s':>7} {'max s':>7} {'peak MB':>8}"
+    )
+
+
+def base_env(args, mock):
+    env = dict(os.environ)
+    env.update(
+        TECHCYTE_API_URL=mock.url,
+        HOST="bench.local",
+        API_KEY_ID="bench",
+        API_KEY_SECRET="bench",
+        PYTHONUNBUFFERED="1",
+        RESULTS_SPOOL_DIR=os.path.join(args.work_dir, "spool"),
+        LEVEL_CACHE_DIR=os.path.join(args.work_dir, "levels"),
+        BLOCK_CACHE_DIR=os.path.join(args.work_dir, "blocks"),
+    )
+    return env
+
+
+def scan_urls(args, server, count):
+    """`count` distinct names for the synthetic slide, so no cache is shared between scans."""
+    slide = make_slide(
+        os.path.join(args.work_dir, f"slide-{args.width}x{args.height}.tiff"), args.width, args.height
+    )
+    urls = []
+    for i in range(count):
+        name = f"scan-{args.width}x{args.height}-{i}.tiff"
+        path = os.path.join(args.work_dir, name)
+        if not os.path.exists(path):
+            os.symlink(os.path.basename(slide), path)
+        urls.append(server.file_url(name) + "?X-Amz-Signature=bench")
+    return urls
+
+
+def bench_main(args, server, mock):
+    env = base_env(args, mock)
+    if args.stream:
+        env["STREAM_SLIDE"] = "1"
+    urls = scan_urls(args, server, args.slides)
+    tasks = [
+        {"scan_url": url, "task_id": f"main-{time.time_ns()}-{i}", "scan_id": f"scan-{i}"}
+        for i, url in enumerate(urls)
+    ]
+    command = [sys.executable, os.path.join(HOSTING_SERVICE, "main.py")]
+    log_path = os.path.join(args.work_dir, "main.log")
+
+    if args.batch:
+        batch_path = os.path.join(args.work_dir, "batch.json")
+        with open(batch_path, "w") as f:
+            json.dump(tasks, f)
+        start = time.time()
+        seconds, peak = run_process(command, {**env, "BATCH_FILE": batch_path}, HOSTING_SERVICE, log_path)
+        latencies = [mock.received(task["task_id"]) - start for task in tasks]
+        return report("main", len(tasks), "slides", seconds, latencies, peak)
+
+    latencies, peak = [], 0
+    for task in tasks:
+        task_env = {**env, "SCAN_URL": task["scan_url"], "TASK_ID": task["task_id"], "SCAN_ID": task["scan_id"]}
+        seconds, task_peak = run_process(command, task_env, HOSTING_SERVICE, log_path)
+        latencies.append(seconds)
+        peak = max(peak, task_peak)
+    return report("main", len(tasks), "slides", sum(latencies), latencies, peak)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _request(url, data=None, timeout=10):
+    body = json.dumps(data).encode() if data is not None else None
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.status, response.read()
+
+
+def bench_webhook(args, server, mock):
+    env = base_env(args, mock)
+    if args.stream:
+        env["STREAM_SLIDES"] = "1"
+    port = _free_port()
+    bridge_dir = os.path.join(args.work_dir, "bridge")  # Its cache/ ends up here
+    os.makedirs(bridge_dir, exist_ok=True)
+    log_path = os.path.join(args.work_dir, "webserver.log")
+    command = [
+        sys.executable,
+        os.path.join(API_BRIDGE, "webserver.py"),
+        "--port",
+        str(port),
+        "--api-key-id",
+        "bench",
+        "--api-key-secret",
+        "bench",
+    ]
+    base_url = f"http://127.0.0.1:{port}"
+    with open(log_path, "ab") as log:
+        process = subprocess.Popen(command, env=env, cwd=bridge_dir, stdout=log, stderr=subprocess.STDOUT)
+    sampler = PeakRss(process.pid)
+    try:
+        deadline = time.time() + 120
+        while True:
+            try:
+                _request(f"{base_url}/jobs")
+                break
+            except OSError:
+                if process.poll() is not None or time.time() > deadline:
+                    raise RuntimeError(f"webserver.py didn't start, see {log_path}")
+                time.sleep(0.2)
+
+        urls = scan_urls(args, server, args.jobs * args.scans_per_job)
+        jobs = [
+            {
+                "task_id": f"webhook-{time.time_ns()}-{i}",
+                "scans": {
+                    f"job{i}-scan{j}": urls[i * args.scans_per_job + j] for j in range(args.scans_per_job)
+                },
+            }
+            for i in range(args.jobs)
+        ]
+
+        # Responsiveness of the event loop while it downloads, processes and posts
+        probes = []
+        done = threading.Event()
+
+        def probe():
+            while not done.is_set():
+                start = time.perf_counter()
+                _request(f"{base_url}/jobs")
+                probes.append(time.perf_counter() - start)
+                done.wait(0.02)
+
+        prober = threading.Thread(target=probe, daemon=True)
+        prober.start()
+
+        sent = {}
+        start = time.time()
+
+        def submit(job):
+            sent[job["task_id"]] = time.time()
+            _request(f"{base_url}/webhook", job)
+
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            list(pool.map(submit, jobs))
+        finished = mock.wait_for(sent, args.timeout)
+        seconds = time.time() - start
+        done.set()
+        prober.join()
+        if not finished:
+            raise RuntimeError(f"Not every job posted results within {args.timeout}s, see {log_path}")
+        latencies = [mock.received(task_id) - sent[task_id] for task_id in sent]
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        peak = sampler.stop()
+
+    result = report("webhook", len(jobs), "jobs", seconds, latencies, peak)
+    loop = percentiles(np.array(probes) * 1000)
+    print(
+        f"  event loop: GET /jobs p50 {loop['p50']:.1f}ms, p90 {loop['p90']:.1f}ms, "
+        f"p99 {loop['p99']:.1f}ms, max {loop['max']:.1f}ms over {len(probes)} probes"
+    )
+    result["event_loop_ms"] = loop
+    return result
+
+
+def bench_objects(args, server, mock):
+    env = {**base_env(args, mock), "CLIENT_ID": "bench", "CLIENT_SECRET": "bench"}
+    save_location = os.path.join(args.work_dir, "objects.ndjson")
+    if args.pairs:
+        manifest = os.path.join(args.work_dir, "manifest.csv")
+        with open(manifest, "w") as f:
+            f.write("scan_id,evaluation_id\n")
+            f.writelines(f"scan-{i},evaluation\n" for i in range(args.pairs))
+        save_location = os.path.join(args.work_dir, "objects")
+        target = ["--manifest", manifest, "--output-dir", save_location]
+    else:
+        target = ["scan", "evaluation", save_location]
+    command = [
+        sys.executable,
+        os.path.join(DOWNLOAD_OBJECTS, "get_objects.py"),
+        *target,
+        "--host",
+        mock.url,
+        "--page-size",
+        str(args.page_size),
+        "--concurrency",
+        str(args.concurrency),
+    ]
+    latencies, peak = [], 0
+    for _ in range(args.repeat):
+        if os.path.isdir(save_location):
+            shutil.rmtree(save_location)
+        elif os.path.exists(save_location):
+            os.remove(save_location)
+        seconds, run_peak = run_process(command, env, args.work_dir, os.path.join(args.work_dir, "objects.log"))
+        latencies.append(seconds)
+        peak = max(peak, run_peak)
+    total = args.objects * max(1, args.pairs) * args.repeat
+    return report("objects", total, "objects", sum(latencies), latencies, peak)
+
+
+TARGETS = {"main": bench_main, "webhook": bench_webhook, "objects": bench_objects}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("target", choices=[*TARGETS, "all"])
+    parser.add_argument("--width", type=int, default=20000, help="Synthetic slide width")
+    parser.add_argument("--height", type=int, default=15000, help="Synthetic slide height")
+    parser.add_argument("--slides", type=int, default=4, help="Slides processed by main.py")
+    parser.add_argument("--batch", action="store_true", help="Run main.py once with a BATCH_FILE")
+    parser.add_argument("--stream", action="store_true", help="Stream slides with Range requests")
+    parser.add_argument("--jobs", type=int, default=8, help="Webhooks sent to the api-bridge")
+    parser.add_argument("--scans-per-job", type=int, default=2)
+    parser.add_argument("--objects", type=int, default=200000, help="Objects served to get_objects.py")
+    parser.add_argument("--page-size", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3, help="get_objects.py runs")
+    parser.add_argument("--pairs", type=int, default=0, help="Export this many pairs with --manifest")
+    parser.add_argument("--latency", type=float, default=0, help="Milliseconds added to every mock API response")
+    parser.add_argument("--slide-latency", type=float, default=0, help="Milliseconds added to every slide request")
+    parser.add_argument("--fail-rate", type=float, default=0, help="Fraction of result posts failing with 503")
+    parser.add_argument("--timeout", type=float, default=900, help="Seconds to wait for webhook results")
+    parser.add_argument("--work-dir", default=os.path.join(tempfile.gettempdir(), "devkit-bench"))
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    shutil.rmtree(os.path.join(args.work_dir, "spool"), ignore_errors=True)
+    targets = list(TARGETS) if args.target == "all" else [args.target]
+    results = []
+    with RangeServer(args.work_dir, args.slide_latency / 1000) as server, MockTechcyte(
+        args.latency / 1000, args.fail_rate, args.objects
+    ) as mock:
+        print_header()
+        for target in targets:
+            results.append(TARGETS[target](args, server, mock))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Benchmark result serialization: nested dicts + json.dumps vs geojson_builder.
+
+Usage:
+    python bench_geojson.py [--sizes 10000 100000 1000000]
+
+Reports wall time, peak Python memory (tracemalloc) and payload size for each
+number of box features.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "common"))
+from geojson_builder import FeatureBuilder, iter_json, gzip_chunks  # noqa: E402
+
+PROPERTIES = {"name": "Mitosis", "color": "#ff0000"}
+
+
+def random_boxes(count, seed=0):
+    rng = np.random.default_rng(seed)
+    xy = rng.uniform(0, 100000, size=(count, 2))
+    return np.hstack([xy, xy + rng.uniform(10, 60, size=(count, 2))])
+
+
+def dict_path(boxes):
+    """How process_image built and posted results before geojson_builder."""
+    features = []
+    for x0, y0, x1, y1 in boxes.astype(int).tolist():
+        features.append(
+            {
+                "type": "Feature",
+                "geometry": {
+                    "type": "Polygon",
+                    "coordinates": [[[x0, y0], [x0, y1], [x1, y1], [x1, y0], [x0, y0]]],
+                },
+                "properties": dict(PROPERTIES),
+            }
+        )
+    document = {"scanResults": [{"geojson": {"type": "FeatureCollection", "features": features}}]}
+    return len(json.dumps(document).encode())  # What requests does for json=...
+
+
+def builder_path(boxes, compress=False):
+    builder = FeatureBuilder()
+    builder.add_boxes(boxes, PROPERTIES)
+    chunks = iter_json({"scanResults": [{"geojson": builder}]})
+    if compress:
+        chunks = gzip_chunks(chunks)
+    return sum(len(chunk) for chunk in chunks)  # Streamed, never joined
+
+
+def measure(function, *args):
+    start = time.perf_counter()
+    size = function(*args)
+    seconds = time.perf_counter() - start
+    # Separate run, tracemalloc slows allocation heavy code down a lot
+    tracemalloc.start()
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    args = parser.parse_args()
+
+    print(f"{'features':>10} {'path':>14} {'seconds':>9} {'peak MB':>9} {'payload MB':>11}")
+    for count in args.sizes:
+        boxes = random_boxes(count)
+        for name, function, extra in [
+            ("dict+json", dict_path, ()),
+            ("builder", builder_path, ()),
+            ("builder+gzip", builder_path, (True,)),
+        ]:
+            seconds, peak, size = measure(function, boxes, *extra)
+            print(f"{count:>10} {name:>14} {seconds:>9.3f} {peak / 1e6:>9.1f} {size / 1e6:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
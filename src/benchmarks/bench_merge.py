@@ -0,0 +1,74 @@
+"""
+Benchmark merging duplicate detections across tile seams with merge.nms.
+
+Usage:
+    python bench_merge.py [--sizes 10000 100000 1000000] [--tile-size 512] [--overlap 64]
+
+Scatters objects over a slide tiled with overlap and reports every object once
+for each tile that fully contains it, with a little jitter in position and
+score, as a tiled detector would. Reports wall time, peak memory
+(tracemalloc) and how many boxes are left compared to the true object count.
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "common"))
+from merge import nms  # noqa: E402
+
+
+def tiled_detections(count, tile_size, overlap, seed=0):
+    """Boxes of `count` objects as seen by every overlapping tile that contains them."""
+    rng = np.random.default_rng(seed)
+    stride = tile_size - overlap
+    side = np.sqrt(count) * 200  # Roughly one object per 200x200 pixels
+    x0y0 = rng.uniform(0, side, size=(count, 2))
+    objects = np.hstack([x0y0, x0y0 + rng.uniform(10, 40, size=(count, 2))])
+
+    detections = []
+    for dx in (0, -1):
+        for dy in (0, -1):
+            # Tile (col + dx, row + dy), where col/row is the last tile starting before the object
+            col = np.floor(objects[:, 0] / stride) + dx
+            row = np.floor(objects[:, 1] / stride) + dy
+            inside = (
+                (col >= 0)
+                & (row >= 0)
+                & (objects[:, 2] <= col * stride + tile_size)
+                & (objects[:, 3] <= row * stride + tile_size)
+            )
+            seen = objects[inside] + rng.normal(0, 1, size=(int(inside.sum()), 4))
+            scores = rng.uniform(0.5, 1.0, size=(len(seen), 1))
+            detections.append(np.hstack([seen, scores]))
+    return np.concatenate(detections)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--tile-size", type=int, default=512)
+    parser.add_argument("--overlap", type=int, default=64)
+    parser.add_argument("--iou", type=float, default=0.5)
+    args = parser.parse_args()
+
+    print(f"{'objects':>10} {'detections':>11} {'kept':>10} {'seconds':>9} {'peak MB':>9}")
+    for count in args.sizes:
+        boxes = tiled_detections(count, args.tile_size, args.overlap)
+        start = time.perf_counter()
+        kept = nms(boxes, args.iou)
+        seconds = time.perf_counter() - start
+        # Measured in a second run, tracing slows down allocation heavy code
+        tracemalloc.start()
+        nms(boxes, args.iou)
+        peak = tracemalloc.get_traced_memory()[1] / 1024**2
+        tracemalloc.stop()
+        print(f"{count:>10} {len(boxes):>11} {len(kept):>10} {seconds:>9.3f} {peak:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Benchmark region and confidence queries on an object_store against scanning a JSON export.
+
+Usage:
+    python bench_object_store.py [--sizes 100000 1000000] [--window 2000] [--queries 100]
+
+Writes `count` objects scattered over a slide both as newline delimited JSON
+(what QA scripts load today) and as an object store, then times answering
+random --window sized regions with a confidence threshold: loading and
+filtering the JSON once, against opening the store and querying it. Every
+store answer is checked against the scan. Files are kept in --work-dir.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "download-objects"))
+from object_store import COLUMNS, ObjectStore, ObjectStoreWriter  # noqa: E402
+
+PAGE_SIZE = 10000
+
+
+def make_objects(count, seed=0):
+    """Objects of 10-60 pixels spread over a slide with one object per 200x200 pixels, as dicts."""
+    rng = np.random.default_rng(seed)
+    side = np.sqrt(count) * 200
+    columns = {
+        "x": rng.uniform(0, side, count).round(),
+        "y": rng.uniform(0, side, count).round(),
+        "width": rng.uniform(10, 60, count).round(),
+        "height": rng.uniform(10, 60, count).round(),
+        "confidence": rng.uniform(0, 1, count).astype(np.float32).round(4),
+    }
+    return [dict(zip(COLUMNS, values)) for values in zip(*(columns[c].tolist() for c in COLUMNS))], side
+
+
+def scan(objects, bbox, min_confidence):
+    x0, y0, x1, y1 = bbox
+    return sum(
+        1
+        for obj in objects
+        if obj["x"] <= x1
+        and obj["y"] <= y1
+        and obj["x"] + obj["width"] >= x0
+        and obj["y"] + obj["height"] >= y0
+        and obj["confidence"] >= min_confidence
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("--window", type=float, default=2000, help="Query window side in pixels")
+    parser.add_argument("--min-confidence", type=float, default=0.5)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--work-dir", default=os.path.join(tempfile.gettempdir(), "devkit-bench"))
+    args = parser.parse_args()
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    print(
+        f"{'objects':>10} {'write s':>8} {'json load s':>12} {'json MB':>8} "
+        f"{'scan ms/q':>10} {'open ms':>8} {'store ms/q':>11} {'store MB':>9} {'matches/q':>10}"
+    )
+    for count in args.sizes:
+        objects, side = make_objects(count)
+        json_path = os.path.join(args.work_dir, f"objects-{count}.ndjson")
+        store_path = os.path.join(args.work_dir, f"objects-{count}.objects")
+        with open(json_path, "w") as f:
+            f.writelines(json.dumps(obj) + "\n" for obj in objects)
+        start = time.perf_counter()
+        writer = ObjectStoreWriter(store_path)
+        for page in range(0, count, PAGE_SIZE):
+            writer.write(objects[page : page + PAGE_SIZE])
+        writer.close()
+        write_seconds = time.perf_counter() - start
+        del objects
+
+        rng = np.random.default_rng(1)
+        corners = rng.uniform(0, side - args.window, size=(args.queries, 2))
+        windows = [(x, y, x + args.window, y + args.window) for x, y in corners.tolist()]
+
+        # What a QA script does today: load the whole export, then filter it
+        tracemalloc.start()
+        start = time.perf_counter()
+        with open(json_path) as f:
+            loaded = [json.loads(line) for line in f]
+        load_seconds = time.perf_counter() - start
+        json_peak = tracemalloc.get_traced_memory()[1] / 1024**2
+        tracemalloc.stop()
+        start = time.perf_counter()
+        expected = [scan(loaded, window, args.min_confidence) for window in windows]
+        scan_ms = (time.perf_counter() - start) / len(windows) * 1000
+        del loaded
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        store = ObjectStore(store_path)
+        open_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        found = [len(store.query(window, args.min_confidence)["x"]) for window in windows]
+        store_ms = (time.perf_counter() - start) / len(windows) * 1000
+        store_peak = tracemalloc.get_traced_memory()[1] / 1024**2
+        tracemalloc.stop()
+        assert found == expected, "Store and scan disagree"
+
+        print(
+            f"{count:>10} {write_seconds:>8.2f} {load_seconds:>12.2f} {json_peak:>8.0f} "
+            f"{scan_ms:>10.1f} {open_ms:>8.2f} {store_ms:>11.3f} {store_peak:>9.1f} {np.mean(found):>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+"""
+Offline fixtures for the end-to-end benchmarks.
+
+- `make_slide` writes a synthetic pyramidal, JPEG tiled TIFF of any size,
+  tile by tile, so slides larger than memory can be generated.
+- `RangeServer` serves a directory over HTTP with Range, HEAD and ETag support,
+  like S3 presigned URLs, with optional added latency, or ignoring Range like
+  some plain web servers.
+- `MockTechcyte` answers `/api/v3/token`, `/api/v3/external/results/{task_id}`
+  and `/api/graphql` (objects, with limit/offset paging), with optional latency
+  and injected 503s, and records when every result arrived.
+
+Servers bind to an ephemeral port on 127.0.0.1 and run on daemon threads; use
+them as context managers.
+"""
+
+import gzip
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+import numpy as np
+
+# Tissue blobs as (center x, center y, radius) in fractions of the slide width/height
+BLOBS = [(0.3, 0.35, 0.22), (0.72, 0.6, 0.18), (0.5, 0.85, 0.08)]
+BACKGROUND = 240
+
+
+def _tile(x0: int, y0: int, size: int, scale: float, width: int, height: int, seed: int) -> np.ndarray:
+    """One RGB tile at level 0 pixel (x0, y0) * scale: background glass with textured tissue blobs."""
+    ys, xs = np.mgrid[y0 : y0 + size, x0 : x0 + size].astype(np.float32)
+    xs *= scale / width
+    ys *= scale / height
+    tile = np.full((size, size, 3), BACKGROUND, dtype=np.uint8)
+    tissue = np.zeros((size, size), dtype=bool)
+    for cx, cy, r in BLOBS:
+        tissue |= (xs - cx) ** 2 + ((ys - cy) * height / width) ** 2 < r**2
+    if tissue.any():
+        rng = np.random.default_rng(seed)
+        texture = rng.integers(-25, 25, size=(int(tissue.sum()), 1), dtype=np.int16)
+        tile[tissue] = np.clip(np.array([175, 80, 160], dtype=np.int16) + texture, 0, 255)
+    return tile
+
+
+def make_slide(path: str, width: int, height: int, tile_size: int = 256, levels: int = 4) -> str:
+    """
+    Write a `width` x `height` pyramidal TIFF to `path`, each level 4x smaller than the last.
+    Skipped if `path` already exists. Readable by OpenSlide and tifffile.
+    """
+    if os.path.exists(path):
+        return path
+    import tifffile  # Only needed to generate slides
+
+    tmp_path = f"{path}.tmp"
+    with tifffile.TiffWriter(tmp_path, bigtiff=width * height * 3 > 2**31) as tiff:
+        for level in range(levels):
+            scale = 4**level
+            level_width = max(1, width // scale)
+            level_height = max(1, height // scale)
+            rows = math.ceil(level_height / tile_size)
+            cols = math.ceil(level_width / tile_size)
+            tiles = (
+                _tile(col * tile_size, row * tile_size, tile_size, scale, width, height, row * cols + col)
+                for row in range(rows)
+                for col in range(cols)
+            )
+            tiff.write(
+                tiles,
+                shape=(level_height, level_width, 3),
+                dtype=np.uint8,
+                tile=(tile_size, tile_size),
+                photometric="rgb",
+                compression="jpeg",
+                subfiletype=1 if level else 0,
+            )
+            if level_width <= tile_size and level_height <= tile_size:
+                break
+    os.replace(tmp_path, path)
+    return path
+
+
+class _Server:
+    handler = BaseHTTPRequestHandler
+
+    def __init__(self):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self.handler)
+        self.httpd.daemon_threads = True
+        self.httpd.fixture = self
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _open(self):
+        fixture = self.server.fixture
+        name = self.path.split("?")[0].lstrip("/")
+        path = os.path.join(fixture.directory, name)
+        if fixture.latency:
+            time.sleep(fixture.latency)
+        if "/" in name or not os.path.isfile(path):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None, 0, ""
+        stat = os.stat(path)
+        return path, stat.st_size, f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+    def do_HEAD(self):
+        path, size, etag = self._open()
+        if path:
+            self.send_response(200)
+            self.send_header("Content-Length", str(size))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.end_headers()
+
+    def do_GET(self):
+        path, size, etag = self._open()
+        if not path:
+            return
+        start, end = 0, size - 1
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match and not self.server.fixture.ignore_range:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.end_headers()
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = f.read(min(remaining, 1024 * 1024))
+                if not data:
+                    break
+                try:
+                    self.wfile.write(data)
+                except ConnectionError:
+                    self.close_connection = True
+                    return  # The client stopped reading
+                remaining -= len(data)
+                self.server.fixture.bytes_sent += len(data)
+
+
+class RangeServer(_Server):
+    handler = _RangeHandler
+
+    def __init__(self, directory: str, latency: float = 0.0, ignore_range: bool = False):
+        """
+        Serve the files in `directory`, waiting `latency` seconds before every response.
+        With `ignore_range`, every GET is answered 200 with the whole file.
+        """
+        super().__init__()
+        self.directory = directory
+        self.latency = latency
+        self.ignore_range = ignore_range
+        self.bytes_sent = 0
+
+    def file_url(self, name: str) -> str:
+        return f"{self.url}/{name}"
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status: int, body: bytes = b"{}"):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                if not size:
+                    self.rfile.readline()
+                    return b"".join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        mock = self.server.fixture
+        body = self._body()
+        if mock.latency:
+            time.sleep(mock.latency)
+        if self.path == "/api/v3/token":
+            return self._reply(200, json.dumps({"access_token": "mock-token", "expires_in": 3600}).encode())
+        if self.path == "/api/graphql":
+            return self._reply(200, mock.objects_page(json.loads(body)))
+        match = re.fullmatch(r"/api/v3/external/results/([^/?]+)", self.path)
+        if not match:
+            return self._reply(404)
+        if mock.fail_rate and random.random() < mock.fail_rate:
+            return self._reply(503)
+        if self.headers.get("Content-Encoding") == "gzip":
+            size = len(gzip.decompress(body))
+        else:
+            size = len(body)
+        with mock.lock:
+            mock.results.setdefault(match.group(1), []).append(
+                {"received": time.time(), "bytes": size, "idempotency_key": self.headers.get("Idempotency-Key")}
+            )
+        self._reply(200)
+
+
+class MockTechcyte(_Server):
+    handler = _MockHandler
+
+    def __init__(self, latency: float = 0.0, fail_rate: float = 0.0, objects: int = 0):
+        """
+        Args:
+            latency: Seconds added to every response
+            fail_rate: Fraction of result posts answered with a 503
+            objects: Number of objects the GraphQL `objects` query pages through
+        """
+        super().__init__()
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.objects = objects
+        self.results: Dict[str, List[Dict]] = {}
+        self.lock = threading.Lock()
+
+    def objects_page(self, request: Dict) -> bytes:
+        variables = request.get("variables", {})
+        offset = variables.get("offset", 0)
+        limit = variables.get("limit", self.objects)
+        index = np.arange(offset, min(offset + limit, self.objects))
+        page = [
+            {"x": x, "y": y, "width": w, "height": w, "confidence": c}
+            for x, y, w, c in zip(
+                (index * 7919 % 100000).tolist(),
+                (index * 104729 % 80000).tolist(),
+                (20 + index % 40).tolist(),
+                ((index % 1000) / 1000).tolist(),
+            )
+        ]
+        return json.dumps({"data": {"objects": page}}).encode()
+
+    def wait_for(self, task_ids, timeout: float) -> bool:
+        """Wait until results for every task in `task_ids` arrived, False on timeout."""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self.lock:
+                if all(task_id in self.results for task_id in task_ids):
+                    return True
+            time.sleep(0.05)
+        return False
+
+    def received(self, task_id: str) -> float:
+        """When the first results for `task_id` arrived."""
+        with self.lock:
+            return self.results[task_id][0]["received"]
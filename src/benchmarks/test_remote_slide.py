@@ -0,0 +1,51 @@
+"""
+Range reads of remote_slide against a local server that ignores Range.
+
+Usage:
+    python -m pytest test_remote_slide.py
+"""
+
+import os
+import sys
+import time
+
+import pytest
+
+from fixtures import RangeServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "common"))
+from remote_slide import RangeFile, RangeNotSupported, is_streamable  # noqa: E402
+
+SIZE = 256 * 1024 * 1024
+
+
+@pytest.fixture
+def large_file(tmp_path):
+    with open(tmp_path / "scan.tiff", "wb") as f:
+        f.truncate(SIZE)  # Sparse, so it costs no disk
+    return tmp_path
+
+
+def test_range_file_rejects_200_without_reading_body(large_file):
+    with RangeServer(str(large_file), ignore_range=True) as server:
+        with pytest.raises(RangeNotSupported):
+            RangeFile(server.file_url("scan.tiff"))
+        time.sleep(0.2)  # Let the handler notice the closed connection
+        assert server.bytes_sent < SIZE // 4
+
+
+def test_is_streamable_is_cheap_without_range_support(large_file):
+    with RangeServer(str(large_file), ignore_range=True) as server:
+        start = time.monotonic()
+        assert not is_streamable(server.file_url("scan.tiff"), cache_dir=None)
+        assert time.monotonic() - start < 5
+        time.sleep(0.2)
+        assert server.bytes_sent < SIZE // 4
+
+
+def test_range_file_reads_with_range_support(large_file):
+    with RangeServer(str(large_file)) as server:
+        f = RangeFile(server.file_url("scan.tiff"))
+        assert f.size == SIZE
+        assert f.read(16) == bytes(16)
+        assert server.bytes_sent < SIZE // 4
@@ -0,0 +1,348 @@
+"""
+Parallel, resumable downloads of presigned scan URLs.
+
+The object is split into byte ranges that are fetched over several concurrent
+connections (threads with `download_file`, asyncio with `async_download_file`)
+and written straight into a preallocated file with positional writes. Finished
+chunks are recorded in a `<save_path>.progress` sidecar, so an interrupted
+download resumes where it stopped. The result is checked against the object
+size and, when it is a plain MD5, the ETag.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+CHUNK_SIZE = 16 * 1024 * 1024  # Bytes per range request
+CONNECTIONS = 8  # Concurrent range requests
+READ_SIZE = 1024 * 1024  # Bytes written per positional write
+RETRIES = 3  # Attempts per chunk before giving up
+
+
+class DownloadError(Exception):
+    """The downloaded file doesn't match the object on the server."""
+
+
+class DownloadStats(namedtuple("DownloadStats", ["size", "downloaded", "seconds", "connections", "resumed"])):
+    """
+    size: Object size in bytes
+    downloaded: Bytes fetched by this call (less than size when resuming)
+    seconds: Wall time of this call
+    connections: Concurrent connections used
+    resumed: Number of chunks reused from a previous, interrupted download
+    """
+
+    @property
+    def mb_per_second(self) -> float:
+        return self.downloaded / 1e6 / max(self.seconds, 1e-9)
+
+    def __str__(self):
+        return (
+            f"{self.downloaded / 1e6:.1f} MB in {self.seconds:.1f}s "
+            f"({self.mb_per_second:.1f} MB/s over {self.connections} connections, "
+            f"{self.resumed} chunks resumed)"
+        )
+
+
+class _Progress:
+    """Chunk bookkeeping, persisted to a sidecar file after every finished chunk."""
+
+    def __init__(self, save_path: str, size: int, etag: Optional[str], chunk_size: int):
+        self.path = f"{save_path}.progress"
+        self.size = size
+        self.etag = etag
+        self.chunk_size = chunk_size
+        self.done = set()
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            # Only resume into the same object, chunked the same way
+            if (saved["size"], saved["etag"], saved["chunk_size"]) == (size, etag, chunk_size):
+                self.done = set(saved["done"])
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def chunks(self):
+        """Return the (index, start, end) byte ranges still to fetch, end inclusive."""
+        count = (self.size + self.chunk_size - 1) // self.chunk_size
+        return [
+            (index, index * self.chunk_size, min((index + 1) * self.chunk_size, self.size) - 1)
+            for index in range(count)
+            if index not in self.done
+        ]
+
+    def mark_done(self, index: int):
+        with self.lock:
+            self.done.add(index)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(
+                    {
+                        "size": self.size,
+                        "etag": self.etag,
+                        "chunk_size": self.chunk_size,
+                        "done": sorted(self.done),
+                    },
+                    f,
+                )
+            os.replace(tmp_path, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _parse_probe(status: int, headers) -> Tuple[Optional[int], Optional[str]]:
+    """Return (size, etag) from a `Range: bytes=0-0` response, size is None without range support."""
+    etag = headers.get("ETag")
+    if status != 206:
+        return None, etag
+    total = headers.get("Content-Range", "").rpartition("/")[2]
+    return (int(total) if total.isdigit() else None), etag
+
+
+def probe_object(
+    url: str, session: Optional[requests.Session] = None, timeout: float = 60
+) -> Tuple[Optional[int], Optional[str]]:
+    """Return the (size, etag) of `url`, size is None if the server doesn't support Range requests."""
+    # Presigned URLs are usually only signed for GET, so ask for one byte instead of a HEAD
+    session = session or requests.Session()
+    with session.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=timeout) as probe:
+        probe.raise_for_status()
+        return _parse_probe(probe.status_code, probe.headers)
+
+
+async def async_probe_object(url: str, session) -> Tuple[Optional[int], Optional[str]]:
+    """Same as `probe_object` over an `aiohttp.ClientSession`."""
+    async with session.get(url, headers={"Range": "bytes=0-0"}) as probe:
+        probe.raise_for_status()
+        return _parse_probe(probe.status, probe.headers)
+
+
+def _open_preallocated(save_path: str, size: int) -> int:
+    fd = os.open(save_path, os.O_RDWR | os.O_CREAT, 0o644)
+    if os.fstat(fd).st_size != size:
+        os.ftruncate(fd, size)
+    return fd
+
+
+def _verify(save_path: str, size: int, etag: Optional[str]):
+    actual = os.path.getsize(save_path)
+    if actual != size:
+        raise DownloadError(f"Expected {size} bytes, got {actual}")
+    # Multipart uploads have ETags like "<md5>-<parts>" which aren't the file's MD5
+    etag = (etag or "").strip('"')
+    if len(etag) == 32 and "-" not in etag:
+        md5 = hashlib.md5()
+        with open(save_path, "rb") as f:
+            for block in iter(lambda: f.read(READ_SIZE), b""):
+                md5.update(block)
+        if md5.hexdigest() != etag:
+            raise DownloadError(f"Checksum mismatch: expected {etag}, got {md5.hexdigest()}")
+
+
+def _check_same_object(headers, etag: Optional[str]):
+    if etag and headers.get("ETag") and headers["ETag"] != etag:
+        raise DownloadError("Object changed on the server during the download")
+
+
+def download_file(
+    url: str,
+    save_path: str,
+    chunk_size: int = CHUNK_SIZE,
+    connections: int = CONNECTIONS,
+    retries: int = RETRIES,
+    session: Optional[requests.Session] = None,
+    timeout: float = 60,
+) -> DownloadStats:
+    """
+    Download `url` to `save_path` over `connections` concurrent threads.
+
+    Falls back to a single streamed request if the server doesn't support
+    Range requests.
+
+    Raises:
+        requests.RequestException: If a chunk still fails after `retries` attempts
+        DownloadError: If the result doesn't match the size or ETag of the object
+    """
+    start_time = time.monotonic()
+    if session is None:
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(pool_maxsize=connections))
+        session.mount("http://", HTTPAdapter(pool_maxsize=connections))
+
+    size, etag = probe_object(url, session, timeout)
+
+    if size is None:
+        with session.get(url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            with open(save_path, "wb") as f:
+                for block in response.iter_content(chunk_size=READ_SIZE):
+                    f.write(block)
+            # A body cut short still ends the loop, check it against what was announced.
+            # Compressed bodies are announced compressed, requests hands them decompressed.
+            downloaded = os.path.getsize(save_path)
+            size = downloaded
+            if "Content-Length" in response.headers and "Content-Encoding" not in response.headers:
+                size = int(response.headers["Content-Length"])
+        _verify(save_path, size, etag)
+        return DownloadStats(size, downloaded, time.monotonic() - start_time, 1, 0)
+
+    progress = _Progress(save_path, size, etag, chunk_size)
+    resumed = len(progress.done)
+    fd = _open_preallocated(save_path, size)
+    downloaded = 0
+    downloaded_lock = threading.Lock()
+
+    def fetch(chunk):
+        nonlocal downloaded
+        index, start, end = chunk
+        for attempt in range(retries):
+            offset = start
+            try:
+                with session.get(
+                    url, headers={"Range": f"bytes={start}-{end}"}, stream=True, timeout=timeout
+                ) as response:
+                    response.raise_for_status()
+                    _check_same_object(response.headers, etag)
+                    for block in response.iter_content(chunk_size=READ_SIZE):
+                        os.pwrite(fd, block, offset)
+                        offset += len(block)
+                if offset != end + 1:
+                    raise requests.RequestException(f"Short read for bytes {start}-{end}")
+                break
+            except requests.RequestException:
+                if attempt == retries - 1:
+                    raise
+                time.sleep(2**attempt)
+        with downloaded_lock:
+            downloaded += end + 1 - start
+        progress.mark_done(index)
+
+    chunks = progress.chunks()
+    connections = max(1, min(connections, len(chunks)))
+    pool = ThreadPoolExecutor(max_workers=connections)
+    try:
+        futures = [pool.submit(fetch, chunk) for chunk in chunks]
+        for future in futures:
+            future.result()  # Re-raises the first failed chunk
+    finally:
+        # Don't start chunks after a failure, and don't close fd under running writes
+        pool.shutdown(wait=True, cancel_futures=True)
+        os.close(fd)
+
+    _verify(save_path, size, etag)
+    progress.remove()
+    return DownloadStats(size, downloaded, time.monotonic() - start_time, connections, resumed)
+
+
+async def async_download_file(
+    url: str,
+    save_path: str,
+    chunk_size: int = CHUNK_SIZE,
+    connections: int = CONNECTIONS,
+    retries: int = RETRIES,
+    session=None,
+    timeout: float = 60,
+) -> DownloadStats:
+    """
+    Download `url` to `save_path` over `connections` concurrent aiohttp requests.
+
+    Same behaviour as `download_file`. `session` is an optional `aiohttp.ClientSession`.
+
+    Raises:
+        aiohttp.ClientError: If a chunk still fails after `retries` attempts
+        DownloadError: If the result doesn't match the size or ETag of the object
+    """
+    import aiohttp  # Only needed by the api-bridge
+
+    start_time = time.monotonic()
+    loop = asyncio.get_running_loop()
+    own_session = session is None
+    if own_session:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=connections),
+            timeout=aiohttp.ClientTimeout(total=None, sock_read=timeout),
+        )
+    try:
+        size, etag = await async_probe_object(url, session)
+
+        if size is None:
+            fd = os.open(save_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                async with session.get(url) as response:
+                    response.raise_for_status()
+                    offset = 0
+                    async for block in response.content.iter_chunked(READ_SIZE):
+                        await loop.run_in_executor(None, os.pwrite, fd, block, offset)
+                        offset += len(block)
+                    # A body cut short still ends the loop, check it against what was announced.
+                    # Compressed bodies are announced compressed, aiohttp hands them decompressed.
+                    size = offset
+                    if response.content_length is not None and "Content-Encoding" not in response.headers:
+                        size = response.content_length
+            finally:
+                os.close(fd)
+            await loop.run_in_executor(None, _verify, save_path, size, etag)
+            return DownloadStats(size, offset, time.monotonic() - start_time, 1, 0)
+
+        progress = _Progress(save_path, size, etag, chunk_size)
+        resumed = len(progress.done)
+        fd = _open_preallocated(save_path, size)
+        chunks = progress.chunks()
+        connections = max(1, min(connections, len(chunks)))
+        semaphore = asyncio.Semaphore(connections)
+        downloaded = 0
+
+        async def fetch(chunk):
+            nonlocal downloaded
+            index, start, end = chunk
+            async with semaphore:
+                for attempt in range(retries):
+                    offset = start
+                    try:
+                        async with session.get(url, headers={"Range": f"bytes={start}-{end}"}) as response:
+                            response.raise_for_status()
+                            _check_same_object(response.headers, etag)
+                            async for block in response.content.iter_chunked(READ_SIZE):
+                                await loop.run_in_executor(None, os.pwrite, fd, block, offset)
+                                offset += len(block)
+                        if offset != end + 1:
+                            raise aiohttp.ClientPayloadError(f"Short read for bytes {start}-{end}")
+                        break
+                    except (aiohttp.ClientError, asyncio.TimeoutError):
+                        if attempt == retries - 1:
+                            raise
+                        await asyncio.sleep(2**attempt)
+            downloaded += end + 1 - start
+            await loop.run_in_executor(None, progress.mark_done, index)
+
+        tasks = [asyncio.ensure_future(fetch(chunk)) for chunk in chunks]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            os.close(fd)
+
+        await loop.run_in_executor(None, _verify, save_path, size, etag)
+        progress.remove()
+        return DownloadStats(size, downloaded, time.monotonic() - start_time, connections, resumed)
+    finally:
+        if own_session:
+            await session.close()
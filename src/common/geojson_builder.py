@@ -0,0 +1,195 @@
+"""
+Compact, streaming GeoJSON for large annotation sets.
+
+`FeatureBuilder` stores features as NumPy coordinate arrays instead of nested
+dicts and lists, and serializes them in chunks with one C-level string format
+per chunk. `iter_json` walks a results document (dicts, lists and builders)
+and yields compact JSON bytes, so a payload with hundreds of thousands of
+polygons never exists as a single Python object graph or string. `gzip_chunks`
+compresses such a stream on the fly for a chunked request body.
+"""
+
+import json
+import zlib
+from typing import Any, Dict, Iterable, Iterator, List
+
+import numpy as np
+
+CHUNK_FEATURES = 10000  # Features serialized per yielded chunk
+
+
+def _properties_json(properties: Dict[str, Any]) -> str:
+    return json.dumps(properties, separators=(",", ":"))
+
+
+class FeatureBuilder:
+    def __init__(self, quantize: bool = True):
+        """
+        Args:
+            quantize: Round coordinates to integers (level 0 pixels), which keeps the payload small
+        """
+        self.quantize = quantize
+        # Runs of features that share properties, in insertion order:
+        # ("boxes", [(N, 4) arrays], properties, include_bbox) or ("polygons", [(K, 2) arrays], properties)
+        self.segments = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add_boxes(self, boxes, properties: Dict[str, Any], include_bbox: bool = False):
+        """Add one rectangular polygon feature per [x0, y0, x1, y1] row of `boxes`."""
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        if not len(boxes):
+            return
+        properties = _properties_json(properties)
+        last = self.segments[-1] if self.segments else None
+        if last and last[0] == "boxes" and last[2:] == (properties, include_bbox):
+            last[1].append(boxes)
+        else:
+            self.segments.append(("boxes", [boxes], properties, include_bbox))
+        self.count += len(boxes)
+
+    def add_polygon(self, ring, properties: Dict[str, Any]):
+        """Add a polygon feature from a (K, 2) ring of [x, y] points. It's closed if it isn't already."""
+        ring = np.asarray(ring, dtype=np.float64).reshape(-1, 2)
+        if len(ring) and not np.array_equal(ring[0], ring[-1]):
+            ring = np.vstack([ring, ring[:1]])
+        properties = _properties_json(properties)
+        last = self.segments[-1] if self.segments else None
+        if last and last[0] == "polygons" and last[2] == properties:
+            last[1].append(ring)
+        else:
+            self.segments.append(("polygons", [ring], properties))
+        self.count += 1
+
+    def _number_format(self) -> str:
+        return "%d" if self.quantize else "%r"
+
+    def _values(self, array: np.ndarray) -> list:
+        if self.quantize:
+            return np.rint(array).astype(np.int64).ravel().tolist()
+        return array.ravel().tolist()
+
+    def _iter_boxes(self, boxes: np.ndarray, properties: str, include_bbox: bool) -> Iterator[str]:
+        n = self._number_format()
+        ring = ",".join(f"[{n},{n}]" for _ in range(5))
+        template = '{"type":"Feature",'
+        if include_bbox:
+            template += f'"bbox":[{n},{n},{n},{n}],'
+        properties = properties.replace("%", "%%")  # The template is %-formatted
+        template += f'"geometry":{{"type":"Polygon","coordinates":[[{ring}]]}},"properties":{properties}}}'
+        # x0,y0,x1,y1 -> optional bbox, then the closed ring (x0,y0)(x0,y1)(x1,y1)(x1,y0)(x0,y0)
+        columns = [0, 1, 0, 3, 2, 3, 2, 1, 0, 1]
+        if include_bbox:
+            columns = [0, 1, 2, 3] + columns
+        for start in range(0, len(boxes), CHUNK_FEATURES):
+            chunk = boxes[start : start + CHUNK_FEATURES][:, columns]
+            yield ",".join([template] * len(chunk)) % tuple(self._values(chunk))
+
+    def _iter_polygons(self, rings: List[np.ndarray], properties: str) -> Iterator[str]:
+        n = self._number_format()
+        for start in range(0, len(rings), CHUNK_FEATURES):
+            features = []
+            for ring in rings[start : start + CHUNK_FEATURES]:
+                points = ",".join([f"[{n},{n}]"] * len(ring)) % tuple(self._values(ring))
+                features.append(
+                    '{"type":"Feature","geometry":{"type":"Polygon","coordinates":[['
+                    f'{points}]]}},"properties":{properties}}}'
+                )
+            yield ",".join(features)
+
+    def iter_json(self) -> Iterator[bytes]:
+        """Yield the FeatureCollection as compact JSON, CHUNK_FEATURES features at a time."""
+        yield b'{"type":"FeatureCollection","features":['
+        first = True
+        for segment in self.segments:
+            if segment[0] == "boxes":
+                chunks = self._iter_boxes(np.concatenate(segment[1]), segment[2], segment[3])
+            else:
+                chunks = self._iter_polygons(segment[1], segment[2])
+            for chunk in chunks:
+                yield (chunk if first else "," + chunk).encode()
+                first = False
+        yield b"]}"
+
+    def to_dict(self) -> Dict[str, Any]:
+        """The FeatureCollection as plain Python objects. Only meant for small collections."""
+        return json.loads(b"".join(self.iter_json()))
+
+
+def iter_json(obj: Any) -> Iterator[bytes]:
+    """
+    Serialize `obj` as compact JSON bytes, streaming any FeatureBuilder inside it.
+    Any other object with an `iter_json()` method (e.g. spool.SpooledResults) is streamed too.
+    """
+    if hasattr(obj, "iter_json"):
+        yield from obj.iter_json()
+    elif isinstance(obj, dict):
+        yield b"{"
+        for i, (key, value) in enumerate(obj.items()):
+            yield (b"," if i else b"") + json.dumps(str(key)).encode() + b":"
+            yield from iter_json(value)
+        yield b"}"
+    elif isinstance(obj, (list, tuple)):
+        yield b"["
+        for i, value in enumerate(obj):
+            if i:
+                yield b","
+            yield from iter_json(value)
+        yield b"]"
+    else:
+        yield json.dumps(obj, separators=(",", ":")).encode()
+
+
+def dumps(obj: Any) -> str:
+    """Serialize `obj` (which may contain FeatureBuilders) to a compact JSON string."""
+    return b"".join(iter_json(obj)).decode()
+
+
+def gzip_chunks(chunks: Iterable[bytes], level: int = 6, min_size: int = 64 * 1024) -> Iterator[bytes]:
+    """Gzip a stream of chunks, yielding compressed output in pieces of at least `min_size` bytes."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31 writes a gzip header
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            pending.append(data)
+            pending_size += len(data)
+        if pending_size >= min_size:
+            yield b"".join(pending)
+            pending, pending_size = [], 0
+    pending.append(compressor.flush())
+    yield b"".join(pending)
+
+
+def request_body(
+    results: Any, compress: bool = False, buffer_size: int = 1024 * 1024, tracer=None
+) -> Iterable[bytes]:
+    """
+    Serialize `results` into a request body.
+
+    Small documents (under `buffer_size` bytes after compression) come back as
+    one bytes object, so they're sent with a Content-Length. Larger ones come
+    back as a generator, which HTTP clients send with chunked encoding.
+    With a `tracing.Tracer`, the serialization is recorded as a "serialize" span.
+    """
+    chunks = iter_json(results)
+    if compress:
+        chunks = gzip_chunks(chunks)
+    if tracer is not None:
+        chunks = tracer.iterate("serialize", chunks, compressed=compress)
+    buffered = []
+    size = 0
+    for chunk in chunks:
+        buffered.append(chunk)
+        size += len(chunk)
+        if size >= buffer_size:
+            return _chain(buffered, chunks)
+    return b"".join(buffered)
+
+
+def _chain(buffered: List[bytes], rest: Iterator[bytes]) -> Iterator[bytes]:
+    yield b"".join(buffered)
+    yield from rest
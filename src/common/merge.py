@@ -0,0 +1,173 @@
+"""
+Merging duplicate detections across tile seams.
+
+With overlapping tiles, an object near a tile edge is detected once in every
+tile that sees it. `nms` removes the duplicates with greedy IoU non-maximum
+suppression over all of a slide's boxes at once, without comparing every pair:
+
+1. Boxes are bucketed into a uniform grid whose cells are as large as all but
+   the largest 1% of boxes, so two of those boxes can only overlap if their top
+   left corners are in the same or neighbouring cells.
+2. Candidate pairs are generated per cell and neighbouring cell. The few boxes
+   larger than a cell are paired with the boxes in their own x range, and among
+   themselves by the same method. IoU is computed in one vectorized pass.
+3. The suppression graph is resolved in rounds: a box is kept once every
+   higher scoring box it overlaps has been suppressed. This gives exactly the
+   result of sequential greedy NMS, in as many rounds as the longest chain of
+   overlapping boxes (usually two or three).
+
+Memory and time grow with the number of boxes plus candidate pairs, so millions
+of detections per slide are fine as long as boxes aren't piled on top of each other,
+even next to a handful of slide-sized boxes.
+"""
+
+from typing import Optional, Tuple
+
+import numpy as np
+
+# Boxes larger than this quantile of box sizes are paired outside the grid
+LARGE_BOX_QUANTILE = 0.99
+
+# Neighbouring cells checked for each cell. Together with pairs inside a cell this
+# covers each unordered pair of adjacent cells exactly once.
+_NEIGHBOURS = [(1, 0), (-1, 1), (0, 1), (1, 1)]
+
+
+def _ragged_arange(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """Concatenation of arange(start, start + count) for every start/count pair."""
+    total = int(counts.sum())
+    if not total:
+        return np.empty(0, dtype=np.int64)
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + np.arange(total) - offsets
+
+
+def _candidate_pairs(boxes: np.ndarray, cell_size: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Index pairs (i, j), i < j, of boxes in the same or neighbouring grid cells."""
+    cells = np.floor(boxes[:, :2] / cell_size).astype(np.int64)
+    cells -= cells.min(axis=0) - 1  # Keeps every neighbour's key non-negative
+    stride = int(cells[:, 0].max()) + 2
+    keys = cells[:, 1] * stride + cells[:, 0]
+
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    unique_keys, starts, counts = np.unique(sorted_keys, return_index=True, return_counts=True)
+    group = np.repeat(np.arange(len(unique_keys)), counts)  # Group of each sorted position
+    position = np.arange(len(order))
+
+    firsts, seconds = [], []
+    # Pairs inside a cell: every box with the boxes after it in the same cell
+    after = starts[group] + counts[group] - position - 1
+    firsts.append(np.repeat(position, after))
+    seconds.append(_ragged_arange(position + 1, after))
+    # Pairs with the neighbouring cells that exist
+    for dx, dy in _NEIGHBOURS:
+        neighbour = np.searchsorted(unique_keys, unique_keys + dy * stride + dx)
+        neighbour = np.minimum(neighbour, len(unique_keys) - 1)
+        found = unique_keys[neighbour] == unique_keys + dy * stride + dx
+        partner_counts = np.where(found, counts[neighbour], 0)[group]
+        firsts.append(np.repeat(position, partner_counts))
+        seconds.append(_ragged_arange(starts[neighbour][group], partner_counts))
+
+    first = order[np.concatenate(firsts)]
+    second = order[np.concatenate(seconds)]
+    return np.minimum(first, second), np.maximum(first, second)
+
+
+def _overlap_pairs(
+    boxes: np.ndarray, iou_threshold: float, cell_size: Optional[float] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Index pairs (i, j), i < j, of boxes that may overlap by more than `iou_threshold`."""
+    sides = np.max(boxes[:, 2:] - boxes[:, :2], axis=1)
+    if cell_size is None:
+        cell_size = max(float(np.quantile(sides, LARGE_BOX_QUANTILE)), 1.0)
+    large = sides > cell_size
+    if not large.any():
+        return _candidate_pairs(boxes, cell_size)
+
+    small = np.flatnonzero(~large)
+    large = np.flatnonzero(large)
+    firsts, seconds = [], []
+    if len(small) > 1:
+        first, second = _candidate_pairs(boxes[small], cell_size)
+        firsts.append(small[first])
+        seconds.append(small[second])
+    # A large box meets the small boxes whose top left corner is at most a cell before it
+    by_x = small[np.argsort(boxes[small, 0], kind="stable")]
+    small_x = boxes[by_x, 0]
+    for i in large:
+        x0, y0, x1, y1 = boxes[i, :4]
+        # IoU is at most the ratio of the areas, a small box is at most a cell squared
+        if iou_threshold > 0 and cell_size**2 <= iou_threshold * (x1 - x0) * (y1 - y0):
+            continue
+        candidates = by_x[
+            np.searchsorted(small_x, x0 - cell_size) : np.searchsorted(small_x, x1, side="right")
+        ]
+        candidates = candidates[
+            (boxes[candidates, 1] >= y0 - cell_size) & (boxes[candidates, 1] <= y1)
+        ]
+        firsts.append(np.minimum(i, candidates))
+        seconds.append(np.maximum(i, candidates))
+    # Large boxes among themselves, with a grid sized for them. Fewer boxes each time,
+    # the largest is never larger than the quantile.
+    if len(large) > 1:
+        first, second = _overlap_pairs(boxes[large], iou_threshold)
+        firsts.append(large[first])
+        seconds.append(large[second])
+    if not firsts:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(firsts), np.concatenate(seconds)
+
+
+def _iou(boxes: np.ndarray, first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    a = boxes[first]
+    b = boxes[second]
+    width = np.clip(np.minimum(a[:, 2], b[:, 2]) - np.maximum(a[:, 0], b[:, 0]), 0, None)
+    height = np.clip(np.minimum(a[:, 3], b[:, 3]) - np.maximum(a[:, 1], b[:, 1]), 0, None)
+    intersection = width * height
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a + area_b - intersection
+    return np.divide(intersection, union, out=np.zeros_like(union), where=union > 0)
+
+
+def nms(boxes, iou_threshold: float = 0.5, cell_size: Optional[float] = None) -> np.ndarray:
+    """
+    Greedy non-maximum suppression of (N, 5) [x0, y0, x1, y1, score] boxes.
+
+    Args:
+        boxes: Boxes of the whole slide, e.g. tile outputs mapped with tiling.tile_boxes_to_level0
+        iou_threshold: A box is dropped if it overlaps a higher scoring kept box by more than this
+        cell_size: Grid cell size, defaults to the 99th percentile of box widths and heights.
+            Larger boxes are paired outside the grid.
+
+    Returns:
+        Indices of the kept boxes, highest score first.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 5)
+    n = len(boxes)
+    if n < 2:
+        return np.arange(n)
+    # Work in score order, so a lower index always means a higher score
+    order = np.argsort(-boxes[:, 4], kind="stable")
+    ranked = boxes[order, :4]
+
+    first, second = _overlap_pairs(ranked, iou_threshold, cell_size)
+    overlapping = _iou(ranked, first, second) > iou_threshold
+    suppressor, suppressed = first[overlapping], second[overlapping]
+
+    keep = np.zeros(n, dtype=bool)
+    decided = np.zeros(n, dtype=bool)
+    while not decided.all():
+        # Boxes overlapping a kept box are out
+        decided[suppressed[keep[suppressor]]] = True
+        # Boxes whose every higher scoring neighbour is decided (and so not kept) are in
+        blocked = np.zeros(n, dtype=bool)
+        blocked[suppressed[~decided[suppressor]]] = True
+        newly_kept = ~decided & ~blocked
+        keep |= newly_kept
+        decided |= newly_kept
+        # Only edges into undecided boxes matter from here on
+        pending = ~decided[suppressed]
+        suppressor, suppressed = suppressor[pending], suppressed[pending]
+    return order[np.flatnonzero(keep)]
@@ -0,0 +1,349 @@
+"""
+Read TIFF/SVS slides straight from a presigned URL with HTTP Range requests.
+
+`RangeFile` is a seekable, read-only file over a URL that fetches fixed size
+blocks on demand and keeps them in a small in-memory LRU, backed by an optional
+on-disk block cache shared between processes. The disk cache has a directory
+per object version (path plus ETag), and the least recently opened ones are
+removed once it's over BLOCK_CACHE_GB. `RemoteSlide` parses the TIFF
+directories through it with `tifffile` and exposes the parts of the OpenSlide
+API that the tiling code uses, so tiling can start as soon as the header and
+directories have arrived instead of after the whole file is downloaded.
+"""
+
+import hashlib
+import io
+import math
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+from urllib.parse import urlsplit
+
+import numpy as np
+import openslide
+import requests
+import tifffile
+from PIL import Image
+
+BLOCK_SIZE = 512 * 1024
+# Shared by every process reading the same slide, e.g. the tiling workers
+BLOCK_CACHE_DIR = os.environ.get(
+    "BLOCK_CACHE_DIR", os.path.join(tempfile.gettempdir(), "slide_blocks")
+)
+BLOCK_CACHE_BYTES = int(float(os.environ.get("BLOCK_CACHE_GB", "10")) * 1024**3)
+
+
+def _dir_size(path: str) -> int:
+    size = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    size += entry.stat().st_size
+                except FileNotFoundError:
+                    pass
+    except FileNotFoundError:
+        pass
+    return size
+
+
+def trim_block_cache(cache_dir: str, max_bytes: int, keep: Optional[str] = None):
+    """Remove the least recently opened slides' blocks until `cache_dir` is within `max_bytes`."""
+    try:
+        with os.scandir(cache_dir) as entries:
+            slides = [(entry.stat().st_mtime, entry.path) for entry in entries if entry.is_dir()]
+    except FileNotFoundError:
+        return
+    sizes = {path: _dir_size(path) for _, path in slides}
+    total = sum(sizes.values())
+    for _, path in sorted(slides):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        # Another process may still be reading it, it fetches what it misses again
+        shutil.rmtree(path, ignore_errors=True)
+        total -= sizes[path]
+
+
+class RangeNotSupported(Exception):
+    """The server ignored the Range header, the slide has to be downloaded instead."""
+
+
+class RangeFile(io.RawIOBase):
+    def __init__(
+        self,
+        url: str,
+        block_size: int = BLOCK_SIZE,
+        cache_dir: Optional[str] = None,
+        max_memory_blocks: int = 64,
+        session: Optional[requests.Session] = None,
+        timeout: float = 30,
+        cache_max_bytes: int = BLOCK_CACHE_BYTES,
+    ):
+        """
+        Open `url` for reading with Range requests.
+
+        Args:
+            url: The (presigned) URL of the file
+            block_size: Size of each fetched and cached block in bytes
+            cache_dir: Directory for the on-disk block cache, None to only cache in memory
+            cache_max_bytes: Budget of the on-disk block cache, over all slides in `cache_dir`
+            max_memory_blocks: Number of blocks kept in memory
+            session: requests session to reuse, a new one is created by default
+            timeout: Timeout for each request in seconds
+
+        Raises:
+            RangeNotSupported: If the server does not honour Range requests
+        """
+        super().__init__()
+        self.url = url
+        self.name = urlsplit(url).path
+        self.block_size = block_size
+        self.max_memory_blocks = max_memory_blocks
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        self.position = 0
+        self.blocks = OrderedDict()
+        self.lock = threading.Lock()
+        self.bytes_fetched = 0
+        self.cache_dir = None
+        self.size = None
+        self.validator = None
+
+        # The first block also tells us the total size via Content-Range, and the object's
+        # version, so a replaced object never reads the blocks of the old one
+        first_block = self._fetch(0, 1)
+        if cache_dir:
+            # Presigned query strings change per task, so key the cache on the object path
+            parts = urlsplit(url)
+            key = f"{parts.netloc}{parts.path}\n{self.validator}"
+            self.cache_dir = os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest())
+            os.makedirs(self.cache_dir, exist_ok=True)
+            os.utime(self.cache_dir)  # Most recently opened
+            trim_block_cache(cache_dir, cache_max_bytes, keep=self.cache_dir)
+        self._store(0, first_block)
+
+    def _fetch(self, first_block: int, count: int) -> bytes:
+        start = first_block * self.block_size
+        end = start + count * self.block_size - 1
+        if self.size is not None:
+            end = min(end, self.size - 1)
+        # Streamed, so a server that ignores Range isn't read to the end of the object
+        response = self.session.get(
+            self.url, headers={"Range": f"bytes={start}-{end}"}, timeout=self.timeout, stream=True
+        )
+        with response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise RangeNotSupported(f"Expected 206 Partial Content, got {response.status_code}")
+            if self.size is None:
+                content_range = response.headers.get("Content-Range", "")
+                total = content_range.rpartition("/")[2]
+                if not total.isdigit():
+                    raise RangeNotSupported(f"Unusable Content-Range: {content_range!r}")
+                self.size = int(total)
+            # Without an ETag, the size and modification time are the best guess at the version
+            validator = response.headers.get("ETag") or (
+                f"{self.size} {response.headers.get('Last-Modified', '')}"
+            )
+            if self.validator is None:
+                self.validator = validator
+            elif validator != self.validator:
+                raise requests.RequestException(f"{self.name} changed on the server while it was read")
+            content = response.content
+        self.bytes_fetched += len(content)
+        return content
+
+    def _store(self, first_block: int, data: bytes):
+        for i in range(0, len(data), self.block_size):
+            index = first_block + i // self.block_size
+            block = data[i : i + self.block_size]
+            self._remember(index, block)
+            if self.cache_dir:
+                self._write_cache_file(str(index), block)
+
+    def _write_cache_file(self, name: str, data: bytes):
+        # Write then rename, so other processes never see a partial file
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, os.path.join(self.cache_dir, name))
+        except FileNotFoundError:
+            pass  # Trimmed by another process, the blocks are still in memory
+
+    def _remember(self, index: int, block: bytes):
+        self.blocks[index] = block
+        self.blocks.move_to_end(index)
+        while len(self.blocks) > self.max_memory_blocks:
+            self.blocks.popitem(last=False)
+
+    def _cached_block(self, index: int) -> Optional[bytes]:
+        if index in self.blocks:
+            self.blocks.move_to_end(index)
+            return self.blocks[index]
+        if self.cache_dir:
+            try:
+                with open(os.path.join(self.cache_dir, str(index)), "rb") as f:
+                    block = f.read()
+            except FileNotFoundError:
+                return None
+            self._remember(index, block)
+            return block
+        return None
+
+    def _read_blocks(self, first: int, last: int) -> bytes:
+        """Return blocks first..last (inclusive), fetching each missing run in one request."""
+        blocks = [self._cached_block(index) for index in range(first, last + 1)]
+        index = 0
+        while index < len(blocks):
+            if blocks[index] is not None:
+                index += 1
+                continue
+            run_end = index
+            while run_end + 1 < len(blocks) and blocks[run_end + 1] is None:
+                run_end += 1
+            data = self._fetch(first + index, run_end - index + 1)
+            self._store(first + index, data)
+            for offset in range(index, run_end + 1):
+                start = (offset - index) * self.block_size
+                blocks[offset] = data[start : start + self.block_size]
+            index = run_end + 1
+        return b"".join(blocks)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        return self.position
+
+    def readinto(self, buffer):
+        with self.lock:
+            length = min(len(buffer), max(self.size - self.position, 0))
+            if length == 0:
+                return 0
+            first = self.position // self.block_size
+            last = (self.position + length - 1) // self.block_size
+            data = self._read_blocks(first, last)
+            start = self.position - first * self.block_size
+            buffer[:length] = data[start : start + length]
+            self.position += length
+            return length
+
+
+class RemoteSlide:
+    """A tiled TIFF/SVS slide read over HTTP, with the subset of the OpenSlide API used here."""
+
+    def __init__(self, url: str, cache_dir: Optional[str] = None, block_size: int = BLOCK_SIZE):
+        self.file = RangeFile(url, block_size=block_size, cache_dir=cache_dir)
+        self.lock = threading.Lock()
+        try:
+            self.tiff = tifffile.TiffFile(self.file)
+            # Untiled levels (strips) would need whole-level reads, leave them out
+            self.pages = [level.keyframe for level in self.tiff.series[0].levels]
+            self.pages = [page for page in self.pages if page.is_tiled]
+            if not self.pages or self.pages[0] is not self.tiff.series[0].levels[0].keyframe:
+                raise ValueError("Level 0 of the slide is not tiled")
+        except Exception:
+            self.file.close()
+            raise
+        self.level_dimensions = tuple((p.imagewidth, p.imagelength) for p in self.pages)
+        self.dimensions = self.level_dimensions[0]
+        self.level_count = len(self.pages)
+        self.level_downsamples = tuple(self.dimensions[0] / w for w, _ in self.level_dimensions)
+
+    def get_best_level_for_downsample(self, downsample: float) -> int:
+        """Return the lowest resolution level whose downsample is at most `downsample`."""
+        best = 0
+        for level, level_downsample in enumerate(self.level_downsamples):
+            if level_downsample <= downsample:
+                best = level
+        return best
+
+    def read_region(self, location: Tuple[int, int], level: int, size: Tuple[int, int]) -> Image.Image:
+        """Read an RGBA region like OpenSlide: `location` is level 0, `size` is in `level` pixels."""
+        page = self.pages[level]
+        downsample = self.level_downsamples[level]
+        x = int(location[0] / downsample)
+        y = int(location[1] / downsample)
+        width, height = size
+        region = np.zeros((height, width, 4), dtype=np.uint8)  # Transparent past the edges
+
+        tile_w, tile_h = page.tilewidth, page.tilelength
+        tiles_across = math.ceil(page.imagewidth / tile_w)
+        x_end = min(x + width, page.imagewidth)
+        y_end = min(y + height, page.imagelength)
+        if x_end <= max(x, 0) or y_end <= max(y, 0):
+            return Image.fromarray(region, "RGBA")  # Entirely outside the slide
+        with self.lock:
+            for ty in range(max(y, 0) // tile_h, (y_end - 1) // tile_h + 1):
+                for tx in range(max(x, 0) // tile_w, (x_end - 1) // tile_w + 1):
+                    index = ty * tiles_across + tx
+                    self.file.seek(page.dataoffsets[index])
+                    data = self.file.read(page.databytecounts[index])
+                    tile = page.decode(data, index, jpegtables=page.jpegtables)[0][0]
+                    tile = tile.reshape(tile.shape[0], tile.shape[1], -1)[..., :3]
+                    # Intersect the decoded tile with the requested region
+                    left, top = tx * tile_w, ty * tile_h
+                    src_x0, src_y0 = max(x - left, 0), max(y - top, 0)
+                    src_x1 = min(x_end - left, tile.shape[1])
+                    src_y1 = min(y_end - top, tile.shape[0])
+                    if src_x1 <= src_x0 or src_y1 <= src_y0:
+                        continue
+                    dst_x, dst_y = left + src_x0 - x, top + src_y0 - y
+                    dst = region[dst_y : dst_y + src_y1 - src_y0, dst_x : dst_x + src_x1 - src_x0]
+                    dst[..., :3] = tile[src_y0:src_y1, src_x0:src_x1]
+                    dst[..., 3] = 255
+        return Image.fromarray(region, "RGBA")
+
+    def get_thumbnail(self, size: Tuple[int, int]) -> Image.Image:
+        """Return an RGB thumbnail no larger than `size`, on a white background."""
+        downsample = max(self.dimensions[0] / size[0], self.dimensions[1] / size[1])
+        level = self.get_best_level_for_downsample(downsample)
+        region = self.read_region((0, 0), level, self.level_dimensions[level])
+        thumbnail = Image.new("RGB", region.size, (255, 255, 255))
+        thumbnail.paste(region, mask=region.split()[3])
+        thumbnail.thumbnail(size, Image.LANCZOS)
+        return thumbnail
+
+    def close(self):
+        self.tiff.close()
+        self.file.close()
+
+
+def is_url(source: str) -> bool:
+    return source.startswith(("http://", "https://"))
+
+
+def open_slide(source: str, cache_dir: Optional[str] = BLOCK_CACHE_DIR):
+    """Open a local path with OpenSlide, or a URL as a RemoteSlide."""
+    if is_url(source):
+        return RemoteSlide(source, cache_dir=cache_dir)
+    return openslide.OpenSlide(source)
+
+
+def is_streamable(url: str, cache_dir: Optional[str] = BLOCK_CACHE_DIR) -> bool:
+    """Check whether `url` can be read with RemoteSlide, so the full download can be skipped."""
+    try:
+        open_slide(url, cache_dir=cache_dir).close()
+        return True
+    except (RangeNotSupported, requests.RequestException, tifffile.TiffFileError, ValueError):
+        return False
@@ -0,0 +1,266 @@
+"""
+Durable spool for results that couldn't be delivered.
+
+When posting results still fails after the client's retries, the serialized
+results are written to a spool directory instead of being lost, gzipped and
+next to a small metadata file (task, host, token, idempotency key, attempts).
+A flusher re-sends spooled results with exponential backoff once the API is
+reachable again, reusing the idempotency key of the first attempt, and removes
+them once delivered. Results the API rejects outright (a 4xx other than 401,
+408 or 429) are moved to `rejected/` for inspection rather than retried forever.
+
+Entries survive restarts, so mount the spool directory on a volume if the
+container itself may be replaced.
+"""
+
+import asyncio
+import fcntl
+import gzip
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional
+
+from geojson_builder import iter_json
+
+# A spooled body is read back in pieces of this many bytes
+READ_SIZE = 1024 * 1024
+
+
+class DeliveryRejected(Exception):
+    """The API refused the results for good, sending them again won't help."""
+
+
+def is_retryable_status(status: Optional[int]) -> bool:
+    """Whether a failed request with this HTTP status (None without a response) may succeed later."""
+    return status is None or status >= 500 or status in (401, 408, 429)
+
+
+class SpooledResults:
+    """A spooled results document, serialized straight from disk by geojson_builder.iter_json."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def iter_json(self) -> Iterator[bytes]:
+        with gzip.open(self.path, "rb") as f:
+            while True:
+                chunk = f.read(READ_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+
+
+class SpoolEntry:
+    def __init__(self, spool: "ResultSpool", entry_id: str, meta: Dict[str, Any]):
+        self.spool = spool
+        self.id = entry_id
+        self.meta = meta
+
+    @property
+    def task(self) -> Dict[str, Any]:
+        """The task fields needed to post again: task_id, host and jwt_token."""
+        return self.meta["task"]
+
+    @property
+    def idempotency_key(self) -> str:
+        return self.meta["idempotency_key"]
+
+    @property
+    def body_path(self) -> str:
+        return os.path.join(self.spool.directory, f"{self.id}.json.gz")
+
+    def results(self) -> SpooledResults:
+        return SpooledResults(self.body_path)
+
+
+class ResultSpool:
+    def __init__(self, directory: str, base_delay: float = 30, max_delay: float = 3600):
+        """
+        Spool results to `directory`.
+
+        Args:
+            directory: Created if missing
+            base_delay: Seconds before the first re-send, doubled after every failure
+            max_delay: Longest wait between re-sends
+        """
+        self.directory = directory
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.counters = {"spooled": 0, "delivered": 0, "failed_attempts": 0, "rejected": 0}
+        # One flush at a time, so an entry is never sent twice at once
+        self._flush_lock = threading.Lock()
+        self._async_flush_lock = None
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def _try_lock(self) -> Optional[int]:
+        """Lock the directory against flushes by other processes, None if one is running."""
+        fd = os.open(os.path.join(self.directory, ".flush.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def _meta_path(self, entry_id: str) -> str:
+        return os.path.join(self.directory, f"{entry_id}.meta.json")
+
+    def _write_meta(self, entry_id: str, meta: Dict[str, Any]):
+        path = self._meta_path(entry_id)
+        tmp_path = f"{path}.tmp"
+        # Holds the task's token, keep it private
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, path)
+
+    def put(self, task: Dict[str, Any], results: Any, idempotency_key: str, error: str = "") -> SpoolEntry:
+        """
+        Spool `results` (a document for iter_json, FeatureBuilders included) for `task`.
+
+        The body is streamed to disk and the metadata is written last, so an entry only
+        becomes visible to the flusher once it's complete.
+        """
+        safe_task_id = re.sub(r"[^A-Za-z0-9_.-]", "_", str(task["task_id"]))[:64]
+        entry_id = f"{int(time.time())}-{safe_task_id}-{uuid.uuid4().hex[:8]}"
+        body_path = os.path.join(self.directory, f"{entry_id}.json.gz")
+        with gzip.open(f"{body_path}.tmp", "wb", compresslevel=6) as f:
+            for chunk in iter_json(results):
+                f.write(chunk)
+        os.replace(f"{body_path}.tmp", body_path)
+        now = time.time()
+        meta = {
+            "task": {key: task.get(key) for key in ("task_id", "host", "jwt_token")},
+            "idempotency_key": idempotency_key,
+            "created": now,
+            "attempts": 0,
+            "next_attempt": now + self.base_delay,
+            "last_error": error,
+        }
+        self._write_meta(entry_id, meta)
+        self.counters["spooled"] += 1
+        return SpoolEntry(self, entry_id, meta)
+
+    def entries(self) -> List[SpoolEntry]:
+        """Every complete entry, oldest first."""
+        entries = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".meta.json"):
+                continue
+            entry_id = name[: -len(".meta.json")]
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    entries.append(SpoolEntry(self, entry_id, json.load(f)))
+            except (OSError, ValueError):
+                continue  # Removed by another flusher meanwhile, or unreadable
+        return sorted(entries, key=lambda entry: entry.meta["created"])
+
+    def due(self, now: Optional[float] = None) -> List[SpoolEntry]:
+        now = time.time() if now is None else now
+        return [entry for entry in self.entries() if entry.meta["next_attempt"] <= now]
+
+    def delivered(self, entry: SpoolEntry):
+        os.remove(self._meta_path(entry.id))
+        os.remove(entry.body_path)
+        self.counters["delivered"] += 1
+
+    def failed(self, entry: SpoolEntry, error: Exception):
+        """Schedule the next attempt of `entry`, or set it aside if it was rejected."""
+        if isinstance(error, DeliveryRejected):
+            rejected_dir = os.path.join(self.directory, "rejected")
+            os.makedirs(rejected_dir, mode=0o700, exist_ok=True)
+            entry.meta["last_error"] = str(error)
+            self._write_meta(entry.id, entry.meta)
+            os.replace(entry.body_path, os.path.join(rejected_dir, os.path.basename(entry.body_path)))
+            os.replace(self._meta_path(entry.id), os.path.join(rejected_dir, f"{entry.id}.meta.json"))
+            self.counters["rejected"] += 1
+            return
+        attempts = entry.meta["attempts"] + 1
+        delay = min(self.max_delay, self.base_delay * 2**attempts) * random.uniform(0.5, 1.0)
+        entry.meta.update(attempts=attempts, next_attempt=time.time() + delay, last_error=str(error))
+        self._write_meta(entry.id, entry.meta)
+        self.counters["failed_attempts"] += 1
+
+    def flush(self, send: Callable[[SpoolEntry], Any], force: bool = False) -> int:
+        """
+        Re-send due entries (every entry with `force`) with `send(entry)`, oldest first.
+
+        `send` raises on failure, DeliveryRejected if retrying is pointless.
+        Stops at the first retryable failure, the API is probably still down.
+
+        Returns:
+            The number of entries delivered.
+        """
+        delivered = 0
+        with self._flush_lock:
+            lock = self._try_lock()
+            if lock is None:
+                return 0  # Another process (e.g. a second uvicorn worker) is flushing
+            try:
+                for entry in self.entries() if force else self.due():
+                    try:
+                        send(entry)
+                    except Exception as e:
+                        self.failed(entry, e)
+                        if isinstance(e, DeliveryRejected):
+                            continue
+                        break
+                    self.delivered(entry)
+                    delivered += 1
+            finally:
+                os.close(lock)
+        return delivered
+
+    async def async_flush(self, send: Callable[[SpoolEntry], Awaitable[Any]], force: bool = False) -> int:
+        """`flush` for coroutine `send` functions, file operations run on the default executor."""
+        if self._async_flush_lock is None:
+            self._async_flush_lock = asyncio.Lock()
+        loop = asyncio.get_running_loop()
+        delivered = 0
+        async with self._async_flush_lock:
+            lock = await loop.run_in_executor(None, self._try_lock)
+            if lock is None:
+                return 0
+            try:
+                entries = await loop.run_in_executor(None, self.entries if force else self.due)
+                for entry in entries:
+                    try:
+                        await send(entry)
+                    except Exception as e:
+                        await loop.run_in_executor(None, self.failed, entry, e)
+                        if isinstance(e, DeliveryRejected):
+                            continue
+                        break
+                    await loop.run_in_executor(None, self.delivered, entry)
+                    delivered += 1
+            finally:
+                os.close(lock)
+        return delivered
+
+    def start_flusher(self, send: Callable[[SpoolEntry], Any], interval: float = 30) -> threading.Thread:
+        """Flush every `interval` seconds on a daemon thread, for the life of the process."""
+
+        def run():
+            while True:
+                try:
+                    self.flush(send)
+                except Exception as e:
+                    print(f"Error flushing result spool: {str(e)}")
+                time.sleep(interval)
+
+        thread = threading.Thread(target=run, name="spool-flusher", daemon=True)
+        thread.start()
+        return thread
+
+    def metrics(self) -> Dict[str, Any]:
+        entries = self.entries()
+        return {
+            "entries": len(entries),
+            "bytes": sum(os.path.getsize(entry.body_path) for entry in entries if os.path.exists(entry.body_path)),
+            **self.counters,
+        }
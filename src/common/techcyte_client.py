@@ -0,0 +1,287 @@
+import base64
+import os
+import random
+import threading
+import time
+import uuid
+import requests
+from requests.adapters import HTTPAdapter
+from typing import Callable, Dict, Any, Iterable, Optional, Tuple, Union
+
+from geojson_builder import request_body
+
+# Refresh API key tokens this many seconds before they expire
+TOKEN_REFRESH_MARGIN = 60
+# Used when the token response doesn't include expires_in
+DEFAULT_TOKEN_LIFETIME = 3600
+# Status codes worth retrying, the request may succeed a little later
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Tokens are cached for the whole process, keyed by (host, api_key_id), so creating
+# a client per job doesn't cost a token request each time.
+_token_cache: Dict[Tuple[str, str], Tuple[str, float]] = {}
+_token_lock = threading.Lock()
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def api_url(host: str) -> str:
+    """
+    Root URL of the Techcyte API for `host`: https://api.{host}, or TECHCYTE_API_URL if it's set,
+    e.g. a local mock server for testing and benchmarks.
+    """
+    return os.environ.get("TECHCYTE_API_URL", "").rstrip("/") or f"https://api.{host.rstrip('/')}"
+
+
+def shared_session() -> requests.Session:
+    """Return the process-wide session, so connections (and TLS handshakes) are reused."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            _session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+        return _session
+
+
+class TechcyteClient:
+    def __init__(
+        self,
+        host: str = "app.techcyte.com",
+        jwt_token: Union[str, None] = None,
+        api_key_id: Union[str, None] = None,
+        api_key_secret: Union[str, None] = None,
+        session: Union[requests.Session, None] = None,
+        timeout: float = 60,
+        retries: int = 3,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+    ):
+        """
+        Initialize the Techcyte client with the base URL and JWT token or API key.
+
+        Args:
+            host: Techcyte host, e.g. ci.techcyte.com
+            jwt_token: Task specific token, used when no API key is given
+            api_key_id: API key id, used to request (and refresh) tokens
+            api_key_secret: API key secret
+            session: Defaults to the process-wide shared_session()
+            timeout: Connect and read timeout per request in seconds
+            retries: Retries after a connection error, timeout, 429 or 5xx
+            backoff: Base delay in seconds, doubled every retry with random jitter
+            max_backoff: Longest delay in seconds, a longer Retry-After isn't waited for
+        """
+        self.host = host
+        self.base_url = f"{api_url(host)}/api/v3"
+        self.session = session or shared_session()
+        self.token_expires_at = None
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.token = jwt_token
+        self.api_key_id = api_key_id
+        self.api_key_secret = api_key_secret
+        if not self.token and not self.api_key_secret:
+            raise ValueError(
+                "Either JWT_TOKEN or API_KEY_ID+API_KEY_SECRET environment variable must be set"
+            )
+
+        if self.api_key_secret:
+            self.update_token()
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {
+            "Authorization": f"Bearer {self.token}",
+            "Content-Type": "application/json",
+        }
+
+    def update_token(self, force: bool = False):
+        """
+        Get an access token for the API key, reusing the process-wide cached one if it's still fresh.
+
+        Args:
+            force: Always request a new token, e.g. after the current one was rejected
+        """
+        cache_key = (self.host, self.api_key_id)
+        with _token_lock:
+            cached = _token_cache.get(cache_key)
+            if cached and (not force or cached[0] != self.token):
+                # When forced, another client may already have replaced the rejected token
+                self.token, self.token_expires_at = cached
+                if time.time() < self.token_expires_at - TOKEN_REFRESH_MARGIN:
+                    return
+            self.token, self.token_expires_at = self._request_token()
+            _token_cache[cache_key] = (self.token, self.token_expires_at)
+
+    def _request_token(self) -> Tuple[str, float]:
+        url = f"{self.base_url}/token"
+        # Combine api_key_id and api_key_secret with a colon and Base64 encode
+        auth_string = f"{self.api_key_id}:{self.api_key_secret}"
+        auth_encoded = base64.b64encode(auth_string.encode()).decode()
+        headers = {
+            "accept": "application/json, text/plain, */*",
+            "authorization": f"Basic {auth_encoded}",
+            "content-type": "application/x-www-form-urlencoded",
+        }
+        data = {"grant_type": "client_credentials"}
+
+        response = self.session.post(url, headers=headers, data=data, timeout=self.timeout)
+        response.raise_for_status()  # Raise an exception for bad status codes
+
+        body = response.json()
+        expires_in = body.get("expires_in") or DEFAULT_TOKEN_LIFETIME
+        return body["access_token"], time.time() + float(expires_in)
+
+    def _request(
+        self,
+        method: str,
+        url: str,
+        body: Union[Callable[[], Iterable[bytes]], None] = None,
+        headers: Union[Dict[str, str], None] = None,
+        **kwargs,
+    ) -> requests.Response:
+        """
+        Send an authorized request.
+
+        Refreshes the token when it's close to expiry or rejected, and retries
+        connection errors, timeouts, 429 and 5xx responses with jittered backoff. A
+        response asking to retry after more than max_backoff seconds is returned as is.
+        `body` returns the request data and is called for every attempt, so a
+        streamed body can be sent again.
+        """
+        refreshed = False
+        attempt = 0
+        while True:
+            if self.api_key_secret:
+                self.update_token()
+            if body is not None:
+                kwargs["data"] = body()
+            try:
+                response = self.session.request(
+                    method,
+                    url,
+                    headers={**self.headers, **(headers or {})},
+                    timeout=self.timeout,
+                    **kwargs,
+                )
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.retries:
+                    raise
+                time.sleep(self._retry_delay(attempt))
+                attempt += 1
+                continue
+
+            if response.status_code == 401 and self.api_key_secret and not refreshed:
+                # The cached token may have been revoked or expired early, retry once with a new one
+                self.update_token(force=True)
+                refreshed = True
+                continue
+            if response.status_code in RETRY_STATUSES and attempt < self.retries:
+                delay = self._retry_delay(attempt, response.headers.get("Retry-After"))
+                if delay is not None:
+                    time.sleep(delay)
+                    attempt += 1
+                    continue
+            return response
+
+    def _retry_delay(self, attempt: int, retry_after: Optional[str] = None) -> Optional[float]:
+        """Seconds to wait before retrying, None if the server asks for longer than max_backoff."""
+        if retry_after and retry_after.isdigit():
+            return float(retry_after) if float(retry_after) <= self.max_backoff else None
+        return min(self.backoff * 2**attempt * random.uniform(0.5, 1.5), self.max_backoff)
+
+    def post_results(
+        self,
+        task_id: str,
+        results: Dict[str, Any],
+        compress: bool = False,
+        tracer=None,
+        idempotency_key: Optional[str] = None,
+    ) -> requests.Response:
+        """
+        Post results to the /external/results/{task_id} endpoint.
+
+        Args:
+            task_id: The ID of the task
+            results: Dictionary containing caseResults and scanResults as per the schema,
+                feature collections may be geojson_builder.FeatureBuilders
+            compress: Gzip the request body
+            tracer: Optional tracing.Tracer, records the serialization of every attempt
+            idempotency_key: Sent as the Idempotency-Key header of every attempt, so the
+                server can tell a retry from a new post. Defaults to a new random key.
+
+        Returns:
+            requests.Response: The response from the server
+
+        Raises:
+            requests.RequestException: If the request fails
+        """
+        url = f"{self.base_url}/external/results/{task_id}"
+        post_headers = {"Idempotency-Key": idempotency_key or str(uuid.uuid4())}
+        if compress:
+            post_headers["Content-Encoding"] = "gzip"
+        try:
+            response = self._request(
+                "POST",
+                url,
+                body=lambda: request_body(results, compress, tracer=tracer),
+                headers=post_headers,
+            )
+            response.raise_for_status()
+            return response
+        except requests.RequestException as e:
+            raise requests.RequestException(
+                f"Failed to post results: {str(e)}", response=getattr(e, "response", None)
+            )
+
+
+# Example usage
+if __name__ == "__main__":
+    # Sample data matching the schema
+
+    task_id = "123"
+    scan_id = "456"
+
+    sample_results = {
+        "caseResults": {"mitosisCount": 1000},
+        "scanResults": [
+            {
+                "scanId": scan_id,
+                "geojson": {
+                    "type": "FeatureCollection",
+                    "features": [
+                        {
+                            "type": "Feature",
+                            "bbox": [250, 100, 300, 200],
+                            "geometry": {
+                                "type": "Polygon",
+                                "coordinates": [
+                                    [
+                                        [250, 100],
+                                        [250, 200],
+                                        [300, 250],
+                                        [300, 100],
+                                        [250, 100],
+                                    ]
+                                ],
+                            },
+                            "properties": {"annotation_type": "tissue_tumor_positive"},
+                        },
+                    ],
+                },
+            }
+        ],
+    }
+
+    # Initialize client and post results
+    client = TechcyteClient(
+        api_key_id="your_api_key_id_here", api_key_secret="your_api_key_secret_here"
+    )
+    try:
+        response = client.post_results(task_id, sample_results)
+        print(f"Success: {response.status_code}")
+    except requests.RequestException as e:
+        print(f"Error: {str(e)}")
@@ -0,0 +1,174 @@
+"""
+Tiled whole-slide inference.
+
+Splits one pyramid level of a slide into (optionally overlapping) tiles, decodes
+them across a pool of worker processes that each hold their own slide handle,
+and feeds batches of tiles to a model callable. Batches are yielded as soon as
+they finish, so peak memory is bounded by the batch size and not by the size
+of the slide.
+"""
+
+import math
+import multiprocessing
+import os
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from remote_slide import open_slide
+
+# x/y are level 0 coordinates (what read_region expects), size is in pixels of `level`
+Tile = namedtuple("Tile", ["level", "col", "row", "x", "y", "size", "downsample"])
+
+# One slide handle per worker process, opened by _init_worker
+_worker_slide = None
+
+
+def tile_grid(slide, tile_size: int = 512, overlap: int = 0, level: int = 0) -> List[Tile]:
+    """Return the tiles covering `level` of `slide`, in row-major order."""
+    if tile_size <= 0:
+        raise ValueError("tile_size must be positive")
+    if not 0 <= overlap < tile_size:
+        raise ValueError("overlap must be in [0, tile_size)")
+    if not 0 <= level < slide.level_count:
+        raise ValueError(f"Level {level} out of range (slide has {slide.level_count})")
+
+    width, height = slide.level_dimensions[level]
+    downsample = slide.level_downsamples[level]
+    stride = tile_size - overlap
+    cols = max(1, math.ceil((width - overlap) / stride))
+    rows = max(1, math.ceil((height - overlap) / stride))
+    return [
+        Tile(
+            level=level,
+            col=col,
+            row=row,
+            x=int(round(col * stride * downsample)),
+            y=int(round(row * stride * downsample)),
+            size=tile_size,
+            downsample=downsample,
+        )
+        for row in range(rows)
+        for col in range(cols)
+    ]
+
+
+def read_tiles(slide, tiles: Sequence[Tile]) -> np.ndarray:
+    """Decode `tiles` into a (N, size, size, 3) uint8 array. Out of bounds pixels are white."""
+    size = tiles[0].size
+    batch = np.empty((len(tiles), size, size, 3), dtype=np.uint8)
+    for i, tile in enumerate(tiles):
+        region = np.asarray(slide.read_region((tile.x, tile.y), tile.level, (size, size)))
+        batch[i] = region[..., :3]
+        batch[i][region[..., 3] == 0] = 255  # Transparent padding past the slide edge
+    return batch
+
+
+def _init_worker(image_path):
+    global _worker_slide
+    _worker_slide = open_slide(image_path)
+
+
+def _read_batch(tiles):
+    return tiles, read_tiles(_worker_slide, tiles)
+
+
+def iter_tile_batches(
+    image_path: str,
+    tiles: Sequence[Tile],
+    batch_size: int = 16,
+    num_workers: Optional[int] = None,
+    slide=None,
+) -> Iterator[Tuple[List[Tile], np.ndarray]]:
+    """
+    Decode `tiles` in batches and yield (tiles, pixels) as each batch completes.
+
+    Batches are decoded by `num_workers` processes (defaults to the CPU count) and
+    may be yielded out of order. At most two batches per worker are in flight at
+    any time. `num_workers=0` decodes in the calling process, which is handy for
+    debugging, and reads through `slide` if an open handle is given (it is left
+    open). `image_path` may also be a URL, see remote_slide.open_slide.
+    """
+    tiles = list(tiles)
+    batches = (tiles[i : i + batch_size] for i in range(0, len(tiles), batch_size))
+
+    if num_workers == 0:
+        owned = slide is None
+        if owned:
+            slide = open_slide(image_path)
+        try:
+            for batch in batches:
+                yield batch, read_tiles(slide, batch)
+        finally:
+            if owned:
+                slide.close()
+        return
+
+    num_workers = num_workers or os.cpu_count() or 1
+    max_pending = 2 * num_workers
+    # Spawned rather than forked, callers run this from threads (pipeline stages, the
+    # HTTP server) and forking a process with other threads running can deadlock the child
+    pool = ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(image_path,),
+    )
+    try:
+        pending = set()
+        for batch in batches:
+            pending.add(pool.submit(_read_batch, batch))
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        # Also reached when the consumer stops early; don't decode what nobody will read
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def run_tiled_inference(
+    image_path: str,
+    model: Callable[[np.ndarray], Sequence],
+    tile_size: int = 512,
+    overlap: int = 0,
+    level: int = 0,
+    batch_size: int = 16,
+    num_workers: Optional[int] = None,
+    tiles: Optional[Sequence[Tile]] = None,
+    slide=None,
+) -> Iterator[Tuple[List[Tile], Sequence]]:
+    """
+    Run `model` over a slide tile by tile, yielding (tiles, outputs) per batch.
+
+    `model` receives a (N, tile_size, tile_size, 3) uint8 array and returns one
+    output per tile. Pass `tiles` to process a precomputed subset of the grid, and
+    `slide` to reuse an already open handle of `image_path`.
+    """
+    if tiles is None:
+        if slide is not None:
+            tiles = tile_grid(slide, tile_size, overlap, level)
+        else:
+            grid_slide = open_slide(image_path)
+            try:
+                tiles = tile_grid(grid_slide, tile_size, overlap, level)
+            finally:
+                grid_slide.close()
+    for batch_tiles, pixels in iter_tile_batches(
+        image_path, tiles, batch_size, num_workers, slide
+    ):
+        yield batch_tiles, model(pixels)
+
+
+def tile_boxes_to_level0(tile: Tile, boxes) -> np.ndarray:
+    """Map (K, 5) [x0, y0, x1, y1, score] boxes from tile pixels to level 0 coordinates."""
+    boxes = np.array(boxes, dtype=np.float64).reshape(-1, 5)
+    boxes[:, [0, 2]] = boxes[:, [0, 2]] * tile.downsample + tile.x
+    boxes[:, [1, 3]] = boxes[:, [1, 3]] * tile.downsample + tile.y
+    return boxes
@@ -0,0 +1,99 @@
+"""
+Tissue detection for skipping background tiles.
+
+Thresholds the saturation of a low resolution thumbnail with Otsu's method to
+find tissue, then scores every tile by the fraction of its footprint that falls
+on tissue. Only tiles above a coverage threshold need to be decoded and sent to
+the model.
+"""
+
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Saturation floor, so a blank slide (all glass) doesn't get thresholded into noise
+MIN_SATURATION = 0.05
+
+
+def otsu_threshold(values: np.ndarray, bins: int = 256) -> float:
+    """Return the Otsu threshold of `values` (expected in [0, 1])."""
+    hist, edges = np.histogram(values, bins=bins, range=(0.0, 1.0))
+    hist = hist.astype(np.float64)
+    centers = (edges[:-1] + edges[1:]) / 2
+    weight_bg = np.cumsum(hist)
+    weight_fg = weight_bg[-1] - weight_bg
+    mass_bg = np.cumsum(hist * centers)
+    mean_bg = mass_bg / np.maximum(weight_bg, 1)
+    mean_fg = (mass_bg[-1] - mass_bg) / np.maximum(weight_fg, 1)
+    between_class_variance = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+    return float(centers[np.argmax(between_class_variance)])
+
+
+def tissue_mask(
+    slide, thumbnail_size: int = 1024, thumbnail: Optional[np.ndarray] = None
+) -> Tuple[np.ndarray, Tuple[float, float]]:
+    """
+    Detect tissue on a thumbnail of `slide`. Pass an RGB `thumbnail` array to
+    reuse one that's already decoded, e.g. from multires.cached_thumbnail.
+
+    Returns:
+        (mask, (downsample_x, downsample_y)): a boolean (H, W) mask and the level 0
+        pixels per mask pixel along each axis.
+    """
+    if thumbnail is None:
+        thumbnail = slide.get_thumbnail((thumbnail_size, thumbnail_size)).convert("RGB")
+    rgb = np.asarray(thumbnail, dtype=np.float32)[..., :3]
+    high = rgb.max(axis=2)
+    low = rgb.min(axis=2)
+    saturation = (high - low) / np.maximum(high, 1)
+    threshold = max(otsu_threshold(saturation), MIN_SATURATION)
+    # Very dark pixels (pen marks, scanner padding) are unreliable, drop them
+    mask = (saturation > threshold) & (high > 25)
+
+    width, height = slide.dimensions
+    return mask, (width / mask.shape[1], height / mask.shape[0])
+
+
+def tile_coverage(tiles: Sequence, mask: np.ndarray, mask_downsample: Tuple[float, float]) -> np.ndarray:
+    """
+    Return the fraction of each tile's footprint that is tissue.
+
+    Tiles need `x`, `y` (level 0), `size` and `downsample` attributes, like
+    `tiling.Tile`. Uses a summed area table, so every tile is scored in O(1).
+    """
+    if not len(tiles):
+        return np.empty(0, dtype=np.float64)
+    height, width = mask.shape
+    table = np.zeros((height + 1, width + 1), dtype=np.int64)
+    table[1:, 1:] = mask.cumsum(axis=0).cumsum(axis=1)
+
+    x = np.array([t.x for t in tiles], dtype=np.float64)
+    y = np.array([t.y for t in tiles], dtype=np.float64)
+    extent = np.array([t.size * t.downsample for t in tiles], dtype=np.float64)
+    down_x, down_y = mask_downsample
+    # Footprint in mask pixels, at least one pixel wide so tiny tiles still get scored
+    x0 = np.clip(np.floor(x / down_x), 0, width - 1).astype(np.int64)
+    y0 = np.clip(np.floor(y / down_y), 0, height - 1).astype(np.int64)
+    x1 = np.clip(np.ceil((x + extent) / down_x), x0 + 1, width).astype(np.int64)
+    y1 = np.clip(np.ceil((y + extent) / down_y), y0 + 1, height).astype(np.int64)
+
+    tissue = table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+    return tissue / ((x1 - x0) * (y1 - y0))
+
+
+def filter_tissue_tiles(
+    slide, tiles: Sequence, min_coverage: float = 0.05, thumbnail: Optional[np.ndarray] = None
+) -> Tuple[List, float]:
+    """
+    Keep only the tiles of `slide` with at least `min_coverage` tissue.
+    `thumbnail` is passed on to tissue_mask.
+
+    Returns:
+        (tiles, skipped_ratio): the tissue tiles and the fraction of tiles skipped.
+    """
+    if not len(tiles):
+        return [], 0.0
+    mask, mask_downsample = tissue_mask(slide, thumbnail=thumbnail)
+    coverage = tile_coverage(tiles, mask, mask_downsample)
+    kept = [tile for tile, keep in zip(tiles, coverage >= min_coverage) if keep]
+    return kept, 1 - len(kept) / len(tiles)
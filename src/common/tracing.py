@@ -0,0 +1,301 @@
+"""
+Lightweight tracing of a task's stages.
+
+Wrap each phase of a task (download, slide open, tiling, inference,
+serialization, posting) in `tracer.span(name)`. A span records its wall time,
+the CPU time the process used meanwhile and how much the process' peak RSS grew,
+plus optional byte and item (e.g. tile) counts it derives throughput from:
+
+    tracer = Tracer("task 123")
+    with tracer.span("inference") as span:
+        ...
+        span.items = len(tiles)
+    tracer.write("trace.json")
+
+`write` produces a Chrome trace (open it in https://ui.perfetto.dev or
+chrome://tracing) with a per-stage summary under "otherData". Spans are plain
+dicts in `as_dicts`, so spans recorded in a worker process can be sent back and
+merged with `extend`. `StageMetrics` keeps running totals of every span for a
+Prometheus `/metrics` endpoint.
+"""
+
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+# Upper bounds of the span duration histogram buckets in StageMetrics, in seconds
+DURATION_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+
+
+def peak_rss() -> int:
+    """Peak resident set size of this process so far, in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # Linux reports KiB
+
+
+class Span:
+    def __init__(self, name: str, attrs: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.attrs = attrs or {}
+        self.start = time.time()  # Epoch seconds, comparable across processes
+        self.wall = 0.0
+        self.cpu = 0.0  # CPU seconds of the whole process while the span ran
+        self.bytes = 0
+        self.items = 0
+        self.peak_rss = 0
+        self.rss_growth = 0  # How much the span raised the process' peak RSS
+        self.pid = os.getpid()
+        self.thread = threading.get_ident()
+        self.thread_name = threading.current_thread().name
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(self.__dict__)
+
+    @classmethod
+    def from_dict(cls, values: Dict[str, Any]) -> "Span":
+        span = cls.__new__(cls)
+        span.__dict__.update(values)
+        return span
+
+
+class Tracer:
+    def __init__(self, name: str = "task", on_span: Optional[Callable[[Span], None]] = None):
+        """
+        Collect the spans of one task.
+
+        Args:
+            name: Shown as the process name in the trace viewer
+            on_span: Called with every finished span, e.g. StageMetrics.record
+        """
+        self.name = name
+        self.on_span = on_span
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """Time the body as span `name`. Set `bytes` and `items` on the yielded span to get rates."""
+        span = Span(name, attrs)
+        rss_before = peak_rss()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield span
+        except BaseException as e:
+            span.attrs["error"] = str(e) or type(e).__name__
+            raise
+        finally:
+            span.wall = time.perf_counter() - wall_start
+            span.cpu = time.process_time() - cpu_start
+            span.peak_rss = peak_rss()
+            span.rss_growth = span.peak_rss - rss_before
+            self.add(span)
+
+    def iterate(self, name: str, chunks: Iterable[bytes], **attrs) -> Iterator[bytes]:
+        """
+        Yield from `chunks`, recording the time spent producing them as span `name`.
+
+        For lazily serialized bodies: only the time inside the producer counts, not the
+        time the consumer (e.g. a socket) takes, and `bytes` is the total yielded.
+        """
+        span = Span(name, attrs)
+        rss_before = peak_rss()
+        iterator = iter(chunks)
+        try:
+            while True:
+                wall_start = time.perf_counter()
+                cpu_start = time.process_time()
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    span.wall += time.perf_counter() - wall_start
+                    span.cpu += time.process_time() - cpu_start
+                span.bytes += len(chunk)
+                yield chunk
+        finally:
+            span.peak_rss = peak_rss()
+            span.rss_growth = span.peak_rss - rss_before
+            self.add(span)
+
+    def add(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+        if self.on_span is not None:
+            self.on_span(span)
+
+    def extend(self, spans: Iterable[Dict[str, Any]]):
+        """Add spans recorded elsewhere, e.g. the `as_dicts` of a tracer in a worker process."""
+        for values in spans:
+            self.add(Span.from_dict(values))
+
+    def as_dicts(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [span.as_dict() for span in self.spans]
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """Totals per span name, in the order the names first finished."""
+        stages = OrderedDict()
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            stage = stages.setdefault(
+                span.name,
+                {"count": 0, "seconds": 0.0, "cpu_seconds": 0.0, "bytes": 0, "items": 0, "peak_rss": 0},
+            )
+            stage["count"] += 1
+            stage["seconds"] += span.wall
+            stage["cpu_seconds"] += span.cpu
+            stage["bytes"] += span.bytes
+            stage["items"] += span.items
+            stage["peak_rss"] = max(stage["peak_rss"], span.peak_rss)
+        for stage in stages.values():
+            seconds = max(stage["seconds"], 1e-9)
+            stage["bytes_per_second"] = stage["bytes"] / seconds
+            stage["items_per_second"] = stage["items"] / seconds
+        return stages
+
+    def chrome_trace(self) -> Dict[str, Any]:
+        """The spans as a Chrome trace event document, with the summary under "otherData"."""
+        with self._lock:
+            spans = list(self.spans)
+        events = []
+        threads = {}
+        for span in spans:
+            threads[(span.pid, span.thread)] = span.thread_name
+            args = {"cpu_seconds": round(span.cpu, 6), "peak_rss": span.peak_rss, **span.attrs}
+            if span.rss_growth:
+                args["rss_growth"] = span.rss_growth
+            if span.bytes:
+                args["bytes"] = span.bytes
+            if span.items:
+                args["items"] = span.items
+            events.append(
+                {
+                    "name": span.name,
+                    "ph": "X",
+                    "ts": span.start * 1e6,
+                    "dur": span.wall * 1e6,
+                    "pid": span.pid,
+                    "tid": span.thread,
+                    "args": args,
+                }
+            )
+        for pid in sorted({pid for pid, _ in threads}):
+            events.append(
+                {"name": "process_name", "ph": "M", "pid": pid, "args": {"name": f"{self.name} ({pid})"}}
+            )
+        for (pid, thread), thread_name in threads.items():
+            events.append(
+                {"name": "thread_name", "ph": "M", "pid": pid, "tid": thread, "args": {"name": thread_name}}
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"summary": self.summary()}}
+
+    def write(self, path: str):
+        """Write the Chrome trace to `path`."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+    def __str__(self):
+        lines = [f"Trace of {self.name}"]
+        for name, stage in self.summary().items():
+            line = f"  {name:<12} {stage['seconds']:8.2f}s  cpu {stage['cpu_seconds']:7.2f}s"
+            if stage["bytes"]:
+                line += f"  {stage['bytes'] / 1e6:9.1f} MB {stage['bytes_per_second'] / 1e6:8.1f} MB/s"
+            if stage["items"]:
+                line += f"  {stage['items']:7d} items {stage['items_per_second']:8.1f}/s"
+            line += f"  peak RSS {stage['peak_rss'] / 1024**2:.0f} MB"
+            lines.append(line)
+        return "\n".join(lines)
+
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class StageMetrics:
+    """Running totals of finished spans per stage, in the Prometheus text format."""
+
+    def __init__(self, prefix: str = "devkit"):
+        self.prefix = prefix
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, span: Span):
+        with self._lock:
+            stage = self.stages.get(span.name)
+            if stage is None:
+                stage = self.stages[span.name] = {
+                    "count": 0,
+                    "errors": 0,
+                    "seconds": 0.0,
+                    "cpu_seconds": 0.0,
+                    "bytes": 0,
+                    "items": 0,
+                    "buckets": [0] * len(DURATION_BUCKETS),
+                }
+            stage["count"] += 1
+            stage["errors"] += "error" in span.attrs
+            stage["seconds"] += span.wall
+            stage["cpu_seconds"] += span.cpu
+            stage["bytes"] += span.bytes
+            stage["items"] += span.items
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if span.wall <= bound:
+                    stage["buckets"][i] += 1
+
+    def prometheus(self) -> str:
+        """Every stage's duration histogram and totals, plus this process' peak RSS and CPU time."""
+        p = self.prefix
+        lines = [
+            f"# HELP {p}_stage_duration_seconds Wall time of finished stage spans",
+            f"# TYPE {p}_stage_duration_seconds histogram",
+        ]
+        with self._lock:
+            stages = {name: dict(stage, buckets=list(stage["buckets"])) for name, stage in self.stages.items()}
+        for name, stage in stages.items():
+            label = f'stage="{_label(name)}"'
+            for bound, count in zip(DURATION_BUCKETS, stage["buckets"]):
+                lines.append(f'{p}_stage_duration_seconds_bucket{{{label},le="{bound}"}} {count}')
+            lines.append(f'{p}_stage_duration_seconds_bucket{{{label},le="+Inf"}} {stage["count"]}')
+            lines.append(f"{p}_stage_duration_seconds_sum{{{label}}} {stage['seconds']}")
+            lines.append(f"{p}_stage_duration_seconds_count{{{label}}} {stage['count']}")
+        for key, kind, description in [
+            ("errors", "errors", "Stage spans that raised"),
+            ("cpu_seconds", "cpu_seconds", "Process CPU time while stage spans ran"),
+            ("bytes", "bytes", "Bytes moved by stage spans"),
+            ("items", "items", "Items (e.g. tiles) handled by stage spans"),
+        ]:
+            lines.append(f"# HELP {p}_stage_{kind}_total {description}")
+            lines.append(f"# TYPE {p}_stage_{kind}_total counter")
+            for name, stage in stages.items():
+                lines.append(f'{p}_stage_{kind}_total{{stage="{_label(name)}"}} {stage[key]}')
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        lines += [
+            f"# HELP {p}_peak_rss_bytes Peak resident set size of this process",
+            f"# TYPE {p}_peak_rss_bytes gauge",
+            f"{p}_peak_rss_bytes {peak_rss()}",
+            f"# HELP {p}_cpu_seconds_total CPU time of this process",
+            f"# TYPE {p}_cpu_seconds_total counter",
+            f"{p}_cpu_seconds_total {usage.ru_utime + usage.ru_stime}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+def gauges(prefix: str, name: str, description: str, values: Dict[str, Any], label: str) -> str:
+    """Prometheus text for one gauge with a sample per `values` key, e.g. scheduler counters."""
+    lines = [f"# HELP {prefix}_{name} {description}", f"# TYPE {prefix}_{name} gauge"]
+    for key, value in values.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines.append(f'{prefix}_{name}{{{label}="{_label(str(key))}"}} {value}')
+    return "\n".join(lines) + "\n"
@@ -2,31 +2,72 @@
 Example script to get objects from an evaluation
 
 Should have CLIENT_ID and CLIENT_SECRET in the environment variables.
+
+Objects are fetched in pages, several pages at a time, and streamed to disk as
+they arrive. The output format follows the save location's extension:
+`.ndjson`/`.jsonl` (one object per line), `.parquet` (a directory with one
+Parquet file per page, needs pyarrow), `.objects` (a memory-mapped columnar
+store with a spatial index, see object_store.py, needs numpy) or anything
+else as a JSON list. An
+interrupted export can be resumed by running the same command again.
+
+With --manifest, every (scan_id, evaluation_id) pair listed in a CSV or JSON
+lines file is exported to --output-dir, several pairs at a time over one
+connection pool and one access token. Each pair is written to its own
+`scan_id=<scan_id>/evaluation_id=<evaluation_id>/objects.<format>` partition,
+and pairs whose partition is already complete are skipped, so a failed or
+interrupted batch is finished by running it again.
 """
 
 import requests
-from urllib.parse import urljoin
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import quote, urljoin
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
+import csv
+import sys
 import json
+import time
 import argparse
+import threading
+from collections import deque
 
+COLUMNS = ["x", "y", "width", "height", "confidence"]
 
-if __name__ == "__main__":
-
-    # Parse command line arguments
-    parser = argparse.ArgumentParser(description="Get objects from an evaluation")
-    parser.add_argument("scan_id", help="The scan ID (previously sample ID)")
-    parser.add_argument("evaluation_id", help="The evaluation ID")
-    parser.add_argument("save_location", help="The save location for the JSON file")
-    args = parser.parse_args()
+OBJECTS_QUERY = """
+    query($sample_id: String!, $evaluation_id: String!, $limit: Int, $offset: Int) {
+        objects(
+            sample_id: $sample_id
+            filter: { evaluation_id: $evaluation_id }
+            limit: $limit
+            offset: $offset
+        ) {
+            confidence
+            height
+            width
+            x
+            y
+        }
+    }
+"""
 
-    # parameters
-    host = "https://api.ci.techcyte.com"
+# Used with --page-size 0, for servers without pagination
+UNPAGINATED_OBJECTS_QUERY = """
+    query($sample_id: String!, $evaluation_id: String!) {
+        objects(sample_id: $sample_id, filter: { evaluation_id: $evaluation_id }) {
+            confidence
+            height
+            width
+            x
+            y
+        }
+    }
+"""
 
-    assert not os.path.exists(args.save_location), "File already exists"
 
-    # Get a auth token
-    session = requests.Session()
+def request_token(session, host):
+    """Request an auth token with the CLIENT_ID and CLIENT_SECRET environment variables."""
     response = session.request(
         "POST",
         urljoin(host, "/api/v3/token"),
@@ -40,37 +81,395 @@ if __name__ == "__main__":
         },
     ).json()
     assert "access_token" in response, "Failed to get a JWT from techcyte-server."
-    access_token = response["access_token"]
+    return response
 
-    # Get objects
-    response = session.request(
-        "POST",
-        urljoin(host, "/api/graphql"),
-        json={
-            "query": """
-                query($sample_id: String!, $evaluation_id: String!) {
-                    objects(sample_id: $sample_id, filter: { evaluation_id: $evaluation_id }) {
-                        confidence
-                        height
-                        width
-                        x
-                        y
-                    }
-                }
-            """,
-            "variables": {
-                "evaluation_id": args.evaluation_id,
-                "sample_id": args.scan_id,
+
+class AccessToken:
+    """One token shared by every request and thread, fetched again when it expires or is refused."""
+
+    def __init__(self, session, host):
+        self.session = session
+        self.host = host
+        self.value = None
+        self.expires = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def _fetch(self):
+        response = request_token(self.session, self.host)
+        self.value = response["access_token"]
+        # Renew a minute early rather than have requests refused
+        self.expires = time.monotonic() + float(response.get("expires_in") or 3600) - 60
+        self.requests += 1
+
+    def get(self):
+        with self.lock:
+            if self.value is None or time.monotonic() > self.expires:
+                self._fetch()
+            return self.value
+
+    def refresh(self, stale):
+        """Replace the token `stale` after it was refused, unless another thread already did."""
+        with self.lock:
+            if self.value == stale:
+                self._fetch()
+            return self.value
+
+
+def fetch_page(session, host, token, scan_id, evaluation_id, offset, page_size):
+    """Fetch up to page_size objects from `offset` on, or all of them when page_size is 0."""
+    variables = {"evaluation_id": evaluation_id, "sample_id": scan_id}
+    if page_size:
+        variables.update(limit=page_size, offset=offset)
+    access_token = token.get()
+    for attempt in range(2):
+        response = session.request(
+            "POST",
+            urljoin(host, "/api/graphql"),
+            json={
+                "query": OBJECTS_QUERY if page_size else UNPAGINATED_OBJECTS_QUERY,
+                "variables": variables,
             },
-        },
-        headers={
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json",
-        },
+            headers={
+                "Authorization": f"Bearer {access_token}",
+                "Content-Type": "application/json",
+            },
+        )
+        if response.status_code != 401 or attempt:
+            break
+        access_token = token.refresh(access_token)
+    response.raise_for_status()
+    body = response.json()
+    if body.get("errors"):
+        raise RuntimeError(f"GraphQL error at offset {offset}: {body['errors']}")
+    return body["data"]["objects"]
+
+
+class JsonWriter:
+    """Writes objects as a JSON list, one object per line."""
+
+    def __init__(self, path, resume_bytes=0):
+        self.path = path
+        self.f = open(path, "r+b" if resume_bytes else "wb")
+        self.f.truncate(resume_bytes)  # Drop anything written after the last saved page
+        self.f.seek(resume_bytes)
+        self.empty = resume_bytes <= 2
+        if not resume_bytes:
+            self.f.write(b"[\n")
+
+    def write(self, objects):
+        for obj in objects:
+            self.f.write((b"" if self.empty else b",\n") + json.dumps(obj).encode())
+            self.empty = False
+        self.f.flush()
+        return self.f.tell()
+
+    def close(self):
+        self.f.write(b"\n]\n")
+        self.f.close()
+
+
+class NdjsonWriter(JsonWriter):
+    """Writes objects as newline delimited JSON."""
+
+    def __init__(self, path, resume_bytes=0):
+        self.path = path
+        self.f = open(path, "r+b" if resume_bytes else "wb")
+        self.f.truncate(resume_bytes)
+        self.f.seek(resume_bytes)
+
+    def write(self, objects):
+        self.f.write(b"".join(json.dumps(obj).encode() + b"\n" for obj in objects))
+        self.f.flush()
+        return self.f.tell()
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetWriter:
+    """Writes each page as a Parquet file with x/y/width/height/confidence columns."""
+
+    def __init__(self, path, resume_pages=0):
+        import pyarrow  # Only needed for Parquet output
+        import pyarrow.parquet
+
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.path = path
+        self.page = resume_pages
+        self.schema = pyarrow.schema([(column, pyarrow.float64()) for column in COLUMNS])
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, objects):
+        table = self.pa.table(
+            {column: [obj.get(column) for obj in objects] for column in COLUMNS},
+            schema=self.schema,
+        )
+        part_path = os.path.join(self.path, f"part-{self.page:06d}.parquet")
+        self.pq.write_table(table, f"{part_path}.tmp")
+        os.replace(f"{part_path}.tmp", part_path)
+        self.page += 1
+        return 0
+
+    def close(self):
+        pass
+
+
+def open_writer(path, progress):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".parquet":
+        return ParquetWriter(path, progress["pages"])
+    if extension == ".objects":
+        from object_store import ObjectStoreWriter  # Only needed for object stores, uses numpy
+
+        return ObjectStoreWriter(path, progress["objects"])
+    if extension in (".ndjson", ".jsonl"):
+        return NdjsonWriter(path, progress["bytes"])
+    return JsonWriter(path, progress["bytes"])
+
+
+def load_progress(path):
+    """Return the saved progress of an interrupted export, or a fresh one."""
+    progress_path = f"{path}.progress"
+    if os.path.exists(progress_path):
+        with open(progress_path) as f:
+            return json.load(f)
+    assert not os.path.exists(path), "File already exists"
+    return {"pages": 0, "objects": 0, "bytes": 0}
+
+
+def save_progress(path, progress):
+    with open(f"{path}.progress.tmp", "w") as f:
+        json.dump(progress, f)
+    os.replace(f"{path}.progress.tmp", f"{path}.progress")
+
+
+def export_objects(
+    session, host, token, scan_id, evaluation_id, save_location, page_size, concurrency, verbose=True
+):
+    """Fetch every page of objects, `concurrency` pages at a time, writing them in order."""
+    progress = load_progress(save_location)
+    if progress["pages"]:
+        print(f"Resuming after page {progress['pages']} ({progress['objects']} objects)")
+    # Saved before anything is written, so an output without a progress file is always complete
+    save_progress(save_location, progress)
+    writer = open_writer(save_location, progress)
+
+    start_time = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        pending = deque()  # Futures of the pages in flight, in offset order
+        next_offset = progress["objects"]
+        while True:
+            # Keep `concurrency` pages in flight ahead of the next page to write
+            while page_size and len(pending) < concurrency:
+                pending.append(
+                    pool.submit(
+                        fetch_page, session, host, token, scan_id, evaluation_id, next_offset, page_size
+                    )
+                )
+                next_offset += page_size
+            if not page_size:
+                pending.append(
+                    pool.submit(fetch_page, session, host, token, scan_id, evaluation_id, 0, 0)
+                )
+            objects = pending.popleft().result()
+            if page_size and not objects:
+                break  # Past the end
+            progress["bytes"] = writer.write(objects)
+            progress["pages"] += 1
+            progress["objects"] += len(objects)
+            save_progress(save_location, progress)
+
+            if verbose:
+                elapsed = time.monotonic() - start_time
+                print(f"Page {progress['pages']}: {progress['objects']} objects ({elapsed:.1f}s)")
+            if not page_size:
+                break
+            if len(objects) < page_size:
+                # The last page, or the server caps pages below page_size. Carry on from where
+                # this page ended, in pages of the server's size, until a page comes back empty.
+                page_size = len(objects)
+                for future in pending:
+                    future.cancel()
+                pending.clear()
+                next_offset = progress["objects"]
+        for future in pending:
+            future.cancel()
+
+    writer.close()
+    os.remove(f"{save_location}.progress")
+    return progress["objects"]
+
+
+def read_manifest(path):
+    """(scan_id, evaluation_id) pairs from a CSV with a header row or a JSON lines file, duplicates dropped."""
+    with open(path, newline="") as f:
+        if os.path.splitext(path)[1].lower() in (".jsonl", ".ndjson"):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+    pairs = []
+    for number, row in enumerate(rows, 1):
+        scan_id = row.get("scan_id") or row.get("sample_id")
+        evaluation_id = row.get("evaluation_id")
+        assert scan_id and evaluation_id, f"Manifest row {number} needs a scan_id and an evaluation_id"
+        pairs.append((str(scan_id).strip(), str(evaluation_id).strip()))
+    return list(dict.fromkeys(pairs))
+
+
+def partition_path(output_dir, scan_id, evaluation_id, output_format):
+    """Hive style partition of a pair, readable as one dataset by pyarrow, Spark or DuckDB."""
+    return os.path.join(
+        output_dir,
+        f"scan_id={quote(scan_id, safe='')}",
+        f"evaluation_id={quote(evaluation_id, safe='')}",
+        f"objects.{output_format}",
+    )
+
+
+def export_manifest(
+    session, host, token, pairs, output_dir, output_format, page_size, concurrency, jobs
+):
+    """
+    Export every pair to its partition of `output_dir`, `jobs` pairs at a time.
+    A pair that fails doesn't stop the others, its partial output is resumed next run.
+
+    Returns:
+        Counts of exported, skipped and failed pairs and of objects saved.
+    """
+    counts = {"exported": 0, "skipped": 0, "failed": 0, "objects": 0}
+    todo = []
+    for scan_id, evaluation_id in pairs:
+        path = partition_path(output_dir, scan_id, evaluation_id, output_format)
+        if os.path.exists(path) and not os.path.exists(f"{path}.progress"):
+            counts["skipped"] += 1
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        todo.append((scan_id, evaluation_id, path))
+    print(f"Exporting {len(todo)} of {len(pairs)} pairs, {counts['skipped']} already done")
+
+    start_time = time.monotonic()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {
+            pool.submit(
+                export_objects,
+                session,
+                host,
+                token,
+                scan_id,
+                evaluation_id,
+                path,
+                page_size,
+                concurrency,
+                verbose=False,
+            ): (scan_id, evaluation_id)
+            for scan_id, evaluation_id, path in todo
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            scan_id, evaluation_id = futures[future]
+            elapsed = time.monotonic() - start_time
+            try:
+                count = future.result()
+            except Exception as e:
+                counts["failed"] += 1
+                print(f"[{done}/{len(todo)}] {scan_id} {evaluation_id} failed: {str(e)} ({elapsed:.1f}s)")
+                continue
+            counts["exported"] += 1
+            counts["objects"] += count
+            print(f"[{done}/{len(todo)}] {scan_id} {evaluation_id}: {count} objects ({elapsed:.1f}s)")
+    return counts
+
+
+def main():
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description="Get objects from an evaluation")
+    parser.add_argument("scan_id", nargs="?", help="The scan ID (previously sample ID)")
+    parser.add_argument("evaluation_id", nargs="?", help="The evaluation ID")
+    parser.add_argument(
+        "save_location",
+        nargs="?",
+        help="The save location, .ndjson/.jsonl, .parquet (needs pyarrow), .objects (needs numpy) "
+        "or a JSON list otherwise",
+    )
+    parser.add_argument(
+        "--host",
+        default=os.environ.get("TECHCYTE_API_URL", "https://api.ci.techcyte.com"),
+        help="The Techcyte API host, defaults to $TECHCYTE_API_URL or the CI environment",
+    )
+    parser.add_argument(
+        "--page-size", type=int, default=10000, help="Objects per request, 0 to fetch all at once"
+    )
+    parser.add_argument("--concurrency", type=int, default=4, help="Pages fetched at once per pair")
+    parser.add_argument(
+        "--manifest", help="CSV or .jsonl file of scan_id,evaluation_id pairs to export instead of one pair"
     )
+    parser.add_argument("--output-dir", default="objects", help="Where --manifest pairs are saved")
+    parser.add_argument(
+        "--format",
+        choices=["ndjson", "parquet", "objects", "json"],
+        default="ndjson",
+        help="Output format of --manifest pairs",
+    )
+    parser.add_argument("--jobs", type=int, default=8, help="--manifest pairs exported at once")
+    args = parser.parse_args()
+    if not args.manifest and not (args.scan_id and args.evaluation_id and args.save_location):
+        parser.error("give a scan_id, evaluation_id and save_location, or a --manifest")
+
+    # One pool of connections and one token for every request. GraphQL queries are
+    # read-only, so throttled or failed ones are safe to retry.
+    connections = args.concurrency * (args.jobs if args.manifest else 1)
+    retry = Retry(
+        total=3, backoff_factor=1, status_forcelist=[429, 502, 503, 504], allowed_methods=None
+    )
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_maxsize=connections, max_retries=retry))
+    session.mount("http://", HTTPAdapter(pool_maxsize=connections, max_retries=retry))
+    token = AccessToken(session, args.host)
 
-    # save objects
-    with open(args.save_location, "w") as f:
-        objects = response.json()["data"]["objects"]
-        print(f"Saved {len(objects)} objects to {args.save_location}")
-        json.dump(objects, f, indent=4)
+    start_time = time.monotonic()
+    if args.manifest:
+        pairs = read_manifest(args.manifest)
+        counts = export_manifest(
+            session,
+            args.host,
+            token,
+            pairs,
+            args.output_dir,
+            args.format,
+            args.page_size,
+            args.concurrency,
+            args.jobs,
+        )
+        summary = (
+            f"Exported {counts['exported']} pairs ({counts['objects']} objects), skipped "
+            f"{counts['skipped']}, failed {counts['failed']} to {args.output_dir}"
+        )
+    else:
+        count = export_objects(
+            session,
+            args.host,
+            token,
+            args.scan_id,
+            args.evaluation_id,
+            args.save_location,
+            args.page_size,
+            args.concurrency,
+        )
+        counts = {"failed": 0}
+        summary = f"Saved {count} objects to {args.save_location}"
+    stats = f"{token.requests} token requests"
+    try:
+        import resource  # Not on Windows
+
+        # ru_maxrss is in KB on Linux
+        stats += f", peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB"
+    except ImportError:
+        pass
+    print(f"{summary} in {time.monotonic() - start_time:.1f}s ({stats})")
+    if counts["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+"""
+Columnar, spatially indexed store for exported objects.
+
+A store is a directory with one memory-mapped `.npy` file per column (x, y,
+width, height, confidence as float32), the rows ordered by the cell of a
+regular grid that contains each object's top-left corner, and a small
+`cell_offsets.npy` giving the first row of every cell. A query only reads the
+rows of the grid cells that can overlap its window, so looking at a region of a
+million-object evaluation touches a few pages of the file instead of parsing
+all of it. The few objects much larger than the rest are kept out of the grid,
+in rows after it that every query scans, so one slide-sized object doesn't
+widen every window.
+
+Written by get_objects.py for a save location ending in `.objects` (needs
+numpy). Query it from Python:
+
+    store = ObjectStore("objects.objects")
+    found = store.query(bbox=(x0, y0, x1, y1), min_confidence=0.9)
+    found["x"], found["confidence"]  # NumPy arrays
+
+or from the command line, printing matches as JSON lines:
+
+    python object_store.py objects.objects --bbox 1000 1000 3000 3000 --min-confidence 0.9
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+COLUMNS = ["x", "y", "width", "height", "confidence"]
+DTYPE = np.float32
+# Grid cells are sized for about this many objects each
+OBJECTS_PER_CELL = 64
+# Objects larger than this quantile of sizes, and than a cell, are scanned by every query
+OVERSIZED_QUANTILE = 0.99
+
+
+class ObjectStoreWriter:
+    """
+    Appends pages of objects to raw column files, then sorts them into a store on `close`.
+
+    Has the writer interface of get_objects.py, `resume_objects` rows already written by
+    an interrupted export are kept and anything after them dropped.
+    """
+
+    def __init__(self, path: str, resume_objects: int = 0):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.files = {}
+        for column in COLUMNS:
+            part_path = self._part_path(column)
+            f = open(part_path, "r+b" if resume_objects and os.path.exists(part_path) else "wb")
+            f.truncate(resume_objects * np.dtype(DTYPE).itemsize)
+            f.seek(0, os.SEEK_END)
+            self.files[column] = f
+
+    def _part_path(self, column: str) -> str:
+        return os.path.join(self.path, f"{column}.part")
+
+    def write(self, objects: List[Dict]) -> int:
+        for column, f in self.files.items():
+            values = [obj.get(column) for obj in objects]
+            f.write(np.array([np.nan if v is None else v for v in values], dtype=DTYPE).tobytes())
+            f.flush()
+        return 0
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        parts = {column: self._part_path(column) for column in COLUMNS}
+        count = os.path.getsize(parts["x"]) // np.dtype(DTYPE).itemsize
+        columns = {
+            column: np.fromfile(path, dtype=DTYPE, count=count) for column, path in parts.items()
+        }
+        build(self.path, columns)
+        for path in parts.values():
+            os.remove(path)
+
+
+def _grid(x: np.ndarray, y: np.ndarray) -> Tuple[float, float, float, int, int]:
+    """Origin, cell size and shape of a grid over the objects' top-left corners."""
+    if not len(x) or np.isnan(x).all() or np.isnan(y).all():
+        return 0.0, 0.0, 1.0, 1, 1
+    origin_x, origin_y = float(np.nanmin(x)), float(np.nanmin(y))
+    extent = max(float(np.nanmax(x)) - origin_x, float(np.nanmax(y)) - origin_y, 1.0)
+    cell_size = extent / max(1, math.ceil(math.sqrt(len(x) / OBJECTS_PER_CELL)))
+    cols = int((float(np.nanmax(x)) - origin_x) // cell_size) + 1
+    rows = int((float(np.nanmax(y)) - origin_y) // cell_size) + 1
+    return origin_x, origin_y, cell_size, cols, rows
+
+
+def build(path: str, columns: Dict[str, np.ndarray]):
+    """Write `columns` (equal length arrays) to a store at `path`, sorted by grid cell."""
+    os.makedirs(path, exist_ok=True)
+    columns = {column: np.asarray(columns[column], dtype=DTYPE) for column in COLUMNS}
+    # Cells computed in float64, like the windows of queries
+    x, y = columns["x"].astype(np.float64), columns["y"].astype(np.float64)
+    origin_x, origin_y, cell_size, cols, rows = _grid(x, y)
+    # Objects without coordinates go to the first cell, no window matches them
+    col = np.nan_to_num((x - origin_x) // cell_size).astype(np.int64).clip(0, cols - 1)
+    row = np.nan_to_num((y - origin_y) // cell_size).astype(np.int64).clip(0, rows - 1)
+    cells = row * cols + col
+    # Sizes that aren't numbers can't reach past their cell
+    sizes = np.fmax(np.nan_to_num(columns["width"]), np.nan_to_num(columns["height"]))
+    limit = max(cell_size, float(np.quantile(sizes, OVERSIZED_QUANTILE))) if len(x) else 0.0
+    indexed = sizes <= limit
+    cells[~indexed] = rows * cols  # After every cell, outside of the grid
+    order = np.argsort(cells, kind="stable")
+    offsets = np.zeros(rows * cols + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cells[indexed], minlength=rows * cols), out=offsets[1:])
+
+    for column, values in columns.items():
+        np.save(os.path.join(path, f"{column}.npy"), values[order])
+    np.save(os.path.join(path, "cell_offsets.npy"), offsets)
+    meta = {
+        "count": len(x),
+        "columns": COLUMNS,
+        "origin": [origin_x, origin_y],
+        "cell_size": cell_size,
+        "grid": [cols, rows],
+        # Rows from here on are oversized objects, outside of the grid
+        "indexed": int(indexed.sum()),
+        # How far an object in the grid reaches past its cell, for windows left of or above it
+        "max_width": float(np.nanmax(columns["width"][indexed], initial=0.0)),
+        "max_height": float(np.nanmax(columns["height"][indexed], initial=0.0)),
+    }
+    # Written last, a store without it is incomplete
+    with open(os.path.join(path, "meta.json.tmp"), "w") as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(path, "meta.json.tmp"), os.path.join(path, "meta.json"))
+
+
+class ObjectStore:
+    def __init__(self, path: str):
+        """Open the store at `path`. Columns are memory-mapped, only the cell offsets are read."""
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.columns = {
+            column: np.load(os.path.join(path, f"{column}.npy"), mmap_mode="r")
+            for column in self.meta["columns"]
+        }
+        self.offsets = np.load(os.path.join(path, "cell_offsets.npy"))
+
+    def __len__(self) -> int:
+        return self.meta["count"]
+
+    def _ranges(self, bbox: Optional[Sequence[float]]) -> List[Tuple[int, int]]:
+        """Row ranges of the grid cells that may hold objects overlapping `bbox`, and oversized objects."""
+        if bbox is None:
+            return [(0, len(self))]
+        x0, y0, x1, y1 = bbox
+        origin_x, origin_y = self.meta["origin"]
+        cell_size = self.meta["cell_size"]
+        cols, rows = self.meta["grid"]
+        # Cells hold objects by their top-left corner, objects starting left of or above
+        # the window can still reach into it
+        c0 = int(np.clip((x0 - self.meta["max_width"] - origin_x) // cell_size, 0, cols - 1))
+        c1 = int(np.clip((x1 - origin_x) // cell_size, 0, cols - 1))
+        r0 = int(np.clip((y0 - self.meta["max_height"] - origin_y) // cell_size, 0, rows - 1))
+        r1 = int(np.clip((y1 - origin_y) // cell_size, 0, rows - 1))
+        ranges = []
+        for row in range(r0, r1 + 1):
+            start = int(self.offsets[row * cols + c0])
+            end = int(self.offsets[row * cols + c1 + 1])
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)  # Whole rows of the grid are contiguous
+            elif end > start:
+                ranges.append((start, end))
+        indexed = self.meta["indexed"]
+        if indexed < len(self):
+            if ranges and ranges[-1][1] == indexed:
+                ranges[-1] = (ranges[-1][0], len(self))
+            else:
+                ranges.append((indexed, len(self)))
+        return ranges
+
+    def rows(
+        self, bbox: Optional[Sequence[float]] = None, min_confidence: Optional[float] = None
+    ) -> np.ndarray:
+        """
+        Row numbers of the objects overlapping `bbox` (x0, y0, x1, y1, in slide pixels)
+        with at least `min_confidence`, both optional.
+        """
+        found = []
+        for start, end in self._ranges(bbox):
+            keep = np.ones(end - start, dtype=bool)
+            if bbox is not None:
+                x0, y0, x1, y1 = bbox
+                x = self.columns["x"][start:end]
+                y = self.columns["y"][start:end]
+                keep &= (x <= x1) & (y <= y1)
+                keep &= np.add(x, self.columns["width"][start:end], dtype=np.float64) >= x0
+                keep &= np.add(y, self.columns["height"][start:end], dtype=np.float64) >= y0
+            if min_confidence is not None:
+                keep &= self.columns["confidence"][start:end] >= min_confidence
+            found.append(np.flatnonzero(keep) + start)
+        return np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+
+    def query(
+        self, bbox: Optional[Sequence[float]] = None, min_confidence: Optional[float] = None
+    ) -> Dict[str, np.ndarray]:
+        """Columns of the objects `rows` finds, as NumPy arrays."""
+        rows = self.rows(bbox, min_confidence)
+        return {column: values[rows] for column, values in self.columns.items()}
+
+    def count(
+        self, bbox: Optional[Sequence[float]] = None, min_confidence: Optional[float] = None
+    ) -> int:
+        return len(self.rows(bbox, min_confidence))
+
+
+def iter_objects(columns: Dict[str, np.ndarray]) -> Iterable[Dict[str, float]]:
+    """Objects of `ObjectStore.query` results as dicts, like get_objects.py exports them."""
+    names = list(columns)
+    # Through the shortest float32 repr, so 0.922 isn't printed as 0.921999990940094
+    for values in zip(*(columns[name].astype(str).astype(float).tolist() for name in names)):
+        yield dict(zip(names, values))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query an object store written by get_objects.py")
+    parser.add_argument("store", help="The .objects directory")
+    parser.add_argument("--bbox", type=float, nargs=4, metavar=("X0", "Y0", "X1", "Y1"))
+    parser.add_argument("--min-confidence", type=float)
+    parser.add_argument("--count", action="store_true", help="Only print how many objects match")
+    args = parser.parse_args()
+
+    start_time = time.monotonic()
+    store = ObjectStore(args.store)
+    if args.count:
+        print(store.count(args.bbox, args.min_confidence))
+    else:
+        for obj in iter_objects(store.query(args.bbox, args.min_confidence)):
+            sys.stdout.write(json.dumps(obj) + "\n")
+    print(f"Queried {len(store)} objects in {time.monotonic() - start_time:.3f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
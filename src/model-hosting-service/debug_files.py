@@ -0,0 +1,274 @@
+"""
+Debug files uploaded with a task, for inspection in Fusion.
+
+Processing code registers in-memory buffers, NumPy arrays, images or file
+paths with a `DebugFiles` collection. Nothing is copied or written to disk when
+an entry is registered: on upload, the zip is built entry by entry and streamed
+straight into a chunked PUT to the task's DEBUG_FILE_UPLOAD_URL. Hosts that
+refuse chunked uploads get it spooled to a temporary file and sent with its size.
+
+Each entry has its own compression level, 0 stores it as is (right for PNGs,
+JPEGs and noisy arrays that don't compress). Debug output is kept bounded:
+entries beyond the total or per-entry size limits are left out, and
+`sample_key` keeps a stable fraction of repetitive entries such as per-tile
+overlays. What was left out is listed in the zip's `manifest.json`.
+"""
+
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import zipfile
+from typing import Any, Callable, Dict, Iterator, List, Optional
+from urllib.parse import urlsplit
+
+import requests
+
+# Files are read, and buffers sliced, in pieces of this many bytes
+READ_SIZE = 1024 * 1024
+DEFAULT_COMPRESS_LEVEL = 6
+# Zips up to this size are spooled in memory for hosts that refuse chunked uploads
+SPOOL_MEMORY_BYTES = 64 * 1024 * 1024
+
+# Hosts that refused a chunked upload, later uploads to them are sent with their size right away
+_chunked_refused = set()
+
+
+class _Sink:
+    """Write-only file for zipfile, collecting what it writes until it's drained."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class _SizedBody:
+    """A body generator with a known length, so requests sends a Content-Length instead of chunks."""
+
+    def __init__(self, chunks: Callable[[], Iterator[bytes]], size: int):
+        self.chunks = chunks
+        self.size = size
+
+    def __iter__(self):
+        return self.chunks()
+
+    def __len__(self) -> int:
+        return self.size
+
+
+def _in_pieces(buffer) -> Iterator[memoryview]:
+    view = memoryview(buffer).cast("B")
+    for start in range(0, len(view), READ_SIZE):
+        yield view[start : start + READ_SIZE]
+
+
+def _file_pieces(path: str) -> Iterator[bytes]:
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+class DebugFiles:
+    def __init__(
+        self,
+        upload_url: Optional[str] = None,
+        max_bytes: int = 1024**3,
+        max_entry_bytes: int = 256 * 1024**2,
+        sample_rate: float = 1.0,
+        compress_level: int = DEFAULT_COMPRESS_LEVEL,
+    ):
+        """
+        Args:
+            upload_url: Presigned URL the zip is PUT to. Without one, entries aren't kept.
+            max_bytes: Uncompressed bytes of all entries, later entries are left out beyond it
+            max_entry_bytes: Entries larger than this are left out
+            sample_rate: Fraction of the entries registered with a `sample_key` that are kept
+            compress_level: Deflate level of entries that don't set their own, 0 stores them
+        """
+        self.upload_url = upload_url
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.sample_rate = sample_rate
+        self.compress_level = compress_level
+        self.entries: List[Dict[str, Any]] = []
+        self.skipped: List[Dict[str, Any]] = []
+        self.bytes = 0
+        self._lock = threading.Lock()  # Entries may be added from several threads
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.upload_url)
+
+    def sample(self, key: str) -> bool:
+        """Whether an entry sampled by `key` is kept. Stable for a key, so reruns keep the same ones."""
+        if self.sample_rate >= 1:
+            return True
+        digest = hashlib.sha1(key.encode()).digest()
+        return int.from_bytes(digest[:8], "big") / 2**64 < self.sample_rate
+
+    def _add(self, name, size, pieces, compress_level, sample_key) -> bool:
+        if not self.enabled:
+            return False
+        reason = None
+        if sample_key is not None and not self.sample(sample_key):
+            reason = "sampled out"
+        elif size > self.max_entry_bytes:
+            reason = "larger than the entry limit"
+        with self._lock:
+            if any(entry["name"] == name for entry in self.entries):
+                raise ValueError(f"Debug file {name} was already added")
+            if reason is None and self.bytes + size > self.max_bytes:
+                reason = "over the total size limit"
+            if reason is not None:
+                self.skipped.append({"name": name, "bytes": size, "reason": reason})
+                return False
+            self.bytes += size
+            level = self.compress_level if compress_level is None else compress_level
+            self.entries.append({"name": name, "bytes": size, "level": level, "pieces": pieces})
+        return True
+
+    def add_bytes(
+        self, name: str, data, compress_level: Optional[int] = None, sample_key: Optional[str] = None
+    ) -> bool:
+        """
+        Add `data`, anything supporting the buffer protocol (bytes, bytearray, memoryview...).
+        The buffer is referenced, not copied, until the upload; don't modify it before then.
+
+        Returns:
+            Whether it's included, False if there's no upload URL or it was left out.
+        """
+        size = memoryview(data).nbytes
+        return self._add(name, size, lambda: _in_pieces(data), compress_level, sample_key)
+
+    def add_text(
+        self, name: str, text: str, compress_level: Optional[int] = None, sample_key: Optional[str] = None
+    ) -> bool:
+        return self.add_bytes(name, text.encode(), compress_level, sample_key)
+
+    def add_file(
+        self, name: str, path: str, compress_level: Optional[int] = None, sample_key: Optional[str] = None
+    ) -> bool:
+        """Add the file at `path`, read when the zip is uploaded. Keep it until then."""
+        return self._add(
+            name, os.path.getsize(path), lambda: _file_pieces(path), compress_level, sample_key
+        )
+
+    def add_array(
+        self, name: str, array, compress_level: Optional[int] = None, sample_key: Optional[str] = None
+    ) -> bool:
+        """Add a NumPy array as a `.npy` file, load it with numpy.load. C-contiguous arrays aren't copied."""
+        import numpy as np
+
+        array = np.ascontiguousarray(array)
+        if array.dtype.hasobject:
+            raise ValueError(f"Can't add object array {name} as a debug file")
+        header = io.BytesIO()
+        np.lib.format.write_array_header_1_0(header, np.lib.format.header_data_from_array_1_0(array))
+        header = header.getvalue()
+
+        def pieces():
+            yield header
+            yield from _in_pieces(array.reshape(-1).view(np.uint8))
+
+        return self._add(name, len(header) + array.nbytes, pieces, compress_level, sample_key)
+
+    def add_image(
+        self, name: str, image, compress_level: Optional[int] = 0, sample_key: Optional[str] = None
+    ) -> bool:
+        """
+        Add a PIL image or (H, W[, 3]) uint8 array, encoded in the format of `name`'s extension
+        (e.g. overlay.png). Stored without compression by default, PNG and JPEG already are.
+        """
+        if not self.enabled:
+            return False
+        if sample_key is not None and not self.sample(sample_key):
+            return self._add(name, 0, None, compress_level, sample_key)  # Recorded without encoding it
+        from PIL import Image
+
+        if not isinstance(image, Image.Image):
+            image = Image.fromarray(image)
+        encoded = io.BytesIO()
+        image.save(encoded, format=Image.registered_extensions().get(os.path.splitext(name)[1].lower(), "PNG"))
+        return self.add_bytes(name, encoded.getbuffer(), compress_level, sample_key)
+
+    def manifest(self) -> Dict[str, Any]:
+        return {
+            "entries": [{key: entry[key] for key in ("name", "bytes", "level")} for entry in self.entries],
+            "skipped": self.skipped,
+            "bytes": self.bytes,
+            "sample_rate": self.sample_rate,
+        }
+
+    def iter_zip(self) -> Iterator[bytes]:
+        """The zip of every entry plus manifest.json, built as it's read."""
+        # An empty chunk would end a chunked upload early
+        return (chunk for chunk in self._zip_chunks() if chunk)
+
+    def _zip_chunks(self) -> Iterator[bytes]:
+        sink = _Sink()
+        with zipfile.ZipFile(sink, "w") as zipf:
+            for entry in [*self.entries, self._manifest_entry()]:
+                # Set per entry, ZipFile.open applies the archive's settings to new entries
+                zipf.compression = zipfile.ZIP_DEFLATED if entry["level"] else zipfile.ZIP_STORED
+                zipf.compresslevel = entry["level"] or None
+                with zipf.open(
+                    entry["name"], "w", force_zip64=entry["bytes"] >= zipfile.ZIP64_LIMIT
+                ) as dest:
+                    for piece in entry["pieces"]():
+                        dest.write(piece)
+                        if sink.chunks:
+                            yield sink.drain()
+                yield sink.drain()
+        yield sink.drain()  # The central directory
+
+    def _manifest_entry(self) -> Dict[str, Any]:
+        data = json.dumps(self.manifest(), indent=2).encode()
+        return {"name": "manifest.json", "bytes": len(data), "level": DEFAULT_COMPRESS_LEVEL, "pieces": lambda: [data]}
+
+    def upload(self, url: Optional[str] = None, timeout: float = 300) -> requests.Response:
+        """
+        PUT the zip to `url` (default: the upload URL), streamed with chunked transfer encoding.
+
+        Servers that require a Content-Length, like S3 presigned URLs, answer a chunked upload
+        with 411 or 501, or by closing the connection. The zip is then spooled to a temporary
+        file and sent with its size, and later uploads to the same host skip the chunked attempt.
+
+        Args:
+            timeout: Seconds to wait for the server between sent chunks and for its response
+        """
+        url = url or self.upload_url
+        host = urlsplit(url).netloc
+        if host not in _chunked_refused:
+            try:
+                response = requests.put(url, data=self.iter_zip(), timeout=(10, timeout))
+                if response.status_code not in (411, 501):
+                    return response
+            except requests.ConnectionError:
+                pass
+            _chunked_refused.add(host)
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES) as f:
+            for chunk in self.iter_zip():
+                f.write(chunk)
+            size = f.tell()
+
+            def chunks():
+                f.seek(0)
+                return iter(lambda: f.read(READ_SIZE), b"")
+
+            return requests.put(url, data=_SizedBody(chunks, size), timeout=(10, timeout))
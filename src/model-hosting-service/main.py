@@ -1,15 +1,83 @@
 import os
+import sys
 import time
-import torch
+import json
+import queue
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import requests
-import openslide
+import numpy as np
 from PIL import Image, ImageDraw
-from techcyte_client import TechcyteClient
-import zipfile
+
+# Modules shared with the api-bridge live in src/common, the image copies them next to this file
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from techcyte_client import TechcyteClient  # noqa: E402
+from tiling import tile_grid, run_tiled_inference, tile_boxes_to_level0  # noqa: E402
+from tissue import filter_tissue_tiles  # noqa: E402
+from multires import cached_thumbnail, propose_tiles  # noqa: E402
+from merge import nms  # noqa: E402
+from remote_slide import open_slide, is_streamable  # noqa: E402
+from downloader import download_file  # noqa: E402
+from geojson_builder import FeatureBuilder, dumps  # noqa: E402
+from pipeline import run_pipeline  # noqa: E402
+from tracing import Tracer  # noqa: E402
+from spool import DeliveryRejected, ResultSpool, is_retryable_status  # noqa: E402
+from debug_files import DebugFiles  # noqa: E402
+
+# Tiling options for process_image, tune these for your model
+TILE_SIZE = int(os.environ.get("TILE_SIZE", "512"))
+TILE_OVERLAP = int(os.environ.get("TILE_OVERLAP", "0"))
+TILE_LEVEL = int(os.environ.get("TILE_LEVEL", "0"))  # Pyramid level, 0 is full resolution
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", "16"))
+# Boxes overlapping a higher scoring box by more than this IoU are dropped as duplicates,
+# e.g. the same object found by two overlapping tiles
+MERGE_IOU = float(os.environ.get("MERGE_IOU", "0.5"))
+# Tile decoding processes, defaults to the CPU count. 0 decodes in the main process.
+NUM_WORKERS = int(os.environ["NUM_WORKERS"]) if os.environ.get("NUM_WORKERS") else None
+# Tiles with less tissue than this fraction are skipped. Set to 0 to process every tile.
+MIN_TISSUE_COVERAGE = float(os.environ.get("MIN_TISSUE_COVERAGE", "0.05"))
+# Run example_coarse_model over the whole slide at this downsample first, and only decode
+# the full resolution tiles in the regions it proposes. 0 runs the model on every tile.
+COARSE_DOWNSAMPLE = float(os.environ.get("COARSE_DOWNSAMPLE", "0"))
+# Read tiled TIFF/SVS scans straight from SCAN_URL with Range requests instead of
+# downloading them first. Falls back to the full download if the scan can't be streamed.
+STREAM_SLIDE = os.environ.get("STREAM_SLIDE", "").lower() in ("1", "true", "yes")
+# Concurrent range requests and bytes per request when downloading SCAN_URL
+DOWNLOAD_CONNECTIONS = int(os.environ.get("DOWNLOAD_CONNECTIONS", "8"))
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get("DOWNLOAD_CHUNK_MB", "16")) * 1024 * 1024
+# Optional long-lived mode that keeps the model loaded between tasks. "queue" runs
+# the task files dropped in QUEUE_DIR, "http" accepts tasks with POST /tasks on SERVE_PORT.
+SERVE = os.environ.get("SERVE", "").lower()
+QUEUE_DIR = os.environ.get("QUEUE_DIR", "/tmp/tasks")
+QUEUE_POLL_SECONDS = float(os.environ.get("QUEUE_POLL_SECONDS", "1"))
+SERVE_PORT = int(os.environ.get("SERVE_PORT", "8080"))
+# Optional batch mode: a JSON list of tasks, downloaded, processed and posted as a pipeline
+BATCH_FILE = os.environ.get("BATCH_FILE")
+PREFETCH = int(os.environ.get("PREFETCH", "1"))  # Tasks queued between pipeline stages
+# Optional directory to keep every task's trace in, besides uploading it with the debug files
+TRACE_DIR = os.environ.get("TRACE_DIR")
+# Results that still can't be posted after retries are spooled here and re-sent in the
+# background (see spool.py). Mount it on a volume to keep them across containers, empty disables it.
+# Only on by default when serving, a one-shot container's /tmp is gone when it exits.
+RESULTS_SPOOL_DIR = os.environ.get("RESULTS_SPOOL_DIR", "/tmp/results_spool" if SERVE else "")
+SPOOL_FLUSH_SECONDS = float(os.environ.get("SPOOL_FLUSH_SECONDS", "30"))
+# Gzip result bodies, worth it for large GeoJSON payloads if your Techcyte host accepts it
+COMPRESS_RESULTS = os.environ.get("COMPRESS_RESULTS", "").lower() in ("1", "true", "yes")
+# Bounds on the debug files of a task (see debug_files.py). Entries past DEBUG_MAX_MB in total or
+# DEBUG_MAX_ENTRY_MB each are left out, and only DEBUG_SAMPLE_RATE of the sampled ones are kept.
+DEBUG_MAX_BYTES = int(float(os.environ.get("DEBUG_MAX_MB", "1024")) * 1024**2)
+DEBUG_MAX_ENTRY_BYTES = int(float(os.environ.get("DEBUG_MAX_ENTRY_MB", "256")) * 1024**2)
+DEBUG_SAMPLE_RATE = float(os.environ.get("DEBUG_SAMPLE_RATE", "1"))
+DEBUG_UPLOAD_TIMEOUT = float(os.environ.get("DEBUG_UPLOAD_TIMEOUT", "300"))
+
+_spool = None
 
 
 def gpu_test():
     """Run a simple GPU matrix multiplication test."""
+    import torch  # Imported here so tasks that don't need torch don't pay for it
+
     if not torch.cuda.is_available():
         print("CUDA is not available. No GPU detected.")
         return
@@ -27,57 +95,139 @@ def gpu_test():
 
 
 def download_image(url, save_path):
-    """Download image from a URL to save_path."""
-    response = requests.get(url, stream=True)
-    response.raise_for_status()
-    with open(save_path, "wb") as f:
-        for chunk in response.iter_content(chunk_size=8192):
-            f.write(chunk)
-    print(f"Downloaded image to {save_path}")
+    """Download image from a URL to save_path, resuming an interrupted download."""
+    stats = download_file(
+        url, save_path, chunk_size=DOWNLOAD_CHUNK_SIZE, connections=DOWNLOAD_CONNECTIONS
+    )
+    print(f"Downloaded image to {save_path}: {stats}")
+    return stats
+
+
+MITOSIS_PROPERTIES = {"name": "Mitosis", "color": "#ff0000"}
 
 
 def generate_fake_geojson(width, height):
     """
     Generates a fake GeoJSON with 4 boxes in a 2x2 grid.
+    Returns a FeatureBuilder, add your model's boxes or polygons to it.
     """
     box_size = min(width, height) // 8  # Smaller boxes for demonstration
-    features = []
-    for i in range(2):
-        for j in range(2):
-            x_center = (width // 4) * (2 * i + 1)
-            y_center = (height // 4) * (2 * j + 1)
-            poly = [
-                [x_center - box_size // 2, y_center - box_size // 2],
-                [x_center - box_size // 2, y_center + box_size // 2],
-                [x_center + box_size // 2, y_center + box_size // 2],
-                [x_center + box_size // 2, y_center - box_size // 2],
-                [
-                    x_center - box_size // 2,
-                    y_center - box_size // 2,
-                ],  # Close the polygon
-            ]
-            feature = {
-                "type": "Feature",
-                "geometry": {"type": "Polygon", "coordinates": [poly]},
-                "properties": {"name": "Mitosis", "color": "#ff0000"},
-            }
-            features.append(feature)
-    return {"type": "FeatureCollection", "features": features}
-
-
-def process_image(image_path):
+    centers = np.array(
+        [[(width // 4) * (2 * i + 1), (height // 4) * (2 * j + 1)] for i in range(2) for j in range(2)]
+    )
+    geojson = FeatureBuilder()
+    geojson.add_boxes(
+        np.hstack([centers - box_size // 2, centers + box_size // 2]), MITOSIS_PROPERTIES
+    )
+    return geojson
+
+
+def load_model():
+    """
+    Replace with loading your model, e.g. reading weights onto the GPU.
+    Import torch (or other heavy libraries) here rather than at the top of the file,
+    so they're only loaded when needed. In serve mode this runs once, at startup.
+    """
+    return example_model
+
+
+def example_model(tiles):
+    """
+    Replace with your model.
+    Input: (N, TILE_SIZE, TILE_SIZE, 3) uint8 RGB batch of tiles.
+    Output: One (K, 5) array of [x0, y0, x1, y1, score] boxes per tile, in tile pixels.
+    """
+    return [np.empty((0, 5), dtype=np.float32) for _ in tiles]
+
+
+def example_coarse_model(image):
+    """
+    Replace with your low resolution model, used when COARSE_DOWNSAMPLE is set.
+    Input: (H, W, 3) uint8 RGB image of the whole slide at about COARSE_DOWNSAMPLE.
+    Output: (K, 4) array of [x0, y0, x1, y1] regions worth a closer look, in image pixels.
+    Example: proposes the 5% most stained (saturated) 32x32 pixel cells.
+    """
+    cell = 32
+    rows, cols = image.shape[0] // cell, image.shape[1] // cell
+    if not rows or not cols:
+        return np.empty((0, 4))
+    rgb = np.asarray(image[: rows * cell, : cols * cell], dtype=np.float32)
+    saturation = rgb.max(axis=2) - rgb.min(axis=2)
+    score = saturation.reshape(rows, cell, cols, cell).mean(axis=(1, 3))
+    picked_rows, picked_cols = np.nonzero((score >= np.quantile(score, 0.95)) & (score > 0))
+    x0 = picked_cols * cell
+    y0 = picked_rows * cell
+    return np.stack([x0, y0, x0 + cell, y0 + cell], axis=1)
+
+
+def process_image(image_path, model, tracer=None, debug_files=None):
     """
     Customize this function with your image processing logic.
-    Input: Path to SVS or TIFF file.
+    Input: Path to SVS or TIFF file (or its URL when streaming), the model from load_model(),
+    optionally the task's tracing.Tracer, wrap your own steps in tracer.span(name), and its
+    debug_files.DebugFiles, add overlays, heatmaps or arrays to inspect to it.
     Output: Dict with AI workflow structure including dummy key-value pairs.
-    Example: Places 4 boxes in a 2x2 grid on the highest resolution level.
+    Example: Places 4 boxes in a 2x2 grid on the highest resolution level,
+    plus any boxes found by running example_model over the slide tiles.
     """
-    slide = openslide.OpenSlide(image_path)
-    width, height = slide.dimensions  # Highest resolution (level 0)
+    tracer = tracer or Tracer()
+    debug_files = debug_files or DebugFiles()
+    with tracer.span("open_slide"):
+        slide = open_slide(image_path)
+    try:
+        width, height = slide.dimensions  # Highest resolution (level 0)
+        with tracer.span("tiling") as span:
+            tiles = tile_grid(slide, TILE_SIZE, TILE_OVERLAP, TILE_LEVEL)
+            skipped_ratio = 0.0
+            if MIN_TISSUE_COVERAGE > 0:
+                # Cached on disk, so a second pass over the slide doesn't decode it again
+                thumbnail = cached_thumbnail(slide, image_path)
+                tiles, skipped_ratio = filter_tissue_tiles(
+                    slide, tiles, MIN_TISSUE_COVERAGE, thumbnail=thumbnail
+                )
+                debug_files.add_image("thumbnail.png", thumbnail)
+            span.items = len(tiles)
+        if COARSE_DOWNSAMPLE > 0:
+            with tracer.span("coarse") as span:
+                tissue_tiles = len(tiles)
+                tiles, regions = propose_tiles(
+                    slide, image_path, tiles, example_coarse_model, COARSE_DOWNSAMPLE
+                )
+                span.items = len(tiles)
+            print(
+                f"Coarse pass proposed {len(regions)} regions, "
+                f"keeping {len(tiles)} of {tissue_tiles} tiles"
+            )
+    finally:
+        slide.close()
     geojson = generate_fake_geojson(width, height)
-    num_boxes = len(geojson["features"])
+    num_boxes = len(geojson)
     print(f"Generated {num_boxes} fake annotations.")
 
+    # Tiles are decoded in parallel and streamed back in batches as they finish
+    print(
+        f"Running model over {len(tiles)} tiles (level {TILE_LEVEL}, {TILE_SIZE}px), "
+        f"skipped {skipped_ratio:.1%} as background"
+    )
+    slide_boxes = [np.empty((0, 5))]
+    with tracer.span("inference", tile_size=TILE_SIZE, level=TILE_LEVEL) as span:
+        for batch_tiles, outputs in run_tiled_inference(
+            image_path,
+            model,
+            tiles=tiles,
+            batch_size=BATCH_SIZE,
+            num_workers=NUM_WORKERS,
+        ):
+            for tile, boxes in zip(batch_tiles, outputs):
+                slide_boxes.append(tile_boxes_to_level0(tile, boxes))
+            span.items += len(batch_tiles)
+    # Merge detections repeated across tile seams before adding them to the results
+    with tracer.span("merge") as span:
+        slide_boxes = np.concatenate(slide_boxes)
+        span.items = len(slide_boxes)
+        geojson.add_boxes(slide_boxes[nms(slide_boxes, MERGE_IOU), :4], MITOSIS_PROPERTIES)
+    num_boxes = len(geojson)
+
     # Dummy mitosis count based on number of boxes
     mitosis_count = num_boxes
     # Dummy diagnosis
@@ -97,6 +247,7 @@ def process_image(image_path):
                 {"name": "Result", "result": diagnosis},
                 {"name": "Mitosis Count", "result": str(mitosis_count)},
                 {"name": "Dummy Score", "result": dummy_score},
+                {"name": "Skipped Background Tiles", "result": f"{skipped_ratio:.1%}"},
             ],
             "segments": [
                 {
@@ -109,76 +260,325 @@ def process_image(image_path):
         },
     }
 
-def post_debug_files():
+def task_debug_files(task):
+    """The task's debug files, only collected if it has a DEBUG_FILE_UPLOAD_URL."""
+    return DebugFiles(
+        task.get("debug_file_upload_url") or os.environ.get("DEBUG_FILE_UPLOAD_URL"),
+        max_bytes=DEBUG_MAX_BYTES,
+        max_entry_bytes=DEBUG_MAX_ENTRY_BYTES,
+        sample_rate=DEBUG_SAMPLE_RATE,
+    )
+
+
+def post_debug_files(debug_url=None, tracer=None, debug_files=None):
     """ Optional helper to post debug files for later inspection
-    This example creates a text file, zips it and uploads to the presigned url.
+    This example adds a text file and the task's trace (`trace.json`, open it in
+    https://ui.perfetto.dev) to the files process_image added, and streams them
+    as a zip to the presigned url.
     """
-    debug_url = os.environ.get("DEBUG_FILE_UPLOAD_URL")
-
-    if debug_url:
-        # Create a simple text file for demonstration
-        debug_file_path = "/tmp/debug_info.txt"
-        with open(debug_file_path, "w") as f:
-            f.write("This is a debug file for inspection.\n")
-            f.write("Add any relevant debug information here.\n")
-            f.write("Additional files can be added and zipped together for upload. (images, binary files, etc).\n")
-
-        # Zip the file
-        zip_path = "/tmp/debug_files.zip"
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            zipf.write(debug_file_path, arcname="debug_info.txt")
-
-        # Upload the zipped file to the presigned URL
-        with open(zip_path, 'rb') as f:
-            response = requests.put(debug_url, data=f, timeout=10)
-            if response.status_code == 200:
-                print("Debug files uploaded successfully.")
-            else:
-                print(f"Failed to upload debug files. Status code: {response.status_code}")
+    debug_files = debug_files or task_debug_files({"debug_file_upload_url": debug_url})
 
-def main():
-    # gpu_test()
+    if debug_files.enabled:
+        # A simple text file for demonstration
+        debug_files.add_text(
+            "debug_info.txt",
+            "This is a debug file for inspection.\n"
+            "Add any relevant debug information here.\n"
+            "Additional files can be added to the zip with DebugFiles (images, arrays, files, etc).\n",
+        )
+        if tracer is not None:
+            debug_files.add_text("trace.json", json.dumps(tracer.chrome_trace()))
+            debug_files.add_text("trace_summary.txt", str(tracer))
 
+        response = debug_files.upload(debug_url, timeout=DEBUG_UPLOAD_TIMEOUT)
+        if response.ok:
+            print(
+                f"Debug files uploaded successfully ({len(debug_files.entries)} files, "
+                f"{len(debug_files.skipped)} left out)."
+            )
+        else:
+            print(f"Failed to upload debug files. Status code: {response.status_code}")
+
+def task_from_env():
+    """The task a one-shot container runs, from its environment variables."""
     required_envs = ["SCAN_URL", "HOST", "TASK_ID", "SCAN_ID"]
     for env in required_envs:
         if not os.environ.get(env):
             raise ValueError(f"Missing environment variable: {env}")
-    image_path = "/tmp/downloaded_image.svs"
-    download_image(os.environ["SCAN_URL"], image_path)
+    return {
+        "scan_url": os.environ["SCAN_URL"],
+        "host": os.environ["HOST"],
+        "task_id": os.environ["TASK_ID"],
+        "scan_id": os.environ["SCAN_ID"],
+        "jwt_token": os.environ.get("JWT_TOKEN"),
+        "debug_file_upload_url": os.environ.get("DEBUG_FILE_UPLOAD_URL"),
+    }
+
+
+def parse_task(task):
+    """
+    Check a task received in serve or batch mode. Tasks have the same fields as task_from_env,
+    in lower case; `host` defaults to the HOST environment variable.
+    """
+    if not isinstance(task, dict):
+        raise ValueError("Task must be a JSON object")
+    task = {"host": os.environ.get("HOST"), **task}
+    for key in ["scan_url", "host", "task_id", "scan_id"]:
+        if not task.get(key):
+            raise ValueError(f"Missing task field: {key}")
+    return task
+
+
+def fetch_scan(task, save_path="/tmp/downloaded_image.svs", tracer=None):
+    """Stream the task's scan if possible, otherwise download it. Returns (image_path, downloaded)."""
+    tracer = tracer or Tracer()
+    scan_url = task["scan_url"]
+    if STREAM_SLIDE and is_streamable(scan_url):
+        print("Prod mode: Streaming image with range requests")
+        return scan_url, False
+    with tracer.span("download") as span:
+        span.bytes = download_image(scan_url, save_path).downloaded
     print("Prod mode: Processing downloaded image")
+    return save_path, True
 
-    # Process image
-    print(f"Processing image: {image_path}")
-    workflow_results = process_image(image_path)
 
-    print("Image processing complete. Posting to techcyte...")
-    HOST = os.environ["HOST"]
-    API_KEY_ID = os.environ.get("API_KEY_ID")
-    API_KEY_SECRET = os.environ.get("API_KEY_SECRET")
-    JWT_TOKEN = os.environ.get("JWT_TOKEN")
-
-    client = TechcyteClient(
-        host=HOST,
-        jwt_token=JWT_TOKEN,
-        api_key_id=API_KEY_ID,
-        api_key_secret=API_KEY_SECRET,
+def result_spool():
+    """The spool for undeliverable results, None if RESULTS_SPOOL_DIR is empty."""
+    global _spool
+    if _spool is None and RESULTS_SPOOL_DIR:
+        _spool = ResultSpool(RESULTS_SPOOL_DIR)
+    return _spool
+
+
+def techcyte_client(task):
+    return TechcyteClient(
+        host=task["host"],
+        jwt_token=task.get("jwt_token"),
+        api_key_id=os.environ.get("API_KEY_ID"),
+        api_key_secret=os.environ.get("API_KEY_SECRET"),
     )
+
+
+def send_spooled(entry):
+    """Post spooled results again, for ResultSpool.flush."""
+    task = entry.task
     try:
-        scan_id = os.environ["SCAN_ID"]
-        full_json = {
-            "caseResults": {},
-            "scanResults": [{"scanId": scan_id, "workflow": workflow_results}],
-        }
-        response = client.post_results(os.environ["TASK_ID"], full_json)
+        techcyte_client(task).post_results(
+            task["task_id"],
+            entry.results(),
+            compress=COMPRESS_RESULTS,
+            idempotency_key=entry.idempotency_key,
+        )
+    except requests.RequestException as e:
+        status = e.response.status_code if e.response is not None else None
+        if not is_retryable_status(status):
+            raise DeliveryRejected(str(e)) from e
+        raise
+    print(f"Delivered spooled results of task {task['task_id']}")
+
+
+def post_task_results(task, workflow_results, tracer=None, debug_files=None):
+    """Post the workflow results (and optional debug files with the task's trace) to Techcyte."""
+    tracer = tracer or Tracer(f"task {task['task_id']}")
+    full_json = {
+        "caseResults": {},
+        "scanResults": [{"scanId": task["scan_id"], "workflow": workflow_results}],
+    }
+    # The same key for every attempt, including re-sends from the spool
+    idempotency_key = str(uuid.uuid4())
+    try:
+        with tracer.span("post"):
+            response = techcyte_client(task).post_results(
+                task["task_id"],
+                full_json,
+                compress=COMPRESS_RESULTS,
+                tracer=tracer,
+                idempotency_key=idempotency_key,
+            )
         print(f"Success: {response.status_code}")
     except requests.RequestException as e:
         print(f"Error posting results: {str(e)}")
-        print(f"Results JSON (for debugging): {full_json}")
+        status = e.response.status_code if e.response is not None else None
+        spool = result_spool()
+        if spool is not None and is_retryable_status(status):
+            # Hours of compute shouldn't be lost to an outage, the spool flusher sends them later
+            entry = spool.put(task, full_json, idempotency_key, str(e))
+            print(f"Results spooled to {entry.body_path}, they will be re-sent when the API is back")
+        else:
+            print(f"Results JSON (for debugging): {dumps(full_json)}")
 
+    print(tracer)
+    if TRACE_DIR:
+        tracer.write(os.path.join(TRACE_DIR, f"{task['task_id']}.json"))
     try:
-        post_debug_files()  # Optional: Post debug files for later inspection
+        # Optional: Post debug files for later inspection
+        post_debug_files(task.get("debug_file_upload_url"), tracer, debug_files)
     except Exception as e:
         print(f"Error posting debug files: {str(e)}")
 
+
+def run_task(task, model):
+    """Download (or stream) the task's scan, process it and post the results to Techcyte."""
+    start_time = time.time()
+    tracer = Tracer(f"task {task['task_id']}")
+    debug_files = task_debug_files(task)
+    image_path, downloaded = fetch_scan(task, tracer=tracer)
+    try:
+        # Process image
+        print(f"Processing image: {image_path.split('?')[0]}")  # Drop presigned query
+        workflow_results = process_image(image_path, model, tracer, debug_files)
+    finally:
+        if downloaded and SERVE:
+            os.remove(image_path)  # Don't fill the disk with one scan per task
+
+    print("Image processing complete. Posting to techcyte...")
+    post_task_results(task, workflow_results, tracer, debug_files)
+    print(f"Task {task['task_id']} finished in {time.time() - start_time:.1f}s")
+
+
+def run_batch(tasks, model):
+    """
+    Run a list of tasks as a download -> process -> post pipeline: the next scan
+    downloads and the previous results upload while the current scan is processed.
+    """
+    tracers = [Tracer(f"task {task['task_id']}") for task in tasks]
+    # Only for the tasks between process and post, the entries reference arrays and images
+    debug_files = {}
+
+    def download(index, task, _):
+        return fetch_scan(task, f"/tmp/downloaded_image_{index}.svs", tracers[index])
+
+    def process(index, task, fetched):
+        image_path, downloaded = fetched
+        debug_files[index] = task_debug_files(task)
+        try:
+            print(f"Processing image: {image_path.split('?')[0]}")
+            return process_image(image_path, model, tracers[index], debug_files[index])
+        except Exception:
+            del debug_files[index]
+            raise
+        finally:
+            if downloaded:
+                os.remove(image_path)  # Keeps at most PREFETCH + 2 scans on disk
+
+    def post(index, task, workflow_results):
+        post_task_results(task, workflow_results, tracers[index], debug_files.pop(index))
+
+    report = run_pipeline(
+        tasks, [("download", download), ("process", process), ("post", post)], queue_size=PREFETCH
+    )
+    print(report)
+
+
+def serve_queue(model):
+    """Run task files (`*.json`) from QUEUE_DIR, oldest first. Each is renamed to .done or .failed."""
+    os.makedirs(QUEUE_DIR, exist_ok=True)
+    print(f"Waiting for tasks in {QUEUE_DIR}")
+    while True:
+        paths = [
+            os.path.join(QUEUE_DIR, name) for name in os.listdir(QUEUE_DIR) if name.endswith(".json")
+        ]
+        if not paths:
+            time.sleep(QUEUE_POLL_SECONDS)
+            continue
+        try:
+            # Another server may take a task between listing and claiming it
+            path = min(paths, key=os.path.getmtime)
+            running_path = f"{path}.running"
+            os.rename(path, running_path)  # Claim the task
+        except FileNotFoundError:
+            continue
+        try:
+            with open(running_path) as f:
+                run_task(parse_task(json.load(f)), model)
+            os.rename(running_path, f"{path}.done")
+        except Exception as e:
+            print(f"Task {path} failed: {str(e)}")
+            os.rename(running_path, f"{path}.failed")
+
+
+def serve_http(model):
+    """Accept tasks with POST /tasks on SERVE_PORT and run them one at a time."""
+    tasks = queue.Queue()
+
+    class TaskHandler(BaseHTTPRequestHandler):
+        def _reply(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path != "/health":
+                return self._reply(404, {"error": "Not found"})
+            self._reply(200, {"queued": tasks.qsize()})
+
+        def do_POST(self):
+            if self.path != "/tasks":
+                return self._reply(404, {"error": "Not found"})
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                task = parse_task(json.loads(self.rfile.read(length)))
+            except ValueError as e:  # Includes invalid JSON
+                return self._reply(400, {"error": str(e)})
+            tasks.put(task)
+            self._reply(202, {"task_id": task["task_id"], "queued": tasks.qsize()})
+
+    server = ThreadingHTTPServer(("0.0.0.0", SERVE_PORT), TaskHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Accepting tasks on port {SERVE_PORT}")
+    # Tasks run on the main thread, one at a time, so they never compete for the model
+    while True:
+        task = tasks.get()
+        try:
+            run_task(task, model)
+        except Exception as e:
+            print(f"Task {task['task_id']} failed: {str(e)}")
+
+
+def main():
+    # gpu_test()
+
+    if SERVE not in ("", "queue", "http"):
+        raise ValueError(f"Unknown SERVE mode: {SERVE}, expected queue or http")
+    if BATCH_FILE:
+        with open(BATCH_FILE) as f:
+            tasks = [parse_task(task) for task in json.load(f)]
+    task = None if SERVE or BATCH_FILE else task_from_env()
+
+    spool = result_spool()
+    if spool is not None:
+        # Also sends what earlier runs spooled, when the spool directory is on a volume
+        spool.start_flusher(send_spooled, SPOOL_FLUSH_SECONDS)
+
+    start_time = time.time()
+    model = load_model()
+    print(f"Model loaded in {time.time() - start_time:.1f}s")
+    if SERVE == "queue":
+        serve_queue(model)
+    elif SERVE == "http":
+        serve_http(model)
+    elif BATCH_FILE:
+        run_batch(tasks, model)
+    else:
+        run_task(task, model)
+
+    if spool is not None and spool.entries():
+        # Last chance before the container exits
+        spool.flush(send_spooled, force=True)
+        remaining = len(spool.entries())
+        if remaining:
+            print(f"{remaining} results still spooled in {RESULTS_SPOOL_DIR}, the next run will send them")
+            # In case the directory isn't on a volume after all
+            for entry in spool.entries():
+                print(f"Results JSON of task {entry.task['task_id']} (for debugging): ", end="", flush=True)
+                for chunk in entry.results().iter_json():
+                    sys.stdout.buffer.write(chunk)
+                sys.stdout.buffer.write(b"\n")
+                sys.stdout.buffer.flush()
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,233 @@
+"""
+Coarse-to-fine analysis over the slide pyramid.
+
+A low resolution model looks at the whole slide at once, from the best pyramid
+level for the requested downsample, and proposes regions of interest. Only the
+full resolution tiles that overlap those regions are then decoded and sent to
+the fine model, so a model that finds a few sparse objects decodes a fraction
+of the slide. Region coordinates are scaled back to level 0 with the exact
+per-axis ratio between level 0 and the coarse image.
+
+Decoded coarse images and thumbnails are cached as memory mapped `.npy` files,
+so later passes over the same slide (tissue detection, re-runs, serve mode)
+read them back without decoding again.
+"""
+
+import hashlib
+import math
+import os
+import tempfile
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from remote_slide import is_url
+
+LEVEL_CACHE_DIR = os.environ.get(
+    "LEVEL_CACHE_DIR", os.path.join(tempfile.gettempdir(), "slide_levels")
+)
+LEVEL_CACHE_BYTES = int(os.environ.get("LEVEL_CACHE_MB", "2048")) * 1024 * 1024
+# Larger pyramid levels are not decoded whole, they're read in blocks and downsampled instead
+MAX_LEVEL_PIXELS = 64 * 1024 * 1024
+STRIP_HEIGHT = 1024  # Rows decoded at once when caching a level, and side of the blocks of larger ones
+
+
+def _source_key(source: str) -> str:
+    """Identify a slide across runs, ignoring presigned query strings."""
+    if is_url(source):
+        identity = source.split("?")[0]
+    else:
+        stat = os.stat(source)
+        identity = f"{os.path.abspath(source)}:{stat.st_mtime_ns}:{stat.st_size}"
+    return hashlib.sha1(identity.encode()).hexdigest()[:20]
+
+
+def _prune(cache_dir: str, max_bytes: int):
+    """Remove the least recently used cached arrays until the cache fits in max_bytes."""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(".npy"):
+            stat = os.stat(os.path.join(cache_dir, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def _cached_array(
+    path: str, shape: Optional[Tuple[int, ...]], fill: Callable, max_bytes: int
+) -> np.ndarray:
+    """
+    Load the uint8 array at `path` as a read-only memory map, creating it first if needed.
+
+    With a `shape`, `fill(out)` writes into a memory mapped array of that shape,
+    so large images are never held in memory. Without one, `fill()` returns the array.
+    """
+    if os.path.exists(path):
+        os.utime(path)  # Keeps LRU order for _prune
+        return np.load(path, mmap_mode="r")
+    cache_dir = os.path.dirname(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    if shape is None:
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.ascontiguousarray(fill(), dtype=np.uint8))
+    else:
+        out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8, shape=shape)
+        fill(out)
+        out.flush()
+        del out
+    os.replace(tmp_path, path)  # Written atomically, concurrent readers never see a partial file
+    _prune(cache_dir, max_bytes)
+    return np.load(path, mmap_mode="r")
+
+
+def _rgb(region) -> np.ndarray:
+    rgba = np.asarray(region)
+    rgb = rgba[..., :3].copy()
+    rgb[rgba[..., 3] == 0] = 255  # Transparent areas are background, like tiling.read_tiles
+    return rgb
+
+
+def _reduce_level(slide, level: int, factor: int, out: np.ndarray):
+    """
+    Fill `out` with `level` of `slide` shrunk `factor` times along each axis.
+
+    The level is read in blocks of about STRIP_HEIGHT x STRIP_HEIGHT pixels and each
+    block is averaged over factor x factor pixels, so memory stays bounded however
+    large the level is. Blocks past the level's edge read as white background.
+    """
+    height, width = out.shape[:2]
+    level_downsample = slide.level_downsamples[level]
+    step = max(1, STRIP_HEIGHT // factor)  # Output pixels per block side
+    for y in range(0, height, step):
+        rows = min(step, height - y)
+        y0 = int(round(y * factor * level_downsample))  # read_region takes level 0 coordinates
+        for x in range(0, width, step):
+            cols = min(step, width - x)
+            x0 = int(round(x * factor * level_downsample))
+            block = _rgb(slide.read_region((x0, y0), level, (cols * factor, rows * factor)))
+            block = block.reshape(rows, factor, cols, factor, 3).mean(axis=(1, 3))
+            out[y : y + rows, x : x + cols] = np.round(block).astype(np.uint8)
+
+
+def cached_thumbnail(
+    slide, source: str, size: int = 1024, cache_dir: str = LEVEL_CACHE_DIR
+) -> np.ndarray:
+    """An RGB (H, W, 3) thumbnail of `slide` that fits in size x size, cached on disk."""
+    path = os.path.join(cache_dir, f"{_source_key(source)}-thumb{size}.npy")
+    width0, height0 = slide.dimensions
+    level = slide.get_best_level_for_downsample(max(width0, height0) / size)
+    width, height = slide.level_dimensions[level]
+    if width * height <= MAX_LEVEL_PIXELS:
+        return _cached_array(
+            path,
+            None,
+            lambda: _rgb(slide.get_thumbnail((size, size)).convert("RGBA")),
+            LEVEL_CACHE_BYTES,
+        )
+    # get_thumbnail would decode the whole level in memory
+    factor = max(1, math.ceil(max(width, height) / size))
+    shape = (math.ceil(height / factor), math.ceil(width / factor), 3)
+    return _cached_array(
+        path, shape, lambda out: _reduce_level(slide, level, factor, out), LEVEL_CACHE_BYTES
+    )
+
+
+def coarse_image(
+    slide, source: str, downsample: float = 32, cache_dir: str = LEVEL_CACHE_DIR
+) -> Tuple[np.ndarray, Tuple[float, float]]:
+    """
+    The whole slide as one RGB image at roughly `downsample`, cached on disk.
+
+    Uses the best pyramid level for `downsample`. If that level is still too large
+    (e.g. a slide without a pyramid), it's read in blocks and each block shrunk by
+    the whole factor closest to `downsample`, so it's never decoded whole.
+
+    Returns:
+        (image, (downsample_x, downsample_y)): a read-only (H, W, 3) uint8 memory map
+        and the level 0 pixels per image pixel along each axis.
+    """
+    width0, height0 = slide.dimensions
+    level = slide.get_best_level_for_downsample(downsample)
+    width, height = slide.level_dimensions[level]
+    key = _source_key(source)
+
+    if width * height <= MAX_LEVEL_PIXELS:
+        level_downsample = slide.level_downsamples[level]
+
+        def fill(out):
+            for y in range(0, height, STRIP_HEIGHT):
+                rows = min(STRIP_HEIGHT, height - y)
+                y0 = int(round(y * level_downsample))  # read_region takes level 0 coordinates
+                out[y : y + rows] = _rgb(slide.read_region((0, y0), level, (width, rows)))
+
+        path = os.path.join(cache_dir, f"{key}-level{level}.npy")
+        return _cached_array(path, (height, width, 3), fill, LEVEL_CACHE_BYTES), (
+            width0 / width,
+            height0 / height,
+        )
+
+    factor = max(1, round(downsample / slide.level_downsamples[level]))
+    path = os.path.join(cache_dir, f"{key}-level{level}-reduced{factor}.npy")
+    shape = (math.ceil(height / factor), math.ceil(width / factor), 3)
+    image = _cached_array(
+        path, shape, lambda out: _reduce_level(slide, level, factor, out), LEVEL_CACHE_BYTES
+    )
+    # The last row and column of blocks may run past the level's edge, so scale by the factor
+    return image, (factor * width0 / width, factor * height0 / height)
+
+
+def tiles_in_regions(tiles: Sequence, regions: np.ndarray) -> np.ndarray:
+    """Boolean mask of the tiles that overlap any (K, 4) [x0, y0, x1, y1] level 0 region."""
+    keep = np.zeros(len(tiles), dtype=bool)
+    if not len(tiles) or not len(regions):
+        return keep
+    x0 = np.array([t.x for t in tiles], dtype=np.float64)
+    y0 = np.array([t.y for t in tiles], dtype=np.float64)
+    extent = np.array([t.size * t.downsample for t in tiles], dtype=np.float64)
+    x1 = x0 + extent
+    y1 = y0 + extent
+    for rx0, ry0, rx1, ry1 in regions:
+        keep |= (x0 < rx1) & (x1 > rx0) & (y0 < ry1) & (y1 > ry0)
+    return keep
+
+
+def propose_tiles(
+    slide,
+    source: str,
+    tiles: Sequence,
+    coarse_model: Callable[[np.ndarray], Sequence],
+    downsample: float = 32,
+    margin: float = 0,
+    cache_dir: str = LEVEL_CACHE_DIR,
+) -> Tuple[List, np.ndarray]:
+    """
+    Run `coarse_model` over the whole slide at low resolution and keep the tiles it points at.
+
+    `coarse_model` receives the (H, W, 3) uint8 image from coarse_image and returns
+    (K, 4) [x0, y0, x1, y1] regions of interest in that image's pixels.
+
+    Args:
+        slide: Open slide, as returned by remote_slide.open_slide
+        source: Path or URL `slide` was opened from, identifies it in the cache
+        tiles: Candidate full resolution tiles, e.g. from tiling.tile_grid
+        downsample: Resolution the coarse model runs at
+        margin: Level 0 pixels added around every region
+
+    Returns:
+        (tiles, regions): the tiles overlapping a region and the (K, 4) regions in level 0
+    """
+    image, (down_x, down_y) = coarse_image(slide, source, downsample, cache_dir)
+    regions = np.array(coarse_model(image), dtype=np.float64).reshape(-1, 4)
+    regions *= [down_x, down_y, down_x, down_y]
+    regions[:, :2] -= margin
+    regions[:, 2:] += margin
+    keep = tiles_in_regions(tiles, regions)
+    return [tile for tile, kept in zip(tiles, keep) if kept], regions
@@ -0,0 +1,120 @@
+"""
+Pipelined batch processing.
+
+Runs a list of tasks through consecutive stages (e.g. download, process, post),
+each stage on its own thread. While one task is being processed the next one is
+already downloading and the previous one is uploading, so the network and the
+CPU/GPU are busy at the same time. Stages are connected by bounded queues, so a
+fast stage can't run more than a few tasks ahead of a slow one, which caps the
+scans on disk and the results held in memory.
+"""
+
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+# fn(index, task, value) gets the previous stage's return value (None in the first stage)
+StageFn = Callable[[int, Any, Any], Any]
+
+_DONE = object()  # Sent down the queues after the last task
+
+
+class StageStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.busy = 0.0  # Seconds spent running the stage function
+        self.completed = 0
+        self.failed = 0
+
+
+class PipelineReport:
+    def __init__(
+        self,
+        total: int,
+        stages: List[StageStats],
+        seconds: float,
+        errors: Dict[int, Tuple[str, Exception]],
+    ):
+        self.total = total
+        self.stages = stages
+        self.seconds = seconds
+        self.errors = errors  # Task index -> (stage name, exception)
+
+    @property
+    def completed(self) -> int:
+        return self.stages[-1].completed
+
+    @property
+    def per_minute(self) -> float:
+        return self.completed / self.seconds * 60 if self.seconds else 0.0
+
+    def __str__(self):
+        lines = [
+            f"Processed {self.completed} of {self.total} tasks in {self.seconds:.1f}s "
+            f"({self.per_minute:.1f} per minute)"
+        ]
+        for stage in self.stages:
+            utilization = stage.busy / self.seconds if self.seconds else 0.0
+            lines.append(
+                f"  {stage.name:<10} busy {stage.busy:7.1f}s {utilization:6.1%}  "
+                f"{stage.completed} done, {stage.failed} failed"
+            )
+        return "\n".join(lines)
+
+
+def run_pipeline(
+    tasks: Sequence[Any], stages: List[Tuple[str, StageFn]], queue_size: int = 1
+) -> PipelineReport:
+    """
+    Run every task through `stages` in order and report per-stage utilization.
+
+    `stages` is a list of (name, fn) pairs, see StageFn. Each queue between two
+    stages holds `queue_size` tasks, so there are at most `queue_size + 2` tasks
+    between the start of one stage and the end of the next. A task that fails
+    in one stage is skipped by the later ones, its error is kept in the report.
+    """
+    stats = [StageStats(name) for name, _ in stages]
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages[1:]]
+    errors = {}
+
+    def inputs(i):
+        if i == 0:
+            for index, task in enumerate(tasks):
+                yield index, task, None
+            return
+        while True:
+            entry = queues[i - 1].get()
+            if entry is _DONE:
+                return
+            yield entry
+
+    def run_stage(i):
+        name, fn = stages[i]
+        for index, task, value in inputs(i):
+            start = time.perf_counter()
+            try:
+                value = fn(index, task, value)
+            except Exception as e:
+                print(f"Task {index} failed in {name}: {str(e)}")
+                errors[index] = (name, e)
+                stats[i].failed += 1
+                continue
+            finally:
+                stats[i].busy += time.perf_counter() - start
+            stats[i].completed += 1
+            if i < len(queues):
+                queues[i].put((index, task, value))  # Blocks while the next stage is behind
+        if i < len(queues):
+            queues[i].put(_DONE)
+
+    start = time.perf_counter()
+    threads = [
+        threading.Thread(target=run_stage, args=(i,), name=name, daemon=True)
+        for i, (name, _) in enumerate(stages)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return PipelineReport(len(tasks), stats, time.perf_counter() - start, errors)